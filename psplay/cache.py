@@ -0,0 +1,274 @@
+import hashlib
+import os
+import tempfile
+import threading
+from collections import OrderedDict
+
+import numpy as np
+from pixell import enmap
+
+_units = {"B": 1, "KB": 1024, "MB": 1024 ** 2, "GB": 1024 ** 3, "TB": 1024 ** 4}
+
+
+def parse_size(size):
+    """Convert a size given as a number of bytes or as a string such as '500 MB' into bytes"""
+    if size is None or isinstance(size, (int, float)):
+        return size
+    value = size.strip().upper()
+    for unit in sorted(_units, key=len, reverse=True):
+        if value.endswith(unit):
+            return float(value[: -len(unit)]) * _units[unit]
+    return float(value)
+
+
+def hash_items(*items):
+    """Return a hexadecimal digest identifying the given items
+
+    Parameters
+    ----------
+    items: list
+      numpy arrays, strings, numbers, None or (nested) lists/tuples of them
+    """
+    sha = hashlib.sha1()
+
+    def _update(item):
+        if isinstance(item, np.ndarray):
+            sha.update("{}{}".format(item.dtype.str, item.shape).encode())
+            sha.update(np.ascontiguousarray(item).tobytes())
+        elif isinstance(item, (list, tuple)):
+            sha.update(b"(")
+            for i in item:
+                _update(i)
+            sha.update(b")")
+        else:
+            sha.update(repr(item).encode())
+        sha.update(b";")
+
+    for item in items:
+        _update(item)
+    return sha.hexdigest()
+
+
+def hash_file(file_name):
+    """Return a digest of the file content or None if no file is given"""
+    if file_name is None:
+        return None
+    sha = hashlib.sha1()
+    with open(file_name, "rb") as f:
+        for chunk in iter(lambda: f.read(1 << 20), b""):
+            sha.update(chunk)
+    return sha.hexdigest()
+
+
+def hash_window(window):
+    """Return a digest of the window pixels and of its geometry
+
+    The right ascension of the patch is left out: windows identical up to a translation in right
+    ascension have the same harmonic coefficients up to a phase, hence the same mode coupling. Only
+    the projection, the pixel sizes and the declinations of the pixel rows are kept. Pixels are
+    rounded to 1e-6 since the apodization of translated windows differs by round-off errors.
+    """
+    wcs = window.data.wcs
+    dec, _ = enmap.posaxes(window.data.shape, wcs)
+    return hash_items(
+        np.round(window.data, 6),
+        list(wcs.wcs.ctype),
+        np.round(wcs.wcs.cdelt, 10),
+        np.round(np.rad2deg(dec), 8),
+    )
+
+
+class DiskCache:
+    """A content-addressed store of numpy arrays (or dict of numpy arrays) on disk
+
+    Every entry is saved as a npz file named after its key. The total size of the cache is
+    bounded by ``max_size`` and the least recently used entries are evicted first.
+
+    Parameters
+    ----------
+    directory: string
+      the directory holding the npz files
+    max_size: int, float or string
+      the maximal size of the cache in bytes (or as a string like "2 GB"), None means unbounded
+    """
+
+    def __init__(self, directory, max_size=None):
+        self.directory = os.path.expanduser(directory)
+        self.max_size = parse_size(max_size)
+        os.makedirs(self.directory, exist_ok=True)
+
+    def _path(self, key):
+        return os.path.join(self.directory, "{}.npz".format(key))
+
+    def get(self, key):
+        """Return the value stored under key or None if there is no such entry"""
+        path = self._path(key)
+        if not os.path.exists(path):
+            return None
+        try:
+            with np.load(path, allow_pickle=False) as f:
+                if "__array__" in f.files:
+                    value = f["__array__"]
+                else:
+                    value = {k: f[k] for k in f.files}
+        except (OSError, ValueError):
+            # Corrupted or partially written entry
+            self.remove(key)
+            return None
+        # Mark entry as recently used, the entry may have been evicted by another process
+        try:
+            os.utime(path)
+        except OSError:
+            pass
+        return value
+
+    def set(self, key, value):
+        """Store value (a numpy array or a dict of numpy arrays) under key"""
+        arrays = value if isinstance(value, dict) else {"__array__": value}
+        fd, tmp_path = tempfile.mkstemp(dir=self.directory, suffix=".tmp")
+        try:
+            with os.fdopen(fd, "wb") as f:
+                np.savez(f, **arrays)
+            os.replace(tmp_path, self._path(key))
+        except Exception:
+            os.remove(tmp_path)
+            raise
+        self.evict()
+
+    def remove(self, key):
+        try:
+            os.remove(self._path(key))
+        except FileNotFoundError:
+            pass
+
+    def clear(self):
+        for path, _, _ in self._entries():
+            os.remove(path)
+
+    def _entries(self):
+        entries = []
+        for name in os.listdir(self.directory):
+            if not name.endswith(".npz"):
+                continue
+            path = os.path.join(self.directory, name)
+            try:
+                stat = os.stat(path)
+            except FileNotFoundError:
+                continue
+            entries.append((path, stat.st_mtime, stat.st_size))
+        return entries
+
+    @property
+    def size(self):
+        """The total size in bytes of the cache entries"""
+        return sum(size for _, _, size in self._entries())
+
+    def evict(self):
+        """Remove the least recently used entries until the cache fits within max_size"""
+        if self.max_size is None:
+            return
+        entries = sorted(self._entries(), key=lambda entry: entry[1])
+        total_size = sum(size for _, _, size in entries)
+        for path, _, size in entries:
+            if total_size <= self.max_size:
+                break
+            try:
+                os.remove(path)
+            except FileNotFoundError:
+                pass
+            total_size -= size
+
+
+class MemoryCache:
+    """A store of numpy arrays (or dict of numpy arrays) kept in memory
+
+    The total size of the stored arrays is bounded by ``max_size`` and the least recently used
+    entries are evicted first.
+
+    Parameters
+    ----------
+    max_size: int, float or string
+      the maximal size of the cache in bytes (or as a string like "2 GB"), None means unbounded
+    """
+
+    def __init__(self, max_size=None):
+        self.max_size = parse_size(max_size)
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, key):
+        """Return the value stored under key or None if there is no such entry"""
+        with self._lock:
+            if key not in self._entries:
+                return None
+            self._entries.move_to_end(key)
+            return self._entries[key][0]
+
+    def set(self, key, value):
+        """Store value (a numpy array or a dict of numpy arrays) under key"""
+        arrays = value.values() if isinstance(value, dict) else [value]
+        with self._lock:
+            self._entries[key] = (value, sum(np.asarray(a).nbytes for a in arrays))
+            self._entries.move_to_end(key)
+        self.evict()
+
+    def remove(self, key):
+        with self._lock:
+            self._entries.pop(key, None)
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+
+    @property
+    def size(self):
+        """The total size in bytes of the cache entries"""
+        with self._lock:
+            return sum(size for _, size in self._entries.values())
+
+    def evict(self):
+        """Remove the least recently used entries until the cache fits within max_size"""
+        if self.max_size is None:
+            return
+        with self._lock:
+            total_size = sum(size for _, size in self._entries.values())
+            while total_size > self.max_size and self._entries:
+                _, (_, size) = self._entries.popitem(last=False)
+                total_size -= size
+
+
+class TieredCache:
+    """Chain several caches, from the fastest to the slowest one
+
+    Values are looked up in each cache in turn and copied into the faster caches when found.
+    New values are stored in all the caches.
+
+    Parameters
+    ----------
+    caches: list
+      the caches (e.g. a MemoryCache followed by a DiskCache), None entries are ignored
+    """
+
+    def __init__(self, *caches):
+        self.caches = [cache for cache in caches if cache is not None]
+
+    def get(self, key):
+        for i, cache in enumerate(self.caches):
+            value = cache.get(key)
+            if value is not None:
+                for faster_cache in self.caches[:i]:
+                    faster_cache.set(key, value)
+                return value
+        return None
+
+    def set(self, key, value):
+        for cache in self.caches:
+            cache.set(key, value)
+
+    def remove(self, key):
+        for cache in self.caches:
+            cache.remove(key)
+
+    def clear(self):
+        for cache in self.caches:
+            cache.clear()
@@ -0,0 +1,196 @@
+import json
+from collections.abc import Mapping
+
+import numpy as np
+
+
+def _import_h5py():
+    try:
+        import h5py
+    except ImportError:
+        raise ImportError("h5py is required to read and write results in HDF5 format")
+    return h5py
+
+
+def _write_dataset(group, name, value):
+    value = np.asarray(value)
+    if value.ndim == 0:
+        group.create_dataset(name, data=value)
+    else:
+        group.create_dataset(
+            name, data=value, chunks=True, compression="gzip", compression_opts=4, shuffle=True
+        )
+
+
+def _write_dict(group, name, value):
+    # Spectra and covariances are (nested) dictionaries of arrays. The 2D spectra are pspy
+    # power2D objects for which only the power maps and the multipole axes are stored
+    if hasattr(value, "powermap"):
+        subgroup = group.create_group(name)
+        subgroup.attrs["class"] = "power2D"
+        subgroup.attrs["spectra"] = json.dumps(list(value.spectra))
+        _write_dataset(subgroup, "lx", value.lx)
+        _write_dataset(subgroup, "ly", value.ly)
+        _write_dict(subgroup, "powermap", value.powermap)
+    elif isinstance(value, Mapping):
+        subgroup = group.create_group(name)
+        for k, v in value.items():
+            _write_dict(subgroup, k, v)
+    else:
+        _write_dataset(group, name, value)
+
+
+def _read_item(item, file_name=None):
+    # Groups are read at once, or wrapped into a LazyGroup if a file name is given
+    if not hasattr(item, "keys"):
+        return item[()]
+    if item.attrs.get("class") == "power2D":
+        from pspy import flat_tools
+
+        p2d = flat_tools.power2D()
+        p2d.spectra = json.loads(item.attrs["spectra"])
+        p2d.lx, p2d.ly = item["lx"][()], item["ly"][()]
+        p2d.powermap = _read_item(item["powermap"], file_name)
+        return p2d
+    if file_name is not None:
+        return LazyGroup(file_name, item.name, list(item.keys()))
+    return {k: _read_item(v) for k, v in item.items()}
+
+
+class LazyGroup(Mapping):
+    """A read-only dictionary over a HDF5 group, datasets are only read when accessed
+
+    Parameters
+    ----------
+    file_name: string
+      the name of the HDF5 file
+    path: string
+      the path of the group within the file
+    keys: list
+      the names of the group members
+    """
+
+    def __init__(self, file_name, path, keys):
+        self.file_name = file_name
+        self.path = path
+        self._keys = keys
+        self._items = {}
+
+    def __getitem__(self, key):
+        if key not in self._items:
+            if key not in self._keys:
+                raise KeyError(key)
+            with _import_h5py().File(self.file_name, "r") as f:
+                self._items[key] = _read_item(f[self.path][key], self.file_name)
+        return self._items[key]
+
+    def __iter__(self):
+        return iter(self._keys)
+
+    def __len__(self):
+        return len(self._keys)
+
+    def load(self):
+        """Return a dictionary holding all the datasets of the group"""
+        with _import_h5py().File(self.file_name, "r") as f:
+            return _read_item(f[self.path])
+
+
+def write_results(file_name, patches):
+    """Write the power spectra and covariances of several patches in a HDF5 file
+
+    The file holds one group per patch and, within it, one group per power spectrum method. Each
+    method group holds the binned multipoles ``lb`` and the ``ps`` and ``cov`` groups, indexed by
+    split pair names and spectra. Arrays are stored in chunked and compressed datasets. Patch
+    geometry (as a pstools patch dictionary and as the GeoJSON drawn on the map) and computation
+    configuration are stored as JSON attributes.
+
+    Parameters
+    ----------
+    file_name: string
+      the name of the HDF5 file
+    patches: dict
+      the patches indexed by their names. Each patch is a dictionary with optional 'patch' and
+      'geojson' entries holding the patch geometry and one entry per power spectrum method
+      holding the 'config', the 'results' and optionally the 'performance' records and the
+      'profile_report' of the computation. A failed computation holds an 'error' message in
+      place of the results
+    """
+    h5py = _import_h5py()
+
+    with h5py.File(file_name, "w") as f:
+        for name, patch in patches.items():
+            group = f.create_group(name)
+            for key in ["patch", "geojson"]:
+                if patch.get(key) is not None:
+                    group.attrs[key] = json.dumps(patch[key])
+            for ps_method in ["master", "pseudo", "2dflat"]:
+                method = patch.get(ps_method)
+                if not method or not (method.get("results") or method.get("error")):
+                    continue
+                subgroup = group.create_group(ps_method)
+                subgroup.attrs["config"] = json.dumps(method.get("config", {}))
+                if method.get("performance"):
+                    subgroup.attrs["performance"] = json.dumps(method["performance"])
+                if method.get("profile_report"):
+                    subgroup.attrs["profile_report"] = method["profile_report"]
+                if method.get("error"):
+                    subgroup.attrs["error"] = method["error"]
+                    continue
+                results = method["results"]
+                subgroup.attrs["spectra"] = json.dumps(results["spectra"])
+                subgroup.attrs["spec_name_list"] = json.dumps(results["spec_name_list"])
+                _write_dataset(subgroup, "lb", results["lb"])
+                _write_dict(subgroup, "ps", results["ps"])
+                if results.get("cov") is not None:
+                    _write_dict(subgroup, "cov", results["cov"])
+
+
+def read_results(file_name, lazy=False):
+    """Read the power spectra and covariances written by ``write_results``
+
+    Parameters
+    ----------
+    file_name: string
+      the name of the HDF5 file
+    lazy: boolean
+      if True, the spectra and covariances are returned as LazyGroup objects reading the arrays
+      from the file only when they are accessed. Geometries, configurations and multipoles are
+      always read
+
+    Return
+    ----------
+    The patches indexed by their names with the same layout as the one given to ``write_results``
+    """
+    h5py = _import_h5py()
+
+    patches = {}
+    with h5py.File(file_name, "r") as f:
+        for name, group in f.items():
+            patch = {}
+            for key in ["patch", "geojson"]:
+                if key in group.attrs:
+                    patch[key] = json.loads(group.attrs[key])
+            for ps_method, subgroup in group.items():
+                patch[ps_method] = dict(
+                    config=json.loads(subgroup.attrs["config"]),
+                    performance=json.loads(subgroup.attrs.get("performance", "[]")),
+                )
+                if "profile_report" in subgroup.attrs:
+                    patch[ps_method]["profile_report"] = subgroup.attrs["profile_report"]
+                if "error" in subgroup.attrs:
+                    patch[ps_method].update(error=subgroup.attrs["error"], results=None)
+                    continue
+                patch[ps_method].update(
+                    results={
+                        "spectra": json.loads(subgroup.attrs["spectra"]),
+                        "spec_name_list": json.loads(subgroup.attrs["spec_name_list"]),
+                        "lb": subgroup["lb"][()],
+                        "ps": _read_item(subgroup["ps"], file_name if lazy else None),
+                        "cov": _read_item(subgroup["cov"], file_name if lazy else None)
+                        if "cov" in subgroup
+                        else None,
+                    },
+                )
+            patches[name] = patch
+    return patches
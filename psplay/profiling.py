@@ -0,0 +1,213 @@
+import cProfile
+import io
+import os
+import pstats
+import resource
+import sys
+import time
+from concurrent.futures import Future
+from contextlib import contextmanager
+from contextvars import ContextVar
+
+# The profiler recording the stages of the current computation
+_active_profiler = ContextVar("profiler", default=None)
+
+
+def peak_rss():
+    """Return the peak resident set size of the current process in bytes"""
+    maxrss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    # ru_maxrss is given in kilobytes on Linux and in bytes on macOS
+    return maxrss if sys.platform == "darwin" else maxrss * 1024
+
+
+class Profiler:
+    """Record the wall time, the CPU time and the peak memory of the computation stages
+
+    Each record is a dictionary holding the stage name (e.g. "window", "mcm", "sht"), a label
+    describing what has been done, the wall and CPU times in seconds, the peak resident set size
+    in bytes of the process at the end of the stage and the process id.
+
+    Parameters
+    ----------
+    verbose: boolean
+      print the stages as they are done
+    profile: string
+      optionally profile the whole computation with "cprofile" or "pyinstrument". The report is
+      available in the ``report`` attribute once the profiler is stopped
+    keep_records: boolean
+      keep the records of the stages, otherwise stages are only printed
+    write: callable
+      the function writing the printed text, e.g. the ``append_stdout`` method of an output
+      widget. By default text is written to the standard output
+    """
+
+    def __init__(self, verbose=True, profile=None, keep_records=True, write=None):
+        if profile not in [None, "cprofile", "pyinstrument"]:
+            raise ValueError("Unknown profile option '{}'".format(profile))
+        self.verbose = verbose
+        self.profile = profile
+        self.keep_records = keep_records
+        self.write = write
+        self.records = []
+        self._stages = []
+        self.report = None
+        self._profiler = None
+        self._token = None
+
+    def start(self):
+        """Make the profiler the active one and start the optional profiling hook"""
+        self._token = _active_profiler.set(self)
+        if self.profile == "cprofile":
+            self._profiler = cProfile.Profile()
+            self._profiler.enable()
+        elif self.profile == "pyinstrument":
+            try:
+                from pyinstrument import Profiler as _Profiler
+            except ImportError:
+                raise ImportError("pyinstrument is required for 'pyinstrument' profile option")
+            self._profiler = _Profiler()
+            self._profiler.start()
+        return self
+
+    def stop(self):
+        """Stop the profiling hook and restore the previously active profiler"""
+        if self.profile == "cprofile":
+            self._profiler.disable()
+            stream = io.StringIO()
+            stats = pstats.Stats(self._profiler, stream=stream)
+            stats.sort_stats("cumulative").print_stats(30)
+            self.report = stream.getvalue()
+        elif self.profile == "pyinstrument":
+            self._profiler.stop()
+            self.report = self._profiler.output_text()
+        self._profiler = None
+        if self._token is not None:
+            _active_profiler.reset(self._token)
+            self._token = None
+
+    def __enter__(self):
+        return self.start()
+
+    def __exit__(self, *args):
+        self.stop()
+
+    def start_stage(self, name, label="Starting..."):
+        """Start recording a stage, stages can be nested"""
+        self._print(label, end=" ")
+        self._stages.append((name, label, time.perf_counter(), time.process_time()))
+
+    def stop_stage(self):
+        """Stop recording the last started stage and return its record"""
+        name, label, t0, c0 = self._stages.pop()
+        record = dict(
+            stage=name,
+            label=label,
+            wall_time=time.perf_counter() - t0,
+            cpu_time=time.process_time() - c0,
+            peak_rss=peak_rss(),
+            pid=os.getpid(),
+        )
+        if self.keep_records:
+            self.records.append(record)
+        self._print("done in {:.2f} s".format(record["wall_time"]))
+        return record
+
+    def log(self, message):
+        """Print a message about the computation, such as a reused result, if verbose"""
+        self._print(message)
+
+    def _print(self, text, end="\n"):
+        if not self.verbose:
+            return
+        if self.write is None:
+            print(text, end=end)
+        else:
+            self.write(text + end)
+
+    @contextmanager
+    def stage(self, name, label="Starting..."):
+        """Record the stage run within the context"""
+        self.start_stage(name, label)
+        yield
+        self.stop_stage()
+
+    def extend(self, records):
+        """Add records made elsewhere i.e. in worker processes"""
+        for record in records:
+            if self.keep_records:
+                self.records.append(record)
+            self._print("{} done in {:.2f} s".format(record["label"], record["wall_time"]))
+
+    def summary(self):
+        """Return the total wall time, CPU time and peak memory per stage"""
+        summary = {}
+        for record in self.records:
+            total = summary.setdefault(
+                record["stage"], dict(wall_time=0.0, cpu_time=0.0, peak_rss=0, count=0)
+            )
+            total["wall_time"] += record["wall_time"]
+            total["cpu_time"] += record["cpu_time"]
+            total["peak_rss"] = max(total["peak_rss"], record["peak_rss"])
+            total["count"] += 1
+        return summary
+
+
+def get_profiler():
+    """Return the active profiler or a profiler only printing the stages if there is none"""
+    profiler = _active_profiler.get()
+    return profiler if profiler is not None else _default_profiler
+
+
+# Profiler used outside of any profiled computation
+_default_profiler = Profiler(keep_records=False)
+
+
+def run_profiled(func, *args, **kwargs):
+    """Run func with a new active profiler and return its result together with the records"""
+    with Profiler(verbose=False) as profiler:
+        result = func(*args, **kwargs)
+    return result, profiler.records
+
+
+class ProfiledFuture(Future):
+    """A future holding the result of a function run in a worker by ``run_profiled``
+
+    The stages recorded by the worker are added to the profiler, from the calling thread, the
+    first time the result is retrieved.
+    """
+
+    def __init__(self, profiler):
+        super().__init__()
+        self.profiler = profiler
+        self.records = []
+
+    def result(self, timeout=None):
+        result = super().result(timeout)
+        records, self.records = self.records, []
+        self.profiler.extend(records)
+        return result
+
+
+def submit_profiled(executor, func, args=(), kwargs=None, then=None):
+    """Submit func to the executor and return a future holding its result
+
+    Parameters
+    ----------
+    executor: concurrent.futures.Executor
+      the pool of workers
+    func: callable
+      the function to run with args and kwargs
+    then: callable
+      an optional function applied to the result within the main process before the future is set
+    """
+    future = ProfiledFuture(get_profiler())
+
+    def _done(profiled_future):
+        try:
+            result, future.records = profiled_future.result()
+            future.set_result(then(result) if then is not None else result)
+        except Exception as e:
+            future.set_exception(e)
+
+    executor.submit(run_profiled, func, *args, **(kwargs or {})).add_done_callback(_done)
+    return future
@@ -1,9 +1,13 @@
 # Copyright (c) Simons Observatory.
 # Distributed under the terms of the Modified BSD License.
 #
+import html
+import multiprocessing
 import os
-import pickle
+import threading
 import time
+from concurrent.futures import (FIRST_COMPLETED, CancelledError, ProcessPoolExecutor,
+                                ThreadPoolExecutor, wait)
 from copy import deepcopy
 
 import ipywidgets as widgets
@@ -12,10 +16,13 @@ import plotly.graph_objects as go
 import yaml
 from ipyleaflet import DrawControl, FullScreenControl, Map, MapStyle, Polygon, WidgetControl
 
-from . import utils
+from . import io, utils
 from ._leaflet import (Circle, ColorizableTileLayer, Graticule, KeyBindingControl, LayersControl,
                        StatusBarControl, allowed_colormaps)
-from .pstools import compute_ps
+from .cache import DiskCache
+from .profiling import Profiler
+from .pstools import ComputationCancelled
+from .tools.compute_spectra import compute_patch
 
 
 # Generate default plotly colormap based on planck colormap
@@ -32,12 +39,9 @@ default_colorscale = generate_default_colorscale()
 out = widgets.Output()
 
 
-def _get_section(section, name):
-    # Python 3.8 if not value := section.get(name):
-    value = section.get(name)
-    if not value:
-        raise ValueError("Missing '{}' section".format(name))
-    return value
+def _print(*args):
+    # Print from the computation thread, where the output widget can not capture the output
+    out.append_stdout(" ".join(str(arg) for arg in args) + "\n")
 
 
 class App:
@@ -50,13 +54,20 @@ class App:
             with open(config, "r") as stream:
                 self.config = yaml.load(stream, Loader=yaml.FullLoader)
 
-        self.map_config = _get_section(self.config, "map")
-        self.data_config = _get_section(self.config, "data")
+        self.map_config = utils.get_section(self.config, "map")
+        self.data_config = utils.get_section(self.config, "data")
         self.plot_config = self.config.get("plot", {})
 
         self.m = None
         self.p = None
         self.patches = dict()
+        # Intermediate products of the last computed patch, indexed by patch id and method
+        self._states = dict()
+
+        # Background executor for spectra computation
+        self._executor = ThreadPoolExecutor(max_workers=1)
+        self._cancel = threading.Event()
+        self._future = None
 
         self.layers = [Graticule()]
         self._add_layers()
@@ -65,6 +76,9 @@ class App:
         self._add_plot()
         self._add_theory()
 
+        if self.plot_config.get("results_file"):
+            self.load_results(self.plot_config.get("results_file"))
+
     def show_map(self):
         if self.map_config.get("use_sidecar", True):
             from IPython.display import display
@@ -79,6 +93,50 @@ class App:
     def show_plot(self):
         return self.p
 
+    def load_results(self, file_name):
+        """Restore the patches and the results exported with the 'Export results' button
+
+        Patches are drawn back on the map and their results are shown in the plots. They are only
+        computed again if the computation options change. The spectra and covariances are read
+        from the file when they are displayed.
+
+        Parameters
+        ----------
+        file_name: string
+          the name of the HDF5 file holding the exported results
+        """
+        restored = {}
+        for name, patch in io.read_results(file_name, lazy=True).items():
+            if patch.get("geojson") is None:
+                print("Patch '{}' has no drawn shape and can not be restored".format(name))
+                continue
+            restored[name] = deepcopy(patch["geojson"])
+            restored[name].update({"results": None, "buffer": None})
+            for ps_method in ["master", "2dflat"]:
+                if ps_method in patch:
+                    restored[name][ps_method] = patch[ps_method]
+        print("Restore {} patches from '{}'".format(len(restored), file_name))
+
+        # Restored shapes replace the drawn shapes with the same id
+        shapes = [
+            shape
+            for shape in self.draw_control.data
+            if shape.get("properties", {}).get("style", {}).get("id") not in restored
+        ]
+        self.draw_control.data = shapes + [
+            {k: patch[k] for k in ["type", "geometry", "properties"]} for patch in restored.values()
+        ]
+        self.patches.update(restored)
+        self.clean_button.description = "Clean patches ({})".format(len(self.patches))
+
+        for ps_method in ["master", "2dflat"]:
+            for patch in self.patches.values():
+                results = patch.get(ps_method, dict()).get("results")
+                if results:
+                    self._show_results(ps_method, results)
+                    break
+        self._update_performance_plot()
+
     def _add_layers(self):
         layers = self.map_config.get("layers", {})
         tile_default = dict(
@@ -131,11 +189,15 @@ class App:
         self.draw_control.remove = True
 
         patches = self.patches
+        states = self._states
 
         def handle_draw(self, action, geo_json):
             patch_id = geo_json.get("properties", {}).get("style", {}).get("id", None)
             if not patch_id:
                 raise ValueError("Missing patch id from GeoJSON!")
+            # All the intermediate products depend on the patch geometry
+            for key in [key for key in list(states) if key[0] == patch_id]:
+                states.pop(key, None)
             if action in ["created", "edited"]:
                 patches[patch_id] = geo_json
                 patches[patch_id].update({"results": None, "buffer": None})
@@ -229,30 +291,18 @@ class App:
 
     def _add_compute(self):
         # Store original fits map
-        self.maps_info_list = list()
-        for imap in self.data_config.get("maps", []):
-            self.maps_info_list.append(
-                dict(
-                    id=_get_section(imap, "id"),
-                    name=_get_section(imap, "file"),
-                    data_type=imap.get("data_type", "IQU"),
-                    cal=imap.get("cal"),
-                )
+        self.maps_info_list = utils.get_maps_info(self.data_config)
+        self.masks_info_list = utils.get_masks_info(self.data_config)
+
+        # On-disk cache of mode coupling matrices
+        self.cache = None
+        cache_config = self.plot_config.get("cache")
+        if cache_config:
+            self.cache = DiskCache(
+                cache_config.get("directory", os.path.join("~", ".cache", "psplay")),
+                max_size=cache_config.get("max_size"),
             )
 
-        self.masks_info_list = dict()
-        for imask in self.data_config.get("masks", []):
-            mask_info = dict(name=_get_section(imask, "file"))
-            apodization = imask.get("apodization")
-            if apodization:
-                mask_info.update(
-                    dict(
-                        apo_type=apodization.get("type", "C1"),
-                        apo_radius=apodization.get("radius", 0.3),
-                    )
-                )
-            self.masks_info_list[_get_section(imask, "type")] = mask_info
-
     def _add_theory(self):
         self.theory = None
         theory = self.data_config.get("theory", {})
@@ -304,9 +354,10 @@ class App:
     def _add_plot(self):
         # Main
         self.tab = widgets.Tab()
-        self.tab.children = [self._add_1d_plot(), self._add_2d_plot()]
+        self.tab.children = [self._add_1d_plot(), self._add_2d_plot(), self._add_performance_plot()]
         self.tab.set_title(0, "1D power spectra")
         self.tab.set_title(1, "2D power spectra")
+        self.tab.set_title(2, "Performance")
 
         # General configuration
         layout = widgets.Layout(width="auto", height="auto")
@@ -349,6 +400,8 @@ class App:
         self.compute_button = widgets.Button(description="Compute spectra", icon="check")
         self.clean_button = widgets.Button(description="Clean patches", icon="trash-alt")
         self.export_button = widgets.Button(description="Export results", icon="download")
+        self.cancel_button = widgets.Button(description="Cancel", icon="stop", disabled=True)
+        self.progress = widgets.IntProgress(value=0, min=0, max=1, description="Progress")
 
         def _clean_patches(_):
             # Clean buffer if any
@@ -356,6 +409,7 @@ class App:
                 if "buffer" in patch and patch["buffer"] is not None:
                     self.m.remove_layer(patch["buffer"])
             self.patches.clear()
+            self._states.clear()
             self.draw_control.clear()
             self.clean_button.description = "Clean patches ({})".format(len(self.patches))
 
@@ -364,23 +418,43 @@ class App:
             timestamp = time.strftime("%Y%m%d_%H%M%S")
             export_file = os.path.join(
                 self.plot_config.get("export_directory", "/tmp"),
-                "psplay_results_{}.pkl".format(timestamp),
+                "psplay_results_{}.h5".format(timestamp),
             )
-            # Remove buffer primitives
-            for patch in self.patches.values():
-                if "buffer" in patch:
-                    del patch["buffer"]
-            pickle.dump(self.patches, open(export_file, "wb"))
+            # Only keep the drawn shapes and the results, without buffer primitives and
+            # intermediate products
+            patches = {}
+            for name, patch in self.patches.items():
+                patches[name] = dict(
+                    patch=utils.build_patch_geometry(patch),
+                    geojson={k: patch[k] for k in ["type", "geometry", "properties"] if k in patch},
+                )
+                for ps_method in ["master", "2dflat"]:
+                    if ps_method in patch:
+                        patches[name][ps_method] = patch[ps_method]
+            io.write_results(export_file, patches)
             print("Results exported in '{}'".format(export_file))
 
+        def _cancel_compute(_):
+            self._cancel.set()
+            self.cancel_button.disabled = True
+
         self.compute_button.on_click(self._compute_spectra)
         self.clean_button.on_click(_clean_patches)
         self.export_button.on_click(_export_results)
+        self.cancel_button.on_click(_cancel_compute)
         self.p = widgets.VBox(
             [
                 self.tab,
                 accordion,
-                widgets.HBox([self.clean_button, self.export_button, self.compute_button]),
+                widgets.HBox(
+                    [
+                        self.clean_button,
+                        self.export_button,
+                        self.compute_button,
+                        self.cancel_button,
+                        self.progress,
+                    ]
+                ),
             ]
         )
 
@@ -520,103 +594,250 @@ class App:
     @out.capture()
     def _compute_spectra(self, _):
         out.clear_output()
-        spectra = None
 
         self.compute_button.description = "Running..."
         self.compute_button.icon = "gear"
         self.compute_button.disabled = True
         self.clean_button.disabled = True
         self.export_button.disabled = True
+        self.cancel_button.disabled = False
         self.clean_button.description = "Clean patches ({})".format(len(self.patches))
 
-        for ps_method, compute in zip(
-            ["master", "2dflat"], [self.compute_1d.value, self.compute_2d.value]
-        ):
-            if not compute:
-                continue
-            for name, patch in self.patches.items():
-                print("Compute {} for '{}' method".format(name, ps_method))
-
-                kwargs = dict(
-                    ps_method=ps_method,
-                    lmax=self.lmax.value,
-                )
-                if ps_method == "master":
-                    kwargs.update(
-                        dict(
-                            error_method="master",
-                            binning_file=self.data_config.get("binning_file"),
-                            bin_size=self.bin_size.value,
-                            beam_file=self.data_config.get("beam_file"),
-                            source_mask=self.masks_info_list.get("source"),
-                            galactic_mask=self.masks_info_list.get("galactic"),
-                            compute_T_only=self.compute_T_only.value,
-                            l_exact=800 if self.use_toeplitz.value else None,
-                            l_band=2000 if self.use_toeplitz.value else None,
-                            l_toep=2500 if self.use_toeplitz.value else None,
-                        )
-                    )
-                    if self.use_kspace_filter.value:
-                        filter_config = self.data_config.get("filter")
-                        kwargs.update(
-                            dict(
-                                vk_mask=filter_config.get("vk_mask"),
-                                hk_mask=filter_config.get("hk_mask"),
-                                transfer_function=filter_config.get("transfer_function"),
-                            )
+        # Computation runs in a background thread to keep the map and the plots responsive
+        self._cancel.clear()
+        self._future = self._executor.submit(self._run_compute)
+
+    def _run_compute(self):
+        try:
+            self._compute_patches()
+        except Exception as e:
+            _print("An error occured during computation of power spectra : ", str(e))
+        finally:
+            self.compute_button.description = "Compute spectra"
+            self.compute_button.icon = "check"
+            self.compute_button.disabled = False
+            self.clean_button.disabled = False
+            self.export_button.disabled = False
+            self.cancel_button.disabled = True
+
+    def _compute_patches(self):
+        # Patches may be drawn while computing so work on a snapshot
+        patches = list(self.patches.items())
+        tasks = [
+            (ps_method, name, patch)
+            for ps_method, compute in zip(
+                ["master", "2dflat"], [self.compute_1d.value, self.compute_2d.value]
+            )
+            if compute
+            for name, patch in patches
+        ]
+        self.progress.max = max(len(tasks), 1)
+        self.progress.value = 0
+
+        pending = []
+        for ps_method, name, patch in tasks:
+            patch_dict = utils.build_patch_geometry(patch)
+            kwargs = utils.get_compute_kwargs(
+                self.data_config,
+                self.masks_info_list,
+                ps_method=ps_method,
+                lmax=self.lmax.value,
+                bin_size=self.bin_size.value,
+                compute_T_only=self.compute_T_only.value,
+                use_toeplitz=self.use_toeplitz.value,
+                use_kspace_filter=self.use_kspace_filter.value,
+                toeplitz=self.plot_config.get("toeplitz"),
+                patch=patch_dict,
+            )
+            method = patch.get(ps_method, dict())
+            if method.get("results") and method.get("config") == kwargs:
+                _print("Patch {} already processed under the same condition".format(name))
+                self._show_results(ps_method, method.get("results"))
+                self.progress.value += 1
+            else:
+                pending.append((ps_method, name, patch, patch_dict, kwargs))
+
+        # Workers are spawned since forking this multi-threaded process may deadlock them
+        n_workers = self.plot_config.get("n_workers")
+        executor = None
+        if n_workers is not None and n_workers > 1:
+            executor = ProcessPoolExecutor(
+                max_workers=n_workers, mp_context=multiprocessing.get_context("spawn")
+            )
+        try:
+            if executor is not None and len(pending) > 1:
+                # Whole patches are computed by the workers, as with psplay-compute
+                self._compute_pool(pending, executor)
+            else:
+                # A single patch has its splits transformed by the workers
+                for ps_method, name, patch, patch_dict, kwargs in pending:
+                    if self._cancel.is_set():
+                        break
+                    # Only the intermediate products of the last computed patch are kept, previous
+                    # ones are released before the computation
+                    state = self._states.pop((name, ps_method), {})
+                    self._states.clear()
+                    self._states[name, ps_method] = state
+                    try:
+                        method = compute_patch(
+                            name,
+                            patch_dict,
+                            self.maps_info_list,
+                            kwargs,
+                            self.cache,
+                            profile=self.plot_config.get("profile"),
+                            write=out.append_stdout,
+                            use_memmap=self.data_config.get("use_memmap", False),
+                            n_workers=n_workers,
+                            executor=executor,
+                            state=state,
+                            cancel=self._cancel,
                         )
+                    except ComputationCancelled:
+                        break
+                    self._store_results(ps_method, name, patch, kwargs, method)
+        finally:
+            if executor is not None:
+                # Tasks not started yet are dropped on cancel
+                executor.shutdown(cancel_futures=self._cancel.is_set())
+        if self._cancel.is_set():
+            _print("Computation cancelled")
+
+    def _compute_pool(self, pending, executor):
+        # The cancel event is shared with the workers through a manager process
+        with multiprocessing.get_context("spawn").Manager() as manager:
+            cancel = manager.Event()
+            futures = {
+                executor.submit(
+                    compute_patch,
+                    name,
+                    patch_dict,
+                    self.maps_info_list,
+                    kwargs,
+                    self.cache,
+                    profile=self.plot_config.get("profile"),
+                    use_memmap=self.data_config.get("use_memmap", False),
+                    cancel=cancel,
+                ): (ps_method, name, patch, kwargs)
+                for ps_method, name, patch, patch_dict, kwargs in pending
+            }
+            not_done = set(futures)
+            while not_done:
+                done, not_done = wait(not_done, timeout=0.2, return_when=FIRST_COMPLETED)
+                if self._cancel.is_set():
+                    cancel.set()
+                    for future in not_done:
+                        future.cancel()
+                for future in done:
+                    ps_method, name, patch, kwargs = futures[future]
+                    try:
+                        method = future.result()
+                    except (CancelledError, ComputationCancelled):
+                        continue
+                    except Exception as e:
+                        # The worker itself failed, e.g. it was killed
+                        method = dict(results=None, error="{}: {}".format(type(e).__name__, e))
+                    self._store_results(ps_method, name, patch, kwargs, method)
+
+    def _store_results(self, ps_method, name, patch, kwargs, method):
+        self.progress.value += 1
+        if method.get("error"):
+            _print("An error occured during computation of {} : {}".format(name, method["error"]))
+            return
+        _print("Patch {} computed for '{}' method".format(name, ps_method))
+        patch[ps_method] = dict(method, config=kwargs)
+
+        # Stream results into the plots as soon as the patch is done
+        self._show_results(ps_method, method.get("results"))
+        self._update_performance_plot()
+
+    def _show_results(self, ps_method, results):
+        spectra, spec_name_list = results.get("spectra"), results.get("spec_name_list")
+        if ps_method == "master":
+            dropdowns, options = [self.spectra_1d, self.split_1d], [spectra, spec_name_list]
+            update = self._update_1d_plot
+        if ps_method == "2dflat":
+            dropdowns = [self.spectra_2d, self.split_2d, self.patch_2d]
+            options = [spectra, spec_name_list, list(self.patches.keys())]
+            update = self._update_2d_plot
+
+        # Do not trigger plot updates while changing the dropdown options
+        for dropdown, option in zip(dropdowns, options):
+            try:
+                dropdown.unobserve(update, names="value")
+            except ValueError:
+                # Not observed yet
+                pass
+            if list(dropdown.options) != list(option):
+                dropdown.options = option
+            if dropdown.value is None and option:
+                dropdown.value = option[0]
+        update(None, create=True)
+        for dropdown in dropdowns:
+            dropdown.observe(update, names="value")
+
+    def _add_performance_plot(self):
+        plotly_config = self.plot_config.get("plotly", dict())
+
+        self.fig_perf = go.FigureWidget(
+            layout=go.Layout(
+                height=400,
+                template=plotly_config.get("template", "plotly_white"),
+                barmode="stack",
+                xaxis=dict(title="wall time [s]"),
+            )
+        )
+        self.perf_table = widgets.HTML()
+        self.perf_report = widgets.HTML()
+        return widgets.VBox([self.fig_perf, self.perf_table, self.perf_report])
 
+    def _update_performance_plot(self):
+        # Sum stage timings for each patch and method
+        rows, summaries, reports = [], [], []
+        for name, patch in self.patches.items():
+            for ps_method in ["master", "2dflat"]:
                 method = patch.get(ps_method, dict())
-                if method.get("results") and method.get("config") == kwargs:
-                    print("Patch already processed under the same condition")
-                    spectra, spec_name_list, lb, ps_dict, cov_dict = method.get("results").values()
+                if not method.get("performance"):
                     continue
-
-                try:
-                    patch_dict = utils.build_patch_geometry(patch)
-                    spectra, spec_name_list, lb, ps_dict, cov_dict = compute_ps(
-                        patch=patch_dict, maps_info_list=self.maps_info_list, **kwargs
-                    )
-                    method.update(
-                        dict(
-                            config=kwargs,
-                            results={
-                                "spectra": spectra,
-                                "spec_name_list": spec_name_list,
-                                "lb": lb,
-                                "ps": ps_dict,
-                                "cov": cov_dict,
-                            },
-                        )
+                row = "{} ({})".format(name, ps_method)
+                profiler = Profiler(verbose=False)
+                profiler.extend(method.get("performance"))
+                rows += [row]
+                summaries += [profiler.summary()]
+                if method.get("profile_report"):
+                    report = html.escape(method.get("profile_report"))
+                    reports += ["<b>{}</b><pre>{}</pre>".format(row, report)]
+
+        stages = []
+        for summary in summaries:
+            stages += [stage for stage in summary if stage not in stages]
+
+        with self.fig_perf.batch_update():
+            self.fig_perf.data = []
+            for stage in stages:
+                wall_times = [summary.get(stage, {}).get("wall_time", 0) for summary in summaries]
+                self.fig_perf.add_bar(name=stage, x=wall_times, y=rows, orientation="h")
+
+        header = "".join(
+            "<th>{}</th>".format(col)
+            for col in ["patch", "stage", "count", "wall time [s]", "CPU time [s]", "peak RSS [MB]"]
+        )
+        lines = []
+        for row, summary in zip(rows, summaries):
+            for stage, total in summary.items():
+                lines += [
+                    "<tr><td>{}</td><td>{}</td><td>{}</td><td>{:.2f}</td><td>{:.2f}</td>"
+                    "<td>{:.0f}</td></tr>".format(
+                        row,
+                        stage,
+                        total["count"],
+                        total["wall_time"],
+                        total["cpu_time"],
+                        total["peak_rss"] / 1024 ** 2,
                     )
-                    patch.update({ps_method: method})
-                except Exception as e:
-                    print("An error occured during computation of power spectra : ", str(e))
-
-            if spectra is not None:
-                if ps_method == "master":
-                    self.spectra_1d.options = spectra
-                    self.split_1d.options = spec_name_list
-                if ps_method == "2dflat":
-                    self.spectra_2d.options = spectra
-                    self.split_2d.options = spec_name_list
-
-        if spectra is not None:
-            self.spectra_1d.observe(self._update_1d_plot, names="value")
-            self.split_1d.observe(self._update_1d_plot, names="value")
-            self.spectra_2d.observe(self._update_2d_plot, names="value")
-            self.split_2d.observe(self._update_2d_plot, names="value")
-            self.patch_2d.options = self.patches.keys()
-            self.patch_2d.observe(self._update_2d_plot, names="value")
-
-            self._update_1d_plot(None, create=True)
-            self._update_2d_plot(None, create=True)
-
-        self.compute_button.description = "Compute spectra"
-        self.compute_button.icon = "check"
-        self.compute_button.disabled = False
-        self.clean_button.disabled = False
-        self.export_button.disabled = False
+                ]
+        self.perf_table.value = "<table><tr>{}</tr>{}</table>".format(header, "".join(lines))
+        self.perf_report.value = "".join(reports)
 
     def _update_1d_plot(self, _, create=False):
         split_name = self.split_1d.value
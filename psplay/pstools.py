@@ -1,26 +1,341 @@
 import os
-import time
-from copy import deepcopy
+import tempfile
+from collections import deque
+from concurrent.futures import Future, ProcessPoolExecutor
+from copy import copy, deepcopy
 
 import numpy as np
-from pixell import enmap
-from pspy import flat_tools, pspy_utils, so_cov, so_map, so_mcm, so_spectra, so_window, sph_tools
-from scipy.ndimage.morphology import distance_transform_edt
+from astropy.io import fits
+from pixell import enmap, fft
+from pspy import flat_tools, pspy_utils, so_cov, so_map, so_mcm, so_window, sph_tools
+from scipy.linalg import block_diag
 
+from .cache import MemoryCache, TieredCache, hash_file, hash_items, hash_window
+from .profiling import Profiler, get_profiler, submit_profiled
 
-class Timer:
-    def __init__(self):
-        self.t0 = None
 
-    def start(self, prefix="Starting..."):
-        self.t0 = time.time()
-        print(prefix, end=" ")
+# In-memory cache shared by all the computations of the session
+memory_cache = MemoryCache(max_size="1 GB")
 
-    def stop(self, prefix="done"):
-        print("{} in {:.2f} s".format(prefix, time.time() - self.t0))
+# Parsed text files indexed by their absolute path
+_text_files = {}
 
 
-timer = Timer()
+def load_text_file(file_name):
+    """Return the content of a text data file as an array
+
+    Files are parsed once and kept in memory, they are only read again when their modification
+    time or size changes. The returned array is read-only.
+    """
+    path = os.path.abspath(file_name)
+    stat = os.stat(path)
+    signature = (stat.st_mtime_ns, stat.st_size)
+    entry = _text_files.get(path)
+    if entry is None or entry[0] != signature:
+        data = np.loadtxt(path)
+        data.setflags(write=False)
+        entry = _text_files[path] = (signature, data)
+    return entry[1]
+
+
+class AuxiliaryData:
+    """The binning, the beam and the transfer function used by a spectra computation
+
+    Files are parsed once (see ``load_text_file``) and the resulting arrays are passed through the
+    different computation steps.
+
+    Parameters
+    ----------
+    lmax: integer
+      the maximum multipole to consider for the spectra computation
+    binning_file: text file
+      a binning file with three columns bin low, bin high, bin mean
+    beam_file: text file
+      file describing the beam of the map, expect l,bl
+    transfer_function: str
+      the path to the transfer function, expect the transfer function to be the third column
+    """
+
+    def __init__(self, lmax, binning_file=None, beam_file=None, transfer_function=None):
+        self.lmax = lmax
+        self.binning_file = binning_file
+        self.beam_file = beam_file
+        self.transfer_function_file = transfer_function
+
+        self.binning = None
+        if binning_file is not None:
+            # Same as pspy_utils.read_binning_file
+            bin_lo, bin_hi, bin_c = load_text_file(binning_file).T
+            keep = bin_hi < lmax
+            bin_lo, bin_hi, bin_c = bin_lo[keep], bin_hi[keep], bin_c[keep]
+            bin_lo[0] = max(bin_lo[0], 2)
+            bin_lo, bin_hi = bin_lo.astype(int), bin_hi.astype(int)
+            self.binning = bin_lo, bin_hi, bin_c, bin_hi - bin_lo + 1
+
+        self.beam = None
+        if beam_file is not None:
+            self.beam = load_text_file(beam_file)
+
+        self.transfer_function = None
+        if transfer_function is not None:
+            self.transfer_function = load_text_file(transfer_function)[:, 2]
+
+
+def _read_memmap_cutout(name, car_box):
+    # Only uncompressed and unscaled primary image HDU can be sliced without reading the full map
+    with fits.open(name, memmap=True) as hdul:
+        hdu = hdul[0]
+        header = hdu.header
+        if not isinstance(hdu, fits.PrimaryHDU) or header.get("NAXIS", 0) < 2:
+            return None
+        if header.get("BSCALE", 1) != 1 or header.get("BZERO", 0) != 0 or "BLANK" in header:
+            return None
+
+        shape, wcs = enmap.read_fits_geometry(name)
+        box = np.array(car_box) * np.pi / 180
+        ibox = enmap.subinds(shape, wcs, box, cap=False)
+
+        # Same pixel selection as pixell.enmap.submap
+        sel, flips = [], []
+        for n, (start, stop, step) in zip(shape[-2:], ibox.T):
+            if abs(step) != 1:
+                return None
+            if step < 0:
+                start, stop = stop + 1, start + 1
+            if start < 0 or stop > n:
+                # Boxes crossing the map edges are left to pixell
+                return None
+            sel.append(slice(start, stop))
+            flips.append(step < 0)
+
+        # Slicing a ndmap keeps the view on the memory-mapped data and updates the WCS, the
+        # cutout is copied before the file is closed
+        data = enmap.ndmap(hdu.data, wcs)[(Ellipsis,) + tuple(sel)]
+        if flips[0]:
+            data = data[..., ::-1, :]
+        if flips[1]:
+            data = data[..., :, ::-1]
+        data = data.copy()
+
+    cutout = so_map.so_map()
+    cutout.pixel = header["CTYPE1"][-3:]
+    cutout.ncomp = header.get("NAXIS3", 1)
+    cutout.data = data
+    cutout.coordinate = "equ" if header.get("RADESYS") == "ICRS" else header.get("RADESYS")
+    return cutout
+
+
+def read_cutout(name, car_box, use_memmap=False):
+    """Read the part of a CAR map inside car_box
+
+    Parameters
+    ----------
+    name: fits file
+      the name of the CAR map
+    car_box: 2x2 array
+      an array of the form [[dec0,rac0],[dec1,ra1]] in degrees
+    use_memmap: boolean
+      memory-map the FITS file and only copy the rows and columns covering the box. Compressed
+      or scaled images and boxes crossing the map edges are read the usual way.
+    """
+    if use_memmap:
+        cutout = _read_memmap_cutout(name, car_box)
+        if cutout is not None:
+            return cutout
+    return so_map.read_map(name, car_box=car_box)
+
+
+def default_binning_file(bin_size):
+    """Return a binning file with bins of constant size, written once in the temporary directory
+
+    The file is first written under a unique name and then renamed so that concurrent
+    computations (e.g. the workers of psplay-compute or MPI processes) never read a partially
+    written file.
+
+    Parameters
+    ----------
+    bin_size: integer
+      the size of the bins
+    """
+    file_name = os.path.join(tempfile.gettempdir(), "psplay_binning_{}.dat".format(bin_size))
+    if not os.path.exists(file_name):
+        fd, tmp_name = tempfile.mkstemp(dir=os.path.dirname(file_name), suffix=".dat")
+        os.close(fd)
+        try:
+            pspy_utils.create_binning_file(bin_size=bin_size, n_bins=1000, file_name=tmp_name)
+            os.replace(tmp_name, file_name)
+        except Exception:
+            os.remove(tmp_name)
+            raise
+    return file_name
+
+
+def pyramid_file(name, factor):
+    """Return the name of the map file downgraded by factor, as written by car2pyramid"""
+    root, ext = os.path.splitext(name)
+    return "{}_down{}{}".format(root, factor, ext)
+
+
+def select_pyramid_level(file_names, lmax, safety_margin=2.0):
+    """Return the largest downgrade factor of the map pyramid supporting lmax for all the files
+
+    A level is used if it exists for all the files, if it is newer than the original files and
+    if lmax+50 is lower than the maximal multipole of its pixellisation (see
+    so_map.get_lmax_limit) divided by the safety margin. Downgraded maps are averaged over blocks
+    of pixels, the extra pixel window of the averaging is deconvolved from the split maps (see
+    unapply_downgrade_window). The remaining bias comes from the power above the Nyquist
+    frequency of the downgraded pixels aliased below it: with the default safety margin, it stays
+    at the percent level close to lmax for red spectra such as the CMB but it can reach 20% for
+    white noise dominated maps.
+
+    Parameters
+    ----------
+    file_names: list of fits files
+      the original maps and masks
+    lmax: integer
+      the maximum multipole to consider for the spectra computation
+    safety_margin: float
+      the ratio between the maximal multipole of the pixellisation and lmax+50
+
+    Return
+    ----------
+    The downgrade factor, 1 meaning that the original files should be used
+    """
+    best, factor = 1, 2
+    while True:
+        names = [pyramid_file(name, factor) for name in file_names]
+        if not all(os.path.exists(name) for name in names):
+            break
+        if any(os.path.getmtime(n) < os.path.getmtime(o) for n, o in zip(names, file_names)):
+            break
+        cdelt = max(abs(enmap.read_fits_geometry(name)[1].wcs.cdelt[1]) for name in names)
+        if lmax + 50 > 360 / cdelt / 4 / safety_margin:
+            break
+        best, factor = factor, 2 * factor
+    return best
+
+
+def unapply_downgrade_window(imap, factor):
+    """Deconvolve the pixel window of the block averaging of a downgraded map
+
+    Averaging blocks of factor x factor pixels multiplies the Fourier modes of the map by the
+    ratio of the pixel windows of the downgraded and original pixels. This ratio is divided out
+    along both axes so that the downgraded map keeps the pixel window of the original one. The
+    map being a non-periodic cutout, the deconvolution is applied to its mirror extension, which
+    is periodic and continuous at the edges, so that the edges do not ring.
+
+    Parameters
+    ----------
+    imap: ndmap
+      the downgraded map
+    factor: integer
+      the downgrade factor
+    """
+    ny, nx = imap.shape[-2:]
+    pad = [(0, 0)] * (imap.ndim - 2) + [(0, ny), (0, nx)]
+    extended = enmap.enmap(np.pad(imap, pad, mode="symmetric"), imap.wcs)
+    wy, wx = enmap.calc_window(extended.shape)
+    wy_orig, wx_orig = enmap.calc_window(extended.shape, scale=factor)
+    fmap = enmap.fft(extended)
+    fmap *= (wy_orig / wy)[:, None]
+    fmap *= (wx_orig / wx)[None, :]
+    return enmap.enmap(enmap.ifft(fmap).real[..., :ny, :nx], imap.wcs)
+
+
+class MapCutouts:
+    """Hold the cutouts of the split maps so that each of them is only read once per patch
+
+    Cutouts are shared between the window creation and the spectra computation. Calling
+    ``release`` (or ``clear``) drops the reference to the underlying data.
+
+    Parameters
+    ----------
+    use_memmap: boolean
+      read cutouts through memory-mapped FITS files (see ``read_cutout``)
+    """
+
+    def __init__(self, use_memmap=False):
+        self.use_memmap = use_memmap
+        self._cutouts = {}
+
+    def get(self, name, car_box):
+        """Return the ``so_map`` cutout of the map file inside car_box, reading it if needed"""
+        key = (name, str(car_box))
+        if key not in self._cutouts:
+            self._cutouts[key] = read_cutout(name, car_box, use_memmap=self.use_memmap)
+        return self._cutouts[key]
+
+    def release(self, name, car_box):
+        """Return the cutout and remove it from the provider"""
+        cutout = self.get(name, car_box)
+        del self._cutouts[(name, str(car_box))]
+        return cutout
+
+    def clear(self):
+        self._cutouts.clear()
+
+
+def _window_template(cutouts, map_info, car_box):
+    # Single component copy of the split cutout, the cutout itself is left untouched
+    window = copy(cutouts.get(map_info["name"], car_box))
+    if map_info["data_type"] == "IQU":
+        window.data = window.data[0].copy()
+        window.ncomp = 1
+    else:
+        window.data = window.data.copy()
+    return window
+
+
+def disk_mask(shape, wcs, center, radius):
+    """Return a mask equal to 1 within the given distance of a point and 0 elsewhere
+
+    The angular distance is computed exactly on the sphere from the pixel coordinates of the CAR
+    geometry, using the haversine formula on the per-row declinations and per-column right
+    ascensions.
+
+    Parameters
+    ----------
+    shape: tuple
+      the shape of the map
+    wcs: astropy.wcs.WCS
+      the wcs of the map
+    center: tuple
+      the (dec, ra) coordinates of the disk center in degrees
+    radius: float
+      the radius of the disk in degrees
+    """
+    dec_c, ra_c = np.deg2rad(center)
+    dec, ra = enmap.posaxes(shape, wcs)
+
+    # hav(d) = hav(ddec) + cos(dec) cos(dec_c) hav(dra) with hav(x) = sin(x/2)**2
+    hav_dec = np.sin((dec - dec_c) / 2) ** 2
+    hav_ra = np.sin((ra - ra_c) / 2) ** 2
+    hav_dist = hav_dec[:, None] + (np.cos(dec) * np.cos(dec_c))[:, None] * hav_ra[None, :]
+    return (hav_dist < np.sin(np.deg2rad(radius) / 2) ** 2).astype(float)
+
+
+def disk_box(center, radius, eps=0.1):
+    """Return the CAR box enclosing a disk
+
+    The half-width of the disk in right ascension is arcsin(sin(radius) / cos(dec)), which is at
+    least radius / cos(dec), and the disk spans the whole right ascension range when it contains a
+    pole.
+
+    Parameters
+    ----------
+    center: tuple
+      the (dec, ra) coordinates of the disk center in degrees
+    radius: float
+      the radius of the disk in degrees
+    eps: float
+      the margin added around the disk in degrees
+    """
+    dec_c, ra_c = center
+    sin_radius, cos_dec = np.sin(np.deg2rad(radius)), np.cos(np.deg2rad(dec_c))
+    ra_width = 180.0
+    if sin_radius < cos_dec:
+        ra_width = min(np.rad2deg(np.arcsin(sin_radius / cos_dec)) + eps, 180.0)
+    return [[dec_c - radius - eps, ra_c - ra_width], [dec_c + radius + eps, ra_c + ra_width]]
 
 
 def create_window(
@@ -33,6 +348,7 @@ def create_window(
     compute_T_only=False,
     use_rmax=True,
     use_kspace_filter=False,
+    cutouts=None,
 ):
     """Create a window function for a patch
 
@@ -49,7 +365,7 @@ def create_window(
     apo_radius_survey: float
       the apodisation radius in degree (default: 1 degree)
     res_arcmin: float
-      the angular resolution of the map in arcminutes (default: 0.5 arcminutes)
+      not in use anymore, distances to the disk center are computed from the map geometry
     source_mask: dict
       a dict containing an optional source mask and its properties
       the dictionnary should contain the name, the type of apodisation and the radius of apodisation
@@ -61,15 +377,16 @@ def create_window(
       apply apodization up to the apodization radius
     use_kspace_filter: boolean
       create a binary mask to be only used when applying kspace filter to maps
+    cutouts: MapCutouts
+      an optional provider of split cutouts to be shared with the spectra computation
     """
-    timer.start("Create window...")
+    get_profiler().start_stage("window", "Create window...")
+
+    cutouts = cutouts or MapCutouts()
 
     if patch["patch_type"] == "Rectangle":
         car_box = patch["patch_coordinate"]
-        window = so_map.read_map(maps_info_list[0]["name"], car_box=car_box)
-        if maps_info_list[0]["data_type"] == "IQU":
-            window.data = window.data[0]
-            window.ncomp = 1
+        window = _window_template(cutouts, maps_info_list[0], car_box)
         window.data[:] = 0
         window.data[1:-1, 1:-1] = 1
         apo_type_survey = "C1"
@@ -77,43 +394,28 @@ def create_window(
     elif patch["patch_type"] == "Disk":
         dec_c, ra_c = patch["center"]
         radius = patch["radius"]
-        eps = 0.1
-        car_box = [
-            [dec_c - radius - eps, ra_c - radius - eps],
-            [dec_c + radius + eps, ra_c + radius + eps],
-        ]
-        window = so_map.read_map(maps_info_list[0]["name"], car_box=car_box)
-        if maps_info_list[0]["data_type"] == "IQU":
-            window.data = window.data[0]
-            window.ncomp = 1
-
-        window.data[:] = 1
-        y_c, x_c = enmap.sky2pix(
-            window.data.shape, window.data.wcs, [dec_c * np.pi / 180, ra_c * np.pi / 180]
-        )
-        window.data[int(y_c), int(x_c)] = 0
-        dist = distance_transform_edt(window.data) * res_arcmin * 1 / 60
-        window.data[dist < radius] = 0
-        window.data = 1 - window.data
+        car_box = disk_box((dec_c, ra_c), radius)
+        window = _window_template(cutouts, maps_info_list[0], car_box)
+        window.data[:] = disk_mask(window.data.shape, window.data.wcs, (dec_c, ra_c), radius)
         apo_type_survey = "C1"
 
     if galactic_mask is not None:
-        gal_mask = so_map.read_map(galactic_mask["name"], car_box=car_box)
+        gal_mask = read_cutout(galactic_mask["name"], car_box, use_memmap=cutouts.use_memmap)
         window.data *= gal_mask.data
         del gal_mask
 
     for map_info in maps_info_list:
-        split = so_map.read_map(map_info["name"], car_box=car_box)
+        split = cutouts.get(map_info["name"], car_box)
+        data = split.data
         if compute_T_only and map_info["data_type"] == "IQU":
-            split.data = split.data[0]
-            split.ncomp = 1
+            data = data[0]
 
-        if split.ncomp == 1:
-            window.data[split.data == 0] = 0.0
+        if data.ndim == 2:
+            window.data[data == 0] = 0.0
 
         else:
-            for i in range(split.ncomp):
-                window.data[split.data[i] == 0] = 0.0
+            for i in range(data.shape[0]):
+                window.data[data[i] == 0] = 0.0
 
     # Binary mask for kspace filter
     binary = window.copy() if use_kspace_filter else None
@@ -123,7 +425,7 @@ def create_window(
     )
 
     if source_mask is not None:
-        ps_mask = so_map.read_map(source_mask["name"], car_box=car_box)
+        ps_mask = read_cutout(source_mask["name"], car_box, use_memmap=cutouts.use_memmap)
         if use_kspace_filter:
             binary.data *= ps_mask.data
         ps_mask = so_window.create_apodization(
@@ -132,7 +434,7 @@ def create_window(
         window.data *= ps_mask.data
         del ps_mask
 
-    timer.stop()
+    get_profiler().stop_stage()
     return car_box, window, binary
 
 
@@ -147,6 +449,9 @@ def compute_mode_coupling(
     l_band=None,
     l_toep=None,
     compute_T_only=False,
+    cache=None,
+    aux=None,
+    executor=None,
 ):
     """Compute the mode coupling corresponding the the window function
 
@@ -170,70 +475,335 @@ def compute_mode_coupling(
     save_coupling: str
     compute_T_only: boolean
         True to compute only T spectra
+    cache: MemoryCache, DiskCache or TieredCache
+        an optional cache where to look for (and to store) the inverse mode coupling matrix. Since
+        windows are identified up to a translation in right ascension, patches of the same shape
+        within the same declination band share their mode coupling matrix. The unbinned coupling
+        is also stored so that a change of binning or beam only bins it again
+    aux: AuxiliaryData
+        the already parsed binning and beam, read from binning_file and beam_file if not provided
+    executor: concurrent.futures.Executor
+        an optional pool of workers where to compute the mode coupling. If it needs to be
+        computed, a future holding the inverse mode coupling matrix is returned
     """
 
     if ps_method == "2dflat":
         return None
 
-    timer.start("Compute MCM...")
+    if aux is None:
+        aux = AuxiliaryData(lmax, binning_file=binning_file, beam_file=beam_file)
 
-    bin_lo, bin_hi, bin_c, bin_size = pspy_utils.read_binning_file(binning_file, lmax)
-    n_bins = len(bin_hi)
+    if ps_method == "pseudo":
+        return _pseudo_mode_coupling(window, aux, compute_T_only)
 
+    # The unbinned coupling only depends on the window, the binning and the beam are applied to it
+    coupling_key = binned_key = None
+    if cache is not None:
+        coupling_key = hash_items(
+            "mcm_coupling", hash_window(window), lmax, l_exact, l_band, l_toep, compute_T_only
+        )
+        binned_key = hash_items(coupling_key, hash_file(binning_file), hash_file(beam_file), type)
+        mbb_inv = cache.get(binned_key)
+        if mbb_inv is not None:
+            get_profiler().log("Reuse cached MCM")
+            return mbb_inv
+
+    def _bin(coupling):
+        mbb_inv = bin_mode_coupling(coupling, type, lmax, aux=aux, compute_T_only=compute_T_only)
+        if cache is not None:
+            cache.set(coupling_key, coupling)
+            cache.set(binned_key, mbb_inv)
+        return mbb_inv
+
+    coupling = cache.get(coupling_key) if cache is not None else None
+    if coupling is not None:
+        get_profiler().log("Reuse cached mode coupling")
+        return _bin(coupling)
+
+    args = (window, lmax)
+    kwargs = dict(l_exact=l_exact, l_band=l_band, l_toep=l_toep, compute_T_only=compute_T_only)
+    if executor is not None:
+        # The coupling is binned and stored in the cache once it is back from the worker
+        return submit_profiled(executor, _compute_coupling, args, kwargs, then=_bin)
+    return _bin(_compute_coupling(*args, **kwargs))
+
+
+def _pseudo_mode_coupling(window, aux, compute_T_only):
+    # Pseudo spectra are only corrected for the sky fraction of the window
+    n_bins = len(aux.binning[1])
     fsky = enmap.area(window.data.shape, window.data.wcs) / 4.0 / np.pi
     fsky *= np.mean(window.data)
+    if compute_T_only:
+        return np.identity(n_bins) / fsky
+    mbb_inv = {}
+    for spin in ["spin0xspin0", "spin0xspin2", "spin2xspin0"]:
+        mbb_inv[spin] = np.identity(n_bins) / fsky
+    mbb_inv["spin2xspin2"] = np.identity(4 * n_bins) / fsky
+    return mbb_inv
 
-    beam = None
-    if beam_file is not None:
-        beam_data = np.loadtxt(beam_file)
-        if compute_T_only:
-            beam = beam_data[:, 1]
-        else:
-            beam = (beam_data[:, 1], beam_data[:, 1])
 
+def _compute_coupling(window, lmax, l_exact=None, l_band=None, l_toep=None, compute_T_only=False):
+    # Unbinned mode coupling of the multipoles 2 to lmax+1, before the beam is applied. pspy drops
+    # the last two multipoles of the coupling so it is computed up to lmax+2 with the same band
+    # limit of the window alms. As in pspy, the Toeplitz approximation is only used if l_toep is
+    # lower than lmax
+    get_profiler().start_stage("mcm", "Compute MCM...")
+    if l_toep is not None and l_toep >= lmax:
+        l_toep = lmax + 2
+    kwargs = dict(
+        lmax=lmax + 2,
+        niter=0,
+        l_exact=l_exact,
+        l_band=l_band,
+        l_toep=l_toep,
+        l3_pad=1998,
+        return_coupling_only=True,
+    )
     if compute_T_only:
-        if ps_method == "master":
-            mbb_inv, Bbl = so_mcm.mcm_and_bbl_spin0(
-                window,
-                binning_file,
-                bl1=beam,
-                lmax=lmax,
-                type=type,
-                niter=0,
-                l_exact=l_exact,
-                l_band=l_band,
-                l_toep=l_toep,
+        coupling = so_mcm.mcm_and_bbl_spin0(window, None, **kwargs)
+    else:
+        coupling = so_mcm.mcm_and_bbl_spin0and2((window, window), None, **kwargs)
+    get_profiler().stop_stage()
+    return coupling
+
+
+def bin_mode_coupling(
+    coupling, type, lmax, binning_file=None, beam_file=None, aux=None, compute_T_only=False
+):
+    """Apply the beam and the binning to the unbinned mode coupling and return its inverse
+
+    This is the binning step of ``so_mcm.mcm_and_bbl_spin0`` (or ``mcm_and_bbl_spin0and2``) so
+    that a mode coupling can be binned again when only the binning changes.
+
+    Parameters
+    ----------
+    coupling: array
+      the unbinned mode coupling of the multipoles 2 to lmax+1, with shape (lmax, lmax) or
+      (5, lmax, lmax) for spin 0 and 2 fields
+    type: string
+        the type of binning, either bin Cl or bin Dl
+    lmax : integer
+        the maximum multipole to consider for the spectra computation
+    binning_file: text file
+      a binning file with three columns bin low, bin high, bin mean
+    beam_file: text file
+        file describing the beam of the map, expect bl to be the second column and start at l=0
+    aux: AuxiliaryData
+        the already parsed binning and beam, read from binning_file and beam_file if not provided
+    compute_T_only: boolean
+        True to compute only T spectra
+    """
+    if type not in ["Dl", "Cl"]:
+        raise ValueError("Unknown 'type' value! Must be either 'Dl' or 'Cl'")
+    if aux is None:
+        aux = AuxiliaryData(lmax, binning_file=binning_file, beam_file=beam_file)
+
+    bin_lo, bin_hi, bin_c, bin_size = aux.binning
+    n_bins = len(bin_hi)
+    beam = aux.beam[2:, 1][:lmax] if aux.beam is not None else np.ones(lmax)
+    fac = (2 * np.arange(2, lmax + 2) + 1) / (4 * np.pi) * beam ** 2
+
+    def _bin(mcm):
+        mbb = np.zeros((n_bins, n_bins))
+        so_mcm.mcm_fortran.bin_mcm((mcm * fac).T, bin_lo, bin_hi, bin_size, mbb.T, type == "Dl")
+        return mbb
+
+    if compute_T_only:
+        return np.linalg.inv(_bin(coupling))
+
+    # Same layout of the spin blocks as so_mcm.mcm_and_bbl_spin0and2
+    mbb = [_bin(mcm) for mcm in coupling]
+    spin2xspin2 = np.kron(np.identity(4), mbb[3])
+    blocks = spin2xspin2.reshape(4, n_bins, 4, n_bins)
+    for (i, j), sign in zip([(2, 1), (1, 2), (3, 0), (0, 3)], [-1, -1, 1, 1]):
+        blocks[i, :, j, :] = sign * mbb[4]
+    mbb_inv = dict(spin0xspin0=mbb[0], spin0xspin2=mbb[1], spin2xspin0=mbb[2])
+    mbb_inv["spin2xspin2"] = spin2xspin2
+    return {spin: np.linalg.inv(m) for spin, m in mbb_inv.items()}
+
+
+def _toeplitz_grid(lmax):
+    # Choices spanning the multipole range, with l_exact < l_band <= l_toep
+    grid = []
+    for f_exact in [0.1, 0.2, 0.3]:
+        for f_band in [0.3, 0.5, 0.7]:
+            for f_toep in [0.5, 0.7, 0.9]:
+                if f_exact < f_band <= f_toep:
+                    grid.append((int(f_exact * lmax), int(f_band * lmax), int(f_toep * lmax)))
+    return grid
+
+
+def _max_error(approx, exact):
+    if isinstance(exact, dict):
+        return max(_max_error(approx[spin], exact[spin]) for spin in exact)
+    return np.max(np.abs(approx - exact)) / np.max(np.abs(exact))
+
+
+def tune_toeplitz(
+    window,
+    type,
+    lmax,
+    binning_file,
+    grid=None,
+    beam_file=None,
+    compute_T_only=False,
+    aux=None,
+):
+    """Compare the Toeplitz approximations of the mode coupling matrix to the exact computation
+
+    The harmonic transform of the window is done once and shared by the exact computation and by
+    all the approximations.
+
+    Parameters
+    ----------
+    window: so_map
+      the window function of the patch
+    type: string
+      the type of binning, either bin Cl or bin Dl
+    lmax: integer
+      the maximum multipole to consider for the spectra computation
+    binning_file: text file
+      a binning file with three columns bin low, bin high, bin mean
+    grid: list of tuples
+      the (l_exact, l_band, l_toep) choices to evaluate, a grid spanning the multipole range
+      if None
+    beam_file: text file
+      file describing the beam of the map, expect bl to be the second column and start at l=0
+    compute_T_only: boolean
+      True to compute only T spectra
+    aux: AuxiliaryData
+      the already parsed beam, read from beam_file if not provided
+
+    Return
+    ----------
+    A list of records, one per choice, holding l_exact, l_band and l_toep, the wall time of the
+    computation, the speed-up with respect to the exact computation and the maximal difference to
+    the exact inverse mode coupling matrix relative to its largest element. The first record
+    corresponds to the exact computation.
+    """
+    grid = grid if grid is not None else _toeplitz_grid(lmax)
+    for l_exact, l_band, l_toep in grid:
+        if not l_exact < l_band <= l_toep <= lmax:
+            raise ValueError(
+                "Toeplitz choice ({}, {}, {}) does not satisfy "
+                "l_exact < l_band <= l_toep <= lmax".format(l_exact, l_band, l_toep)
             )
 
-        elif ps_method == "pseudo":
-            mbb_inv = np.identity(n_bins)
-            mbb_inv *= 1 / fsky
+    if aux is None:
+        aux = AuxiliaryData(lmax, beam_file=beam_file)
+
+    profiler = get_profiler()
+    profiler.start_stage("sht", "Compute window alms...")
+    wlm = sph_tools.map2alm(window, niter=0, lmax=min(lmax + 2000, window.get_lmax_limit()))
+    profiler.stop_stage()
+
+    beam = aux.beam[:, 1] if aux.beam is not None else None
+    if compute_T_only:
+        mcm_and_bbl = so_mcm.mcm_and_bbl_spin0
     else:
-        window = (window, window)
-        if ps_method == "master":
-            mbb_inv, Bbl = so_mcm.mcm_and_bbl_spin0and2(
-                window,
-                binning_file,
-                bl1=beam,
-                lmax=lmax,
-                type=type,
-                niter=0,
+        mcm_and_bbl = so_mcm.mcm_and_bbl_spin0and2
+        wlm = (wlm, wlm)
+        beam = (beam, beam) if beam is not None else None
+
+    def _mcm(label, l_exact=None, l_band=None, l_toep=None):
+        profiler.start_stage("mcm", label)
+        mbb_inv, _ = mcm_and_bbl(
+            wlm,
+            binning_file,
+            bl1=beam,
+            lmax=lmax,
+            type=type,
+            niter=0,
+            input_alm=True,
+            l_exact=l_exact,
+            l_band=l_band,
+            l_toep=l_toep,
+        )
+        return mbb_inv, profiler.stop_stage()["wall_time"]
+
+    exact, exact_time = _mcm("Compute exact MCM...")
+    records = [
+        dict(l_exact=None, l_band=None, l_toep=None, wall_time=exact_time, speedup=1.0, max_error=0.0)
+    ]
+    for l_exact, l_band, l_toep in grid:
+        label = "Compute MCM with ({}, {}, {})...".format(l_exact, l_band, l_toep)
+        mbb_inv, wall_time = _mcm(label, l_exact=l_exact, l_band=l_band, l_toep=l_toep)
+        records.append(
+            dict(
                 l_exact=l_exact,
                 l_band=l_band,
                 l_toep=l_toep,
+                wall_time=wall_time,
+                speedup=exact_time / wall_time,
+                max_error=float(_max_error(mbb_inv, exact)),
             )
+        )
+    return records
 
-        elif ps_method == "pseudo":
-            mbb_inv = {}
-            spin_list = ["spin0xspin0", "spin0xspin2", "spin2xspin0"]
-            for spin in spin_list:
-                mbb_inv[spin] = np.identity(n_bins)
-                mbb_inv[spin] *= 1 / fsky
-            mbb_inv["spin2xspin2"] = np.identity(4 * n_bins)
-            mbb_inv["spin2xspin2"] *= 1 / fsky
 
-    timer.stop()
-    return mbb_inv
+def select_toeplitz(records, tolerance=1e-3):
+    """Return the fastest Toeplitz choice of ``tune_toeplitz`` records within the tolerance
+
+    Parameters
+    ----------
+    records: list of dict
+      the records returned by tune_toeplitz
+    tolerance: float
+      the maximal relative error allowed
+
+    Return
+    ----------
+    A dictionary holding l_exact, l_band and l_toep, which are all None if no approximation
+    meets the tolerance
+    """
+    valid = [r for r in records if r["max_error"] <= tolerance]
+    best = max(valid, key=lambda r: r["speedup"])
+    return dict(l_exact=best["l_exact"], l_band=best["l_band"], l_toep=best["l_toep"])
+
+
+class KspaceFilter:
+    """A filter removing the modes in a vertical and a horizontal band of the 2D Fourier space
+
+    The Fourier space mask is computed once for the patch geometry and the filter is applied in
+    place to all the splits, the real Fourier transforms being done at once over all the map
+    components. Note that maps are multiplied by a binary mask before filtering in order to remove
+    pathological pixels.
+
+    Parameters
+    ----------
+    binary: ``so_map``
+      a binary mask removing pathological pixels, it sets the patch geometry
+    vk_mask: list with 2 elements
+      format is fourier modes [-lx,+lx]
+    hk_mask: list with 2 elements
+      format is fourier modes [-ly,+ly]
+    normalize: boolean
+      normalize the Fourier transforms. If False, filtered maps are multiplied by the number of
+      pixels
+    """
+
+    def __init__(self, binary, vk_mask=None, hk_mask=None, normalize=True):
+        self.binary = binary.data
+        self.normalize = normalize
+        ly, lx = enmap.laxes(binary.data.shape, binary.data.wcs)
+        keep_x, keep_y = np.ones(lx.shape), np.ones(ly.shape)
+        if vk_mask is not None:
+            keep_x[(lx > vk_mask[0]) & (lx < vk_mask[1])] = 0.0
+        if hk_mask is not None:
+            keep_y[(ly > hk_mask[0]) & (ly < hk_mask[1])] = 0.0
+        mask = keep_y[:, None] * keep_x[None, :]
+        # Keeping the real part of the filtered map amounts to filtering with the mask averaged
+        # over the (ly, lx) and (-ly, -lx) modes, which is fully described by its lx >= 0 half
+        mask = 0.5 * (mask + np.roll(mask[::-1, ::-1], 1, axis=(0, 1)))
+        self.mask = mask[:, : lx.size // 2 + 1]
+
+    def apply(self, map):
+        """Filter the ``so_map`` in place and return it"""
+        map.data *= self.binary
+        ft = fft.rfft(map.data, axes=[-2, -1])
+        ft *= self.mask
+        map.data[:] = fft.irfft(ft, n=map.data.shape[-1], axes=[-2, -1], normalize=self.normalize)
+        return map
 
 
 def get_filtered_map(map, binary, vk_mask, hk_mask, normalize=False):
@@ -251,38 +821,300 @@ def get_filtered_map(map, binary, vk_mask, hk_mask, normalize=False):
         format is fourier modes [-lx,+lx]
     hk_mask: list with 2 elements
         format is fourier modes [-ly,+ly]
+
+    Use a KspaceFilter to filter several maps with the same geometry
+    """
+    return KspaceFilter(binary, vk_mask, hk_mask, normalize=normalize).apply(map)
+
+
+def _transform_split(
+    split, window, ps_method, lmax, cal=None, kspace_filter=None, downgrade_factor=1, label=""
+):
+    # Calibrate, filter and transform a split cutout
+    profiler = get_profiler()
+    if downgrade_factor > 1:
+        split.data = unapply_downgrade_window(split.data, downgrade_factor)
+    if cal is not None:
+        split.data *= cal
+
+    if kspace_filter is not None:
+        profiler.start_stage("filter", "Filter {} in the patch...".format(label))
+        split = kspace_filter.apply(split)
+        profiler.stop_stage()
+
+    if ps_method in ["master", "pseudo"]:
+        profiler.start_stage("sht", "SPHT of {} in the patch...".format(label))
+        ht = sph_tools.get_alms(split, window, niter=0, lmax=lmax + 50)
+        profiler.stop_stage()
+
+    elif ps_method == "2dflat":
+        profiler.start_stage("fft", "FFT of {} in the patch...".format(label))
+        ht = flat_tools.get_ffts(split, window, lmax)
+        profiler.stop_stage()
+
+    return ht
+
+
+def get_transforms(
+    window,
+    maps_info_list,
+    car_box,
+    lmax,
+    ps_method="master",
+    compute_T_only=False,
+    vk_mask=None,
+    hk_mask=None,
+    binary=None,
+    cutouts=None,
+    executor=None,
+    max_in_flight=None,
+    downgrade_factor=1,
+    cancel=None,
+):
+    """Compute the harmonic transforms (alms or 2D FFTs) of the split maps in the patch
+
+    Parameters
+    ----------
+    window: so_map
+        the window function of the patch
+    maps_info_list: list of dicts describing the data maps
+    car_box: 2x2 array
+      an array of the form [[dec0,rac0],[dec1,ra1]] it encompasses the patch
+    lmax : integer
+        the maximum multipole to consider for the spectra computation
+    ps_method: string
+      the method for the computation of the power spectrum
+      can be "master", "pseudo", or "2dflat" for now
+    compute_T_only: boolean
+        True to compute only T spectra
+    vk_mask: list
+      the vertical band to filter out from 2D FFT (format is [-lx, +lx])
+    hk_mask: list
+      the horizontal band to filter out from 2D FFT (format is [-ly, +ly])
+    binary: so_map
+      the binary mask to be used in the kspace filter process
+    cutouts: MapCutouts
+      an optional provider of split cutouts
+    executor: concurrent.futures.Executor
+      an optional pool of workers where to compute the transforms
+    max_in_flight: integer
+      the maximal number of split cutouts sent to the executor at the same time, by default
+      the number of workers of the executor
+    downgrade_factor: integer
+      the downgrade factor of the split maps read from the map pyramid, the pixel window of the
+      block averaging is deconvolved from them (see unapply_downgrade_window)
+    cancel: threading.Event
+      an optional event checked before each split transform (see compute_ps)
     """
 
-    if map.ncomp == 1:
-        map.data *= binary.data
+    cutouts = cutouts or MapCutouts()
+
+    if not compute_T_only:
+        window = (window, window)
+
+    # The filter is built once for all the splits. The 2D FFTs keep the historical scaling of
+    # filtered maps by the number of pixels
+    kspace_filter = None
+    if vk_mask is not None or hk_mask is not None:
+        kspace_filter = KspaceFilter(binary, vk_mask, hk_mask, normalize=ps_method != "2dflat")
+
+    def _tasks():
+        for map_info in maps_info_list:
+            _check_cancel(cancel)
+            split = cutouts.release(map_info["name"], car_box)
+            if compute_T_only and map_info["data_type"] == "IQU":
+                split.data = split.data[0]
+                split.ncomp = 1
+            kwargs = dict(
+                cal=map_info["cal"],
+                kspace_filter=kspace_filter,
+                downgrade_factor=downgrade_factor,
+                label=os.path.basename(map_info["name"]),
+            )
+            yield split, kwargs
+
+    ht_list = []
+    if executor is None:
+        for split, kwargs in _tasks():
+            ht_list += [_transform_split(split, window, ps_method, lmax, **kwargs)]
     else:
-        map.data[:] *= binary.data
+        # Keep a bounded number of cutouts in flight to limit memory usage
+        max_in_flight = max_in_flight or getattr(executor, "_max_workers", 1)
+        pending = deque()
+        for split, kwargs in _tasks():
+            if len(pending) >= max_in_flight:
+                ht_list += [pending.popleft().result()]
+            args = (split, window, ps_method, lmax)
+            pending.append(submit_profiled(executor, _transform_split, args, kwargs))
+        while pending:
+            ht_list += [pending.popleft().result()]
 
-    lymap, lxmap = map.data.lmap()
-    ly, lx = lymap[:, 0], lxmap[0, :]
+    name_list = [map_info["id"] for map_info in maps_info_list]
+    return name_list, ht_list
 
-    # filtered_map = map.copy()
-    ft = enmap.fft(map.data, normalize=normalize)
 
-    if vk_mask is not None:
-        id_vk = np.where((lx > vk_mask[0]) & (lx < vk_mask[1]))
-    if hk_mask is not None:
-        id_hk = np.where((ly > hk_mask[0]) & (ly < hk_mask[1]))
+def truncate_alms(alms, lmax):
+    """Return the alms (in HEALPIX ordering with mmax = lmax) truncated to a lower lmax
 
-    if map.ncomp == 1:
-        if vk_mask is not None:
-            ft[:, id_vk] = 0.0
-        if hk_mask is not None:
-            ft[id_hk, :] = 0.0
+    Parameters
+    ----------
+    alms: array
+      the alms with shape (..., nalm)
+    lmax: integer
+      the new maximum multipole
+    """
+    nalm = alms.shape[-1]
+    lmax_in = int((np.sqrt(1 + 8 * nalm) - 3) / 2)
+    if lmax == lmax_in:
+        return alms
+    if lmax > lmax_in:
+        raise ValueError("Can not truncate alms with lmax={} to lmax={}".format(lmax_in, lmax))
+    m = np.concatenate([np.full(lmax + 1 - m, m) for m in range(lmax + 1)])
+    ell = np.concatenate([np.arange(m, lmax + 1) for m in range(lmax + 1)])
+    return alms[..., m * (2 * lmax_in + 1 - m) // 2 + ell]
 
-    if map.ncomp == 3:
-        if vk_mask is not None:
-            ft[:, :, id_vk] = 0.0
-        if hk_mask is not None:
-            ft[:, id_hk, :] = 0.0
 
-    map.data[:] = np.real(enmap.ifft(ft, normalize=normalize))
-    return map
+def truncate_transforms(ht_list, lmax, ps_method="master"):
+    """Return the harmonic transforms, computed for a higher lmax, as computed for lmax
+
+    Parameters
+    ----------
+    ht_list: list
+      the alms or the 2D FFTs of the splits as returned by get_transforms
+    lmax: integer
+      the maximum multipole to consider for the spectra computation
+    ps_method: string
+      the method for the computation of the power spectrum
+    """
+    if ps_method == "2dflat":
+        return [ht.trim_fft(lmax) for ht in ht_list]
+    # alms are computed up to lmax + 50
+    return [truncate_alms(ht, lmax + 50) for ht in ht_list]
+
+
+def get_pseudo_spectra(alms, chunk_size=64 * 1024 ** 2):
+    """Compute every auto and cross pseudo power spectrum of a stack of alms
+
+    The alms are expected in the HEALPIX ordering with mmax = lmax. Spectra follow the
+    ``healpy.alm2cl`` convention i.e. C_l = sum_m Re(a_lm b_lm*) / (2l+1) with m < 0 modes
+    obtained from m > 0 ones.
+
+    Parameters
+    ----------
+    alms: 2d array
+      the stacked alms with shape (nfield, nalm)
+    chunk_size: integer
+      the approximate size in bytes of the multipole blocks processed at once
+
+    Return
+    ----------
+    The pseudo power spectra with shape (nfield, nfield, lmax+1)
+    """
+    alms = np.asarray(alms)
+    nfield, nalm = alms.shape
+    lmax = int((np.sqrt(1 + 8 * nalm) - 3) / 2)
+
+    cls = np.empty((lmax + 1, nfield, nfield))
+    nl = max(1, int(chunk_size // (2 * nfield * (lmax + 1) * alms.itemsize)))
+    for lmin in range(0, lmax + 1, nl):
+        ell = np.arange(lmin, min(lmin + nl, lmax + 1))
+        m = np.arange(ell[-1] + 1)
+        # Gather a_lm on a (l, m) grid, m > l entries are zeroed
+        ll, mm = np.meshgrid(ell, m, indexing="ij")
+        valid = mm <= ll
+        index = np.where(valid, mm * (2 * lmax + 1 - mm) // 2 + ll, 0)
+        block = alms[:, index]
+        block[:, ~valid] = 0
+        # m > 0 modes count twice
+        block[..., 1:] *= np.sqrt(2)
+        block = np.concatenate([block.real, block.imag], axis=-1).transpose(1, 0, 2)
+        cls[ell] = np.matmul(block, block.transpose(0, 2, 1))
+
+    cls /= (2 * np.arange(lmax + 1) + 1)[:, None, None]
+    return cls.transpose(1, 2, 0)
+
+
+def _binning_matrix(binning, lmax, type, nl):
+    # Same binning as so_spectra.bin_spectra: multipoles from 2 to lmax averaged within the bins
+    bin_lo, bin_hi, bin_c, bin_size = binning
+    ell = np.arange(nl)
+    fac = ell * (ell + 1) / (2 * np.pi) if type == "Dl" else np.ones(nl)
+    in_bin = (ell >= bin_lo[:, None]) & (ell <= bin_hi[:, None]) & (ell >= 2) & (ell < lmax)
+    pbl = in_bin * fac
+    pbl /= np.sum(in_bin, axis=1)[:, None]
+    return bin_c, pbl
+
+
+def get_cross_spectra(
+    ht_list, binning_file, lmax, type="Dl", mbb_inv=None, spectra=None, aux=None
+):
+    """Compute the binned auto and cross power spectra of all pairs of splits at once
+
+    All the alms are stacked and the pseudo spectra of every pair are computed in a single
+    contraction (see ``get_pseudo_spectra``). Binning and mode coupling deconvolution are then
+    applied as batched matrix products. The result is the same as looping over pairs with
+    ``so_spectra.get_spectra`` and ``so_spectra.bin_spectra``.
+
+    Parameters
+    ----------
+    ht_list: list of alms
+      the alms of each split, either 1d arrays (temperature only) or (T, E, B) 2d arrays
+    binning_file: text file
+      a binning file with three columns bin low, bin high, bin mean
+    lmax: integer
+      the maximum multipole to consider
+    type: string
+      the type of binning, either bin Cl or bin Dl
+    mbb_inv: 2d array or dict of 2d arrays
+      optionnaly the inverse of the binned mode coupling matrix
+    spectra: list of string
+      the arrangement of the spectra, None for temperature only
+    aux: AuxiliaryData
+      the already parsed binning, read from binning_file if not provided
+
+    Return
+    ----------
+    The bin centers, the list of split pairs (i, j) with i <= j and the binned spectra with
+    shape (npairs, nspectra, nbins)
+    """
+    if aux is None:
+        aux = AuxiliaryData(lmax, binning_file=binning_file)
+
+    alms = np.array(ht_list)
+    if alms.ndim == 2:
+        alms = alms[:, None]
+    nsplit, ncomp = alms.shape[:2]
+
+    cls = get_pseudo_spectra(alms.reshape(nsplit * ncomp, -1))
+    cls = cls.reshape(nsplit, ncomp, nsplit, ncomp, -1)
+
+    pairs = [(c1, c2) for c1 in range(nsplit) for c2 in range(nsplit) if c1 <= c2]
+    fields = "TEB"
+    components = [(0, 0)] if spectra is None else [(fields.index(X), fields.index(Y)) for X, Y in spectra]
+    c1, c2 = np.array(pairs).T
+    x, y = np.array(components).T
+    ps = cls[c1[:, None], x[None, :], c2[:, None], y[None, :]]
+
+    lb, pbl = _binning_matrix(aux.binning, lmax, type, ps.shape[-1])
+    ps = ps @ pbl.T
+
+    if mbb_inv is not None:
+        if spectra is None:
+            ps = ps @ mbb_inv.T
+        else:
+            # Block diagonal matrix ordered as TT, TE, TB, ET, BT, EE, EB, BE, BB
+            mbb_inv = block_diag(
+                mbb_inv["spin0xspin0"],
+                mbb_inv["spin0xspin2"],
+                mbb_inv["spin0xspin2"],
+                mbb_inv["spin2xspin0"],
+                mbb_inv["spin2xspin0"],
+                mbb_inv["spin2xspin2"],
+            )
+            npair, nspec, nbin = ps.shape
+            ps = (ps.reshape(npair, -1) @ mbb_inv.T).reshape(npair, nspec, nbin)
+
+    return lb, pairs, ps
 
 
 def get_spectra(
@@ -299,6 +1131,11 @@ def get_spectra(
     hk_mask=None,
     transfer_function=None,
     binary=None,
+    cutouts=None,
+    executor=None,
+    max_in_flight=None,
+    aux=None,
+    transforms=None,
 ):
     """Compute the power spectra in the patch
 
@@ -323,7 +1160,7 @@ def get_spectra(
       a binning file with three columns bin low, bin high, bin mean
       note that either binning_file or bin_size should be provided
     mbb_inv: 2d array
-      the inverse mode coupling matrix, not in use for 2dflat
+      the inverse mode coupling matrix (or a future holding it), not in use for 2dflat
     compute_T_only: boolean
         True to compute only T spectra
     vk_mask: list
@@ -334,47 +1171,44 @@ def get_spectra(
       the path to the transfer function
     binary: so_map
       the binary mask to be used in the kspace filter process
+    cutouts: MapCutouts
+      an optional provider of split cutouts already loaded when creating the window. Cutouts
+      are released from the provider once used
+    executor: concurrent.futures.Executor
+      an optional pool of workers where to compute the harmonic transforms of the splits
+    max_in_flight: integer
+      the maximal number of split cutouts sent to the executor at the same time
+    aux: AuxiliaryData
+      the already parsed binning and transfer function, read from binning_file and
+      transfer_function if not provided
+    transforms: tuple
+      the split names and harmonic transforms as returned by get_transforms, computed if not
+      provided
     """
+    if aux is None:
+        aux = AuxiliaryData(lmax, binning_file=binning_file, transfer_function=transfer_function)
+
+    if transforms is None:
+        transforms = get_transforms(
+            window,
+            maps_info_list,
+            car_box,
+            lmax,
+            ps_method=ps_method,
+            compute_T_only=compute_T_only,
+            vk_mask=vk_mask,
+            hk_mask=hk_mask,
+            binary=binary,
+            cutouts=cutouts,
+            executor=executor,
+            max_in_flight=max_in_flight,
+        )
+    name_list, ht_list = transforms
 
-    ht_list = []
-    name_list = []
-
-    if not compute_T_only:
-        window = (window, window)
-
-    for map_info in maps_info_list:
-
-        split = so_map.read_map(map_info["name"], car_box=car_box)
-
-        if compute_T_only and map_info["data_type"] == "IQU":
-            split.data = split.data[0]
-            split.ncomp = 1
-
-        if map_info["cal"] is not None:
-            split.data *= map_info["cal"]
-
-        use_kspace_filter = vk_mask is not None or hk_mask is not None
-        if use_kspace_filter:
-            timer.start("Filter {} in the patch...".format(os.path.basename(map_info["name"])))
-            split = get_filtered_map(split, binary, vk_mask, hk_mask)
-            timer.stop()
-
-        if ps_method in ["master", "pseudo"]:
-            timer.start("SPHT of {} in the patch...".format(os.path.basename(map_info["name"])))
-            alms = sph_tools.get_alms(split, window, niter=0, lmax=lmax + 50)
-            if use_kspace_filter:
-                alms /= np.product(split.data.shape[-2:])
-            ht_list += [alms]
-            timer.stop()
-
-        elif ps_method == "2dflat":
-            timer.start("FFT of {} in the patch...".format(os.path.basename(map_info["name"])))
-            ffts = flat_tools.get_ffts(split, window, lmax)
-            ht_list += [ffts]
-            timer.stop()
-
-        name_list += [map_info["id"]]
+    if isinstance(mbb_inv, Future):
+        mbb_inv = mbb_inv.result()
 
+    use_kspace_filter = vk_mask is not None or hk_mask is not None
     split_num = np.arange(len(maps_info_list))
 
     if compute_T_only:
@@ -391,30 +1225,32 @@ def get_spectra(
     ps_dict = {}
     spec_name_list = []
 
-    for name1, ht1, c1 in zip(name_list, ht_list, split_num):
-        for name2, ht2, c2 in zip(name_list, ht_list, split_num):
-            if c1 > c2:
-                continue
+    if ps_method in ["master", "pseudo"]:
+        get_profiler().start_stage("binning", "Compute and bin spectra...")
+        ells, pairs, ps_array = get_cross_spectra(
+            ht_list, binning_file, lmax, type=type, mbb_inv=mbb_inv, spectra=spectra, aux=aux
+        )
+        if use_kspace_filter:
+            ps_array /= aux.transfer_function[np.where(ells < lmax)]
+
+        for (c1, c2), ps in zip(pairs, ps_array):
+            spec_name = "%sx%s" % (name_list[c1], name_list[c2])
+            if compute_T_only:
+                ps_dict[spec_name] = ps[0]
+            else:
+                ps_dict[spec_name] = {spec: ps[i] for i, spec in enumerate(spectra)}
+            spec_name_list += [spec_name]
+        get_profiler().stop_stage()
 
-            spec_name = "%sx%s" % (name1, name2)
+    elif ps_method == "2dflat":
+        for name1, ht1, c1 in zip(name_list, ht_list, split_num):
+            for name2, ht2, c2 in zip(name_list, ht_list, split_num):
+                if c1 > c2:
+                    continue
 
-            if ps_method in ["master", "pseudo"]:
-                l, ps = so_spectra.get_spectra(ht1, ht2, spectra=spectra)
-                ells, ps_dict[spec_name] = so_spectra.bin_spectra(
-                    l, ps, binning_file, lmax, type=type, mbb_inv=mbb_inv, spectra=spectra
-                )
-                if use_kspace_filter:
-                    _, _, tf, _ = np.loadtxt(transfer_function, unpack=True)
-                    if compute_T_only:
-                        ps_dict[spec_name] /= tf[np.where(ells < lmax)]
-                    else:
-                        for spec in spectra:
-                            ps_dict[spec_name][spec] /= tf[np.where(ells < lmax)]
-
-            elif ps_method == "2dflat":
+                spec_name = "%sx%s" % (name1, name2)
                 ells, ps_dict[spec_name] = flat_tools.power_from_fft(ht1, ht2, type=type)
-
-            spec_name_list += [spec_name]
+                spec_name_list += [spec_name]
 
     if compute_T_only:
         # to make TT only behave the same as the other cases, make it a dictionnary
@@ -426,6 +1262,71 @@ def get_spectra(
     return spectra, spec_name_list, ells, ps_dict
 
 
+def _covariance_coupling_kernel(window, lmax, l_exact=None, l_band=None, l_toep=None):
+    get_profiler().start_stage("coupling", "Compute covariance coupling...")
+    coupling_dict = so_cov.cov_coupling_spin0(
+        window, lmax, niter=0, l_band=l_band, l_toep=l_toep, l_exact=l_exact
+    )
+    get_profiler().stop_stage()
+    return coupling_dict["TaTcTbTd"]
+
+
+def compute_covariance_coupling(
+    window,
+    lmax,
+    binning_file,
+    l_exact=None,
+    l_band=None,
+    l_toep=None,
+    cache=None,
+    executor=None,
+):
+    """Compute the binned coupling kernel entering the master covariance of the spectra
+
+    Parameters
+    ----------
+    window: so_map
+      the window function of the patch
+    lmax: integer
+      the maximum multipole to consider for the spectra computation
+    binning_file: text file
+      a binning file with three columns bin low, bin high, bin mean
+    cache: MemoryCache, DiskCache or TieredCache
+      an optional cache where to look for (and to store) both the unbinned and the binned
+      coupling kernels. The unbinned kernel is reused when only the binning changes
+    executor: concurrent.futures.Executor
+      an optional pool of workers where to compute the kernel. If the kernel needs to be
+      computed, a future holding the binned kernel is returned
+    """
+    kernel_key = binned_key = None
+    if cache is not None:
+        kernel_key = hash_items("cov_coupling", hash_window(window), lmax, l_exact, l_band, l_toep)
+        binned_key = hash_items(kernel_key, hash_file(binning_file))
+        coupling = cache.get(binned_key)
+        if coupling is not None:
+            get_profiler().log("Reuse cached covariance coupling")
+            return coupling
+
+    def _bin(kernel):
+        coupling = so_cov.bin_mat(kernel, binning_file, lmax)
+        if cache is not None:
+            cache.set(kernel_key, kernel)
+            cache.set(binned_key, coupling)
+        return coupling
+
+    kernel = cache.get(kernel_key) if cache is not None else None
+    if kernel is not None:
+        get_profiler().log("Reuse cached covariance coupling kernel")
+        return _bin(kernel)
+
+    kwargs = dict(l_exact=l_exact, l_band=l_band, l_toep=l_toep)
+    if executor is None:
+        return _bin(_covariance_coupling_kernel(window, lmax, **kwargs))
+
+    # Binning and caching are done once the kernel is back from the worker
+    return submit_profiled(executor, _covariance_coupling_kernel, (window, lmax), kwargs, then=_bin)
+
+
 def get_covariance(
     window,
     lmax,
@@ -440,6 +1341,9 @@ def get_covariance(
     mbb_inv=None,
     compute_T_only=False,
     transfer_function=None,
+    coupling=None,
+    aux=None,
+    cache=None,
 ):
     """Compute the covariance matrix of the power spectrum in the patch
 
@@ -469,10 +1373,34 @@ def get_covariance(
       True to compute only T spectra
     transfer_function: str
       the path to the transfer function
+    coupling: 2d array
+      the binned covariance coupling kernel (or a future holding it) for the master error,
+      computed from the window if not provided
+    aux: AuxiliaryData
+      the already parsed binning and transfer function, read from binning_file and
+      transfer_function if not provided
+    cache: MemoryCache, DiskCache or TieredCache
+      an optional cache of covariance coupling kernels
     """
-    timer.start("Compute {} error...".format(error_method))
+    if aux is None:
+        aux = AuxiliaryData(lmax, binning_file=binning_file, transfer_function=transfer_function)
+    bin_lo, bin_hi, bin_c, bin_size = aux.binning
+
+    if error_method == "master":
+        if coupling is None:
+            coupling = compute_covariance_coupling(
+                window,
+                lmax,
+                binning_file,
+                l_exact=l_exact,
+                l_band=l_band,
+                l_toep=l_toep,
+                cache=cache,
+            )
+        elif isinstance(coupling, Future):
+            coupling = coupling.result()
 
-    bin_lo, bin_hi, bin_c, bin_size = pspy_utils.read_binning_file(binning_file, lmax)
+    get_profiler().start_stage("covariance", "Compute {} error...".format(error_method))
 
     fsky = enmap.area(window.data.shape, window.data.wcs) / 4.0 / np.pi
     fsky *= np.mean(window.data)
@@ -498,10 +1426,9 @@ def get_covariance(
         if not compute_T_only:
             mbb_inv = mbb_inv["spin0xspin0"]
 
-        coupling_dict = so_cov.cov_coupling_spin0(
-            window, lmax, niter=0, l_band=l_band, l_toep=l_toep, l_exact=l_exact
-        )
-        coupling = so_cov.bin_mat(coupling_dict["TaTcTbTd"], binning_file, lmax)
+        if aux.transfer_function is not None:
+            sqrt_tf = np.sqrt(aux.transfer_function[: len(bin_c)])
+            tf_outer = np.outer(sqrt_tf, sqrt_tf)
 
         for name in spec_name_list:
             m1, m2 = name.split("x")
@@ -514,20 +1441,25 @@ def get_covariance(
                 cov_dict[name][X + Y] += so_cov.symmetrize(ps_dict["%sx%s" % (m1, m2)][X + Y] ** 2)
                 cov_dict[name][X + Y] *= coupling
                 cov_dict[name][X + Y] = np.dot(np.dot(mbb_inv, cov_dict[name][X + Y]), mbb_inv.T)
-                if transfer_function is not None:
-                    _, _, tf, _ = np.loadtxt(transfer_function, unpack=True)
-                    tf = tf[: len(bin_c)]
-                    cov_dict[name][X + Y] /= np.outer(np.sqrt(tf), np.sqrt(tf))
+                if aux.transfer_function is not None:
+                    cov_dict[name][X + Y] /= tf_outer
 
     else:
         cov_dict = None
 
-    timer.stop()
+    get_profiler().stop_stage()
     return cov_dict
 
 
 def theory_for_covariance(
-    ps_dict, spec_name_list, spectra, lmax, beam_file=None, binning_file=None, force_positive=True
+    ps_dict,
+    spec_name_list,
+    spectra,
+    lmax,
+    beam_file=None,
+    binning_file=None,
+    force_positive=True,
+    aux=None,
 ):
 
     ps_dict_for_cov = deepcopy(ps_dict)
@@ -543,10 +1475,14 @@ def theory_for_covariance(
                     ps_dict_for_cov["%sx%s" % (m2, m2)][Y + Y]
                 )
 
-    if beam_file is not None:
-        beam_data = np.loadtxt(beam_file)
-        l, bl = beam_data[:, 0], beam_data[:, 1]
-        lb, bb = pspy_utils.naive_binning(l, bl, binning_file, lmax)
+    if aux is None:
+        aux = AuxiliaryData(lmax, binning_file=binning_file, beam_file=beam_file)
+
+    if aux.beam is not None:
+        # Same as pspy_utils.naive_binning
+        l, bl = aux.beam[:, 0], aux.beam[:, 1]
+        bin_lo, bin_hi, bin_c, bin_size = aux.binning
+        bb = np.array([bl[(l >= lo) & (l <= hi)].mean() for lo, hi in zip(bin_lo, bin_hi)])
         for name in spec_name_list:
             for spec in spectra:
                 ps_dict_for_cov[name][spec] *= bb ** 2
@@ -554,6 +1490,36 @@ def theory_for_covariance(
     return ps_dict_for_cov
 
 
+def _file_signature(file_name):
+    # Identify a file by its path, modification time and size
+    if file_name is None:
+        return None
+    stat = os.stat(file_name)
+    return os.path.abspath(file_name), stat.st_mtime_ns, stat.st_size
+
+
+class ComputationCancelled(Exception):
+    """Raised by compute_ps when the computation is cancelled"""
+
+
+def _check_cancel(cancel):
+    # Stop the computation between two stages
+    if cancel is not None and cancel.is_set():
+        raise ComputationCancelled("Computation cancelled")
+
+
+def _get_stage(state, name, key, lmax=None):
+    # Return the stored output of a stage if it was computed with the same inputs and, if given,
+    # up to lmax at least
+    entry = state.get(name)
+    if entry is None or entry["key"] != key:
+        return None
+    if lmax is not None and entry["lmax"] < lmax:
+        return None
+    get_profiler().log("Reuse {} of previous computation".format(name))
+    return entry["value"]
+
+
 def compute_ps(
     patch,
     maps_info_list,
@@ -574,6 +1540,14 @@ def compute_ps(
     vk_mask=None,
     hk_mask=None,
     transfer_function=None,
+    cache=None,
+    use_memmap=False,
+    n_workers=None,
+    profiler=None,
+    state=None,
+    use_pyramid=False,
+    executor=None,
+    cancel=None,
 ):
     """Compute spectra
 
@@ -619,6 +1593,29 @@ def compute_ps(
       the horizontal band to filter out from 2D FFT (format is [-ly, +ly])
     transfer_function: str
       the path to the transfer function
+    cache: DiskCache
+      an optional on-disk cache of mode coupling matrices and covariance coupling kernels
+    use_memmap: boolean
+      read the map cutouts through memory-mapped FITS files
+    n_workers: integer
+      the number of worker processes computing the split transforms and the mode coupling
+      matrices. At most n_workers split cutouts are sent to the workers at the same time.
+    executor: concurrent.futures.Executor
+      an optional pool of workers shared by several computations, e.g. over a list of patches.
+      If None, a pool of n_workers processes is created for this computation
+    profiler: Profiler
+      an optional profiler recording the wall time, the CPU time and the peak memory of each
+      stage (window, MCM, transforms, binning, covariance) of the computation
+    state: dict
+      an optional dictionary keeping the window, the mode coupling matrices and the split
+      transforms between calls for the same patch. Only the stages whose inputs changed since
+      the previous call are computed again
+    use_pyramid: boolean
+      use the coarsest downgraded maps and masks written by car2pyramid that support lmax (see
+      select_pyramid_level), the pixel window of the downgrade is deconvolved from the split maps
+    cancel: threading.Event
+      an optional event checked between the stages of the computation. Once it is set,
+      ComputationCancelled is raised and the pending tasks of the pool of workers are cancelled
     """
 
     # Check computation mode
@@ -639,8 +1636,19 @@ def compute_ps(
     if binning_file is None and ps_method != "2dflat":
         if bin_size is None:
             raise ValueError("Missing binning size!")
-        pspy_utils.create_binning_file(bin_size=bin_size, n_bins=1000, file_name="binning.dat")
-        binning_file = "binning.dat"
+        binning_file = default_binning_file(bin_size)
+
+    factor = 1
+    if use_pyramid:
+        masks = [mask for mask in [galactic_mask, source_mask] if mask is not None]
+        factor = select_pyramid_level([m["name"] for m in maps_info_list + masks], lmax)
+        if factor > 1:
+            get_profiler().log("Use maps downgraded by a factor {}".format(factor))
+            maps_info_list = [dict(m, name=pyramid_file(m["name"], factor)) for m in maps_info_list]
+            if galactic_mask is not None:
+                galactic_mask = dict(galactic_mask, name=pyramid_file(galactic_mask["name"], factor))
+            if source_mask is not None:
+                source_mask = dict(source_mask, name=pyramid_file(source_mask["name"], factor))
 
     use_kspace_filter = False
     if vk_mask is not None or hk_mask is not None:
@@ -648,66 +1656,195 @@ def compute_ps(
             raise ValueError("Missing transfer function to correct for kpsace filter")
         use_kspace_filter = True
 
-    car_box, window, binary = create_window(
-        patch,
-        maps_info_list,
-        apo_radius_survey,
-        galactic_mask=galactic_mask,
-        source_mask=source_mask,
-        compute_T_only=compute_T_only,
-        use_kspace_filter=use_kspace_filter,
-    )
-
-    mbb_inv = compute_mode_coupling(
-        window,
-        type,
+    # Binning, beam and transfer function are parsed once for all the computation steps
+    aux = AuxiliaryData(
         lmax,
-        binning_file,
-        ps_method=ps_method,
+        binning_file=binning_file,
         beam_file=beam_file,
-        l_exact=l_exact,
-        l_band=l_band,
-        l_toep=l_toep,
-        compute_T_only=compute_T_only,
+        transfer_function=transfer_function,
     )
 
-    spectra, spec_name_list, ells, ps_dict = get_spectra(
-        window,
-        maps_info_list,
-        car_box,
+    # Mode coupling matrices and covariance couplings are kept in memory across calls, and on disk
+    # if a cache is given. They are shared by the patches with the same window up to a translation
+    # in right ascension
+    shared_cache = TieredCache(memory_cache, cache)
+
+    # Split cutouts are shared by window creation and spectra computation
+    cutouts = MapCutouts(use_memmap=use_memmap)
+
+    state = state if state is not None else {}
+
+    # Inputs of each stage, a stage is computed again only if its inputs changed
+    window_key = hash_items(
+        "window",
+        patch,
+        [(m["name"], _file_signature(m["name"]), m["data_type"]) for m in maps_info_list],
+        galactic_mask,
+        source_mask,
+        [_file_signature(m["name"]) for m in [galactic_mask, source_mask] if m is not None],
+        apo_radius_survey,
+        compute_T_only,
+        use_kspace_filter,
+    )
+    mcm_key = hash_items(
+        "mcm",
+        window_key,
+        ps_method,
         type,
         lmax,
-        binning_file,
-        ps_method=ps_method,
-        mbb_inv=mbb_inv,
-        compute_T_only=compute_T_only,
-        vk_mask=vk_mask,
-        hk_mask=hk_mask,
-        transfer_function=transfer_function,
-        binary=binary,
+        hash_file(binning_file),
+        hash_file(beam_file),
+        l_exact,
+        l_band,
+        l_toep,
+    )
+    transforms_key = hash_items(
+        "transforms",
+        window_key,
+        [m["cal"] for m in maps_info_list],
+        ps_method,
+        vk_mask,
+        hk_mask,
     )
 
-    if ps_method == "2dflat" or error_method is None:
-        return spectra, spec_name_list, ells, ps_dict, None
+    profiler = profiler or Profiler()
+    profiler.start()
+    owns_executor = executor is None and n_workers is not None and n_workers > 1
+    try:
+        _check_cancel(cancel)
+        if _get_stage(state, "window", window_key) is None:
+            state["window"] = dict(
+                key=window_key,
+                value=create_window(
+                    patch,
+                    maps_info_list,
+                    apo_radius_survey,
+                    galactic_mask=galactic_mask,
+                    source_mask=source_mask,
+                    compute_T_only=compute_T_only,
+                    use_kspace_filter=use_kspace_filter,
+                    cutouts=cutouts,
+                ),
+            )
+        car_box, window, binary = state["window"]["value"]
+        _check_cancel(cancel)
+
+        if owns_executor:
+            executor = ProcessPoolExecutor(max_workers=n_workers)
+
+        mcm_kwargs = dict(
+            ps_method=ps_method,
+            beam_file=beam_file,
+            l_exact=l_exact,
+            l_band=l_band,
+            l_toep=l_toep,
+            compute_T_only=compute_T_only,
+            cache=shared_cache,
+            aux=aux,
+            # Mode coupling matrices are computed while the splits are transformed
+            executor=executor,
+        )
+        coupling = None
+        mbb_inv = _get_stage(state, "mcm", mcm_key)
+        if mbb_inv is None:
+            mbb_inv = compute_mode_coupling(window, type, lmax, binning_file, **mcm_kwargs)
+        if executor is not None and ps_method != "2dflat" and error_method == "master":
+            coupling = compute_covariance_coupling(
+                window,
+                lmax,
+                binning_file,
+                l_exact=l_exact,
+                l_band=l_band,
+                l_toep=l_toep,
+                cache=shared_cache,
+                executor=executor,
+            )
 
-    ps_dict_for_cov = theory_for_covariance(
-        ps_dict, spec_name_list, spectra, lmax, beam_file=beam_file, binning_file=binning_file
-    )
+        _check_cancel(cancel)
 
-    cov_dict = get_covariance(
-        window,
-        lmax,
-        spec_name_list,
-        ps_dict_for_cov,
-        binning_file,
-        error_method=error_method,
-        l_exact=l_exact,
-        l_band=l_band,
-        l_toep=l_toep,
-        spectra=spectra,
-        mbb_inv=mbb_inv,
-        compute_T_only=compute_T_only,
-        transfer_function=transfer_function,
-    )
+        # Transforms computed at a higher lmax are truncated
+        transforms = _get_stage(state, "transforms", transforms_key, lmax=lmax)
+        if transforms is not None:
+            name_list, ht_list = transforms
+            transforms = name_list, truncate_transforms(ht_list, lmax, ps_method)
+        else:
+            transforms = get_transforms(
+                window,
+                maps_info_list,
+                car_box,
+                lmax,
+                ps_method=ps_method,
+                compute_T_only=compute_T_only,
+                vk_mask=vk_mask,
+                hk_mask=hk_mask,
+                binary=binary,
+                cutouts=cutouts,
+                executor=executor,
+                max_in_flight=n_workers,
+                downgrade_factor=factor,
+                cancel=cancel,
+            )
+            state["transforms"] = dict(key=transforms_key, value=transforms, lmax=lmax)
+        cutouts.clear()
+        _check_cancel(cancel)
+
+        spectra, spec_name_list, ells, ps_dict = get_spectra(
+            window,
+            maps_info_list,
+            car_box,
+            type,
+            lmax,
+            binning_file,
+            ps_method=ps_method,
+            mbb_inv=mbb_inv,
+            compute_T_only=compute_T_only,
+            vk_mask=vk_mask,
+            hk_mask=hk_mask,
+            transfer_function=transfer_function,
+            binary=binary,
+            aux=aux,
+            transforms=transforms,
+        )
+
+        if isinstance(mbb_inv, Future):
+            mbb_inv = mbb_inv.result()
+        state["mcm"] = dict(key=mcm_key, value=mbb_inv)
+
+        if ps_method == "2dflat" or error_method is None:
+            return spectra, spec_name_list, ells, ps_dict, None
+        _check_cancel(cancel)
+
+        ps_dict_for_cov = theory_for_covariance(
+            ps_dict,
+            spec_name_list,
+            spectra,
+            lmax,
+            beam_file=beam_file,
+            binning_file=binning_file,
+            aux=aux,
+        )
+
+        cov_dict = get_covariance(
+            window,
+            lmax,
+            spec_name_list,
+            ps_dict_for_cov,
+            binning_file,
+            error_method=error_method,
+            l_exact=l_exact,
+            l_band=l_band,
+            l_toep=l_toep,
+            spectra=spectra,
+            mbb_inv=mbb_inv,
+            compute_T_only=compute_T_only,
+            transfer_function=transfer_function,
+            coupling=coupling,
+            aux=aux,
+            cache=shared_cache,
+        )
+    finally:
+        if owns_executor and executor is not None:
+            executor.shutdown(cancel_futures=cancel is not None and cancel.is_set())
+        profiler.stop()
 
     return spectra, spec_name_list, ells, ps_dict, cov_dict
@@ -0,0 +1,261 @@
+import itertools
+import json
+import os
+import platform
+import resource
+import tempfile
+import time
+import tracemalloc
+
+import numpy as np
+from pspy import pspy_utils, so_map
+
+from .. import __version__, pstools
+
+
+def make_maps(output_dir, n_splits, ncomp, size, resolution=1.0, seed=1234):
+    """Generate synthetic CAR maps centered on (0, 0)
+
+    Parameters
+    ----------
+    output_dir: string
+      the directory where to write the FITS files
+    n_splits: integer
+      the number of splits
+    ncomp: integer
+      the number of components, 1 for temperature only maps and 3 for IQU maps
+    size: float
+      the size in degrees of the square maps
+    resolution: float
+      the resolution in arcminutes
+    seed: integer
+      the seed of the random generator
+
+    Return
+    ----------
+    The list of maps info describing the maps
+    """
+    rng = np.random.default_rng(seed)
+    template = so_map.car_template(ncomp, -size / 2, size / 2, -size / 2, size / 2, resolution)
+    # Common sky signal and independent noise in each split
+    signal = rng.standard_normal(template.data.shape) * 100
+    maps_info_list = []
+    for i in range(n_splits):
+        name = os.path.join(
+            output_dir, "split{}_{}_{}_{}_{}.fits".format(i, ncomp, size, resolution, seed)
+        )
+        if not os.path.exists(name):
+            template.data[:] = signal + rng.standard_normal(template.data.shape) * 10
+            template.write_map(name)
+        data_type = "IQU" if ncomp == 3 else "I"
+        maps_info_list.append(dict(id="split{}".format(i), name=name, data_type=data_type, cal=None))
+    return maps_info_list
+
+
+def _time(func, *args, **kwargs):
+    t0 = time.perf_counter()
+    result = func(*args, **kwargs)
+    return result, time.perf_counter() - t0
+
+
+def _peak_memory(func, *args, **kwargs):
+    # Run apart from the timed runs since tracemalloc slows down allocations
+    tracemalloc.start()
+    try:
+        result = func(*args, **kwargs)
+        _, peak = tracemalloc.get_traced_memory()
+    finally:
+        tracemalloc.stop()
+    return result, peak
+
+
+def benchmark(
+    patch_sizes=(5,),
+    lmaxs=(1000,),
+    n_splits=(2,),
+    compute_T_only=(True, False),
+    bin_size=40,
+    resolution=1.0,
+    repeat=1,
+    map_dir=None,
+):
+    """Time the stages of the spectra pipeline over a grid of parameters
+
+    For each set of parameters, the window creation, the mode coupling, the spectra and the
+    covariance computations are timed separately. The best time over repeats and the peak memory
+    allocated by each stage (as seen by tracemalloc) are recorded. Peak memories are measured in
+    an additional run so that tracemalloc does not slow down the timed runs.
+
+    Parameters
+    ----------
+    patch_sizes: list of float
+      the sizes in degrees of the square patches
+    lmaxs: list of integer
+      the maximum multipoles
+    n_splits: list of integer
+      the numbers of splits
+    compute_T_only: list of boolean
+      True to compute only T spectra
+    bin_size: integer
+      the bin size
+    resolution: float
+      the resolution in arcminutes of the synthetic maps
+    repeat: integer
+      the number of times each measure is repeated
+    map_dir: string
+      the directory where synthetic maps are stored, a temporary directory if None
+
+    Return
+    ----------
+    A list of records, one per stage and set of parameters
+    """
+    tmp_dir = None
+    if map_dir is None:
+        tmp_dir = tempfile.TemporaryDirectory()
+        map_dir = tmp_dir.name
+    os.makedirs(map_dir, exist_ok=True)
+
+    binning_file = os.path.join(map_dir, "binning.dat")
+    pspy_utils.create_binning_file(bin_size=bin_size, n_bins=1000, file_name=binning_file)
+
+    records = []
+    grid = itertools.product(patch_sizes, lmaxs, n_splits, compute_T_only)
+    for size, lmax, n_split, T_only in grid:
+        params = dict(patch_size=size, lmax=lmax, n_splits=n_split, compute_T_only=T_only)
+        print("Benchmark {}".format(params))
+
+        # Maps are larger than the patch to keep the apodized border inside the maps
+        maps_info_list = make_maps(map_dir, n_split, 1 if T_only else 3, size + 4, resolution)
+        patch = dict(patch_type="Rectangle", patch_coordinate=[[-size / 2] * 2, [size / 2] * 2])
+        aux = pstools.AuxiliaryData(lmax, binning_file=binning_file)
+
+        def run_stages(measure):
+            # Return the measures of each stage and the window
+            measures = {}
+            (car_box, window, binary), measures["create_window"] = measure(
+                pstools.create_window, patch, maps_info_list, compute_T_only=T_only
+            )
+            mbb_inv, measures["compute_mode_coupling"] = measure(
+                pstools.compute_mode_coupling,
+                window,
+                "Dl",
+                lmax,
+                binning_file,
+                compute_T_only=T_only,
+                aux=aux,
+            )
+            (spectra, spec_name_list, lb, ps_dict), measures["get_spectra"] = measure(
+                pstools.get_spectra,
+                window,
+                maps_info_list,
+                car_box,
+                "Dl",
+                lmax,
+                binning_file,
+                mbb_inv=mbb_inv,
+                compute_T_only=T_only,
+                aux=aux,
+            )
+            _, measures["get_covariance"] = measure(
+                pstools.get_covariance,
+                window,
+                lmax,
+                spec_name_list,
+                ps_dict,
+                binning_file,
+                spectra=spectra,
+                mbb_inv=mbb_inv,
+                compute_T_only=T_only,
+                aux=aux,
+            )
+            return measures, window
+
+        timings = [run_stages(_time)[0] for _ in range(repeat)]
+        peaks, window = run_stages(_peak_memory)
+
+        npix = int(np.prod(window.data.shape))
+        for stage, peak in peaks.items():
+            best = min(timing[stage] for timing in timings)
+            records.append(dict(stage=stage, npix=npix, **params, time=best, peak_memory=peak))
+
+    if tmp_dir is not None:
+        tmp_dir.cleanup()
+    return records
+
+
+def write_results(output_file, records):
+    """Write the benchmark records and the environment description in a JSON file"""
+    import pixell
+    import pspy
+
+    content = dict(
+        date=time.strftime("%Y-%m-%dT%H:%M:%S"),
+        versions=dict(
+            psplay=__version__,
+            pspy=pspy.__version__,
+            pixell=pixell.__version__,
+            numpy=np.__version__,
+            python=platform.python_version(),
+        ),
+        machine=dict(
+            platform=platform.platform(),
+            processor=platform.processor(),
+            cpu_count=os.cpu_count(),
+            max_rss=resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * 1024,
+        ),
+        records=records,
+    )
+    with open(output_file, "w") as f:
+        json.dump(content, f, indent=2)
+
+
+def main():
+    import argparse
+
+    parser = argparse.ArgumentParser(
+        description="A python program to benchmark the stages of the spectra pipeline on synthetic maps"
+    )
+    parser.add_argument(
+        "-o",
+        "--output-file",
+        help="output JSON file holding the benchmark results",
+        type=str,
+        default="psplay_benchmark.json",
+    )
+    parser.add_argument(
+        "--patch-sizes", help="patch sizes in degrees", type=float, nargs="+", default=[5]
+    )
+    parser.add_argument("--lmax", help="maximum multipoles", type=int, nargs="+", default=[1000])
+    parser.add_argument("--n-splits", help="numbers of splits", type=int, nargs="+", default=[2])
+    parser.add_argument(
+        "--T-only",
+        help="benchmark temperature only computation (default both T only and TEB)",
+        choices=["true", "false", "both"],
+        default="both",
+    )
+    parser.add_argument("--bin-size", help="bin size", type=int, default=40)
+    parser.add_argument("--resolution", help="map resolution in arcminutes", type=float, default=1.0)
+    parser.add_argument("--repeat", help="number of repetitions", type=int, default=1)
+    parser.add_argument(
+        "--map-dir", help="directory where to keep synthetic maps", type=str, default=None
+    )
+    args = parser.parse_args()
+
+    compute_T_only = {"true": [True], "false": [False], "both": [True, False]}[args.T_only]
+    records = benchmark(
+        patch_sizes=args.patch_sizes,
+        lmaxs=args.lmax,
+        n_splits=args.n_splits,
+        compute_T_only=compute_T_only,
+        bin_size=args.bin_size,
+        resolution=args.resolution,
+        repeat=args.repeat,
+        map_dir=args.map_dir,
+    )
+    print("Writing '{}' file".format(args.output_file))
+    write_results(args.output_file, records)
+
+
+# script:
+if __name__ == "__main__":
+    main()
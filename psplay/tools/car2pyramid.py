@@ -0,0 +1,65 @@
+import numpy as np
+from pixell import enmap
+
+from ..pstools import pyramid_file
+
+
+def car2pyramid(input_file, n_levels=4, binary=False):
+    """Write downgraded versions of a CAR map to speed up low lmax computations
+
+    Level k holds the map averaged over blocks of 2**k x 2**k pixels. Files are written next to
+    the input file and named after it (e.g. 'map_down4.fits' for level 2), the pyramid levels are
+    picked by pstools.compute_ps when use_pyramid is True.
+
+    Parameters
+    ----------
+    input_file: fits file
+      name of the input CAR fits file
+    n_levels: integer
+      the number of downgraded levels
+    binary: boolean
+      round the averaged values to 0 or 1, i.e. for binary masks
+    """
+    imap = enmap.read_map(input_file)
+    for level in range(1, n_levels + 1):
+        factor = 2 ** level
+        output_file = pyramid_file(input_file, factor)
+        # Blocks are aligned on the (0, 0) coordinates to keep maps and masks pixel-compatible
+        omap = enmap.downgrade(imap, factor, ref=(0, 0))
+        if binary:
+            omap = np.round(omap)
+        print("Writing '{}' file with shape {}".format(output_file, omap.shape))
+        enmap.write_map(output_file, omap)
+
+
+def main():
+    import argparse
+
+    parser = argparse.ArgumentParser(
+        description="A python program to produce downgraded versions of CAR maps and masks"
+    )
+    parser.add_argument(
+        "-i",
+        "--input-files",
+        help="input FITS files corresponding to CAR maps or masks",
+        type=str,
+        nargs="+",
+        required=True,
+        default=None,
+    )
+    parser.add_argument("--n-levels", help="number of downgraded levels", type=int, default=4)
+    parser.add_argument(
+        "--binary",
+        help="round downgraded values to 0 or 1, for binary masks",
+        action="store_true",
+        default=False,
+    )
+    args = parser.parse_args()
+
+    for input_file in args.input_files:
+        car2pyramid(input_file, n_levels=args.n_levels, binary=args.binary)
+
+
+# script:
+if __name__ == "__main__":
+    main()
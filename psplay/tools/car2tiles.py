@@ -1,10 +1,29 @@
+import json
 import os
 
-import numpy as np
-from pixell import enplot, mpi
-from pspy import so_map
+from pixell import enmap, enplot, mpi, utils
 
+from ..cache import hash_items
 from . import tile_utils_sigurd, webplot
+from .expression import Expression
+
+manifest_file = "manifest.json"
+
+
+def _read_manifest(output_dir):
+    file_name = os.path.join(output_dir, manifest_file)
+    if not os.path.exists(file_name):
+        return None
+    with open(file_name, "r") as f:
+        return json.load(f)
+
+
+def _write_manifest(output_dir, manifest):
+    # Replace the manifest at once so that an interrupted run leaves the previous one
+    file_name = os.path.join(output_dir, manifest_file)
+    with open(file_name + ".tmp", "w") as f:
+        json.dump(manifest, f)
+    os.replace(file_name + ".tmp", file_name)
 
 
 def car2tiles(
@@ -15,6 +34,7 @@ def car2tiles(
     delete_fits=True,
     use_webplot=True,
     pre_operation=None,
+    incremental=False,
 ):
     """Convert CAR map to PNG tiles
     Parameters
@@ -28,77 +48,119 @@ def car2tiles(
     output_dir: string
       name of the output directory holding PNG files
     delete_fits: boolean
-      delete the FITS files corresponding to the tiles
+      delete the FITS files corresponding to the tiles (with webplot, they are not written at all)
     use_webplot: boolean
       use webplot in place of enplot program
+    pre_operation: string
+      operation applied to the map 'm' before tiling, e.g. 'log(abs(m))'. Only arithmetic
+      operators and the NumPy functions listed in expression.functions are allowed
+    incremental: boolean
+      keep the FITS tiles and a manifest of checksums in the output directory so that next runs
+      with the same options only rebuild the tiles covering pixels of the map or of the mask that
+      changed. Only available with webplot
     """
+    if incremental and not use_webplot:
+        raise ValueError("Incremental mode is only available with webplot")
     enplot_args = enplot_args or []
+    # Parse the pre operation once, before any tiling
+    operation = Expression(pre_operation) if pre_operation is not None else None
 
-    comm = mpi.COMM_WORLD
-    if comm.rank == 0:
-        if output_dir is None:
-            output_dir = os.path.join("tiles", os.path.basename(input_file))
-        # Check if path to fits file are already stored
-        fits_files = os.path.join(output_dir, "*/*.fits")
-        if fits_files not in enplot_args:
-            enplot_args.append(fits_files)
-
-        if os.path.exists(output_dir):
-            os.system("rm -rf %s" % output_dir)
-
+    def preprocess(imap, rows):
+        # Mask and pre operation are applied on the rows read for the base tiles so that no
+        # full-size copy of the map is created
         if mask_file is not None:
-            car = so_map.read_map(input_file)
-            mask = so_map.read_map(mask_file)
-
-            # from pixell import wcsutils
-            # if not wcsutils.is_compatible(mask.geometry[0], car.geometry[0]):
-            #     raise ValueError("Map and mask must have compatible geometries")
-
-            if mask.ncomp == car.ncomp == 1:
-                car.data *= np.where(mask.data < 0.5, 0, 1)
-            elif mask.ncomp == 1:
-                for i in range(car.ncomp):
-                    car.data[i] *= np.where(mask.data < 0.5, 0, 1)
-            else:
-                if mask.ncomp != car.ncomp:
-                    raise ValueError("Map and mask have different number of components")
-                for i in range(mask.ncomp):
-                    car.data[i] *= np.where(mask.data[i] < 0.5, 0, 1)
-            input_file += ".tmp"
-            car.write_map(input_file)
-
-        if pre_operation is not None:
-            car = so_map.read_map(input_file)
-            car.data = eval(pre_operation, {"m": car.data}, np.__dict__)
-            input_file += ".tmp"
-            car.write_map(input_file)
+            mask = enmap.read_map(mask_file, delayed=True)[..., rows, :]
+            if mask.ndim > 2 and mask.shape[:-2] != imap.shape[:-2]:
+                raise ValueError("Map and mask have different number of components")
+            imap *= ~(mask < 0.5)
+        if operation is not None:
+            imap = operation.evaluate(imap, inplace=True)
+        return imap
+
+    comm = mpi.COMM_WORLD
+    if output_dir is None:
+        output_dir = os.path.join("tiles", os.path.basename(input_file))
+    # Check if path to fits file are already stored
+    fits_files = os.path.join(output_dir, "*/*.fits")
+    if fits_files not in enplot_args:
+        enplot_args.append(fits_files)
+
+    # Find the base tiles whose pixels changed since the previous run
+    dirty, manifest = None, None
+    if incremental:
+        shape, wcs = enmap.read_map_geometry(input_file)
+        options = dict(
+            shape=list(shape),
+            wcs=wcs.to_header_string(),
+            mask_file=mask_file,
+            pre_operation=pre_operation,
+            webplot=[arg for arg in enplot_args if arg != fits_files],
+        )
+        checksums = tile_utils_sigurd.leafchecksums(
+            [input_file] + ([mask_file] if mask_file is not None else []),
+            comm=comm if not mpi.disabled else None,
+        )
+        if not mpi.disabled:
+            checksums = {k: v for sums in comm.allgather(checksums) for k, v in sums.items()}
+        manifest = _read_manifest(output_dir)
+        if manifest is not None and manifest["options"] == options:
+            dirty = {
+                (y, x)
+                for (y, x), checksum in checksums.items()
+                if manifest["sources"].get("%d_%d" % (y, x)) != checksum
+            }
+            if comm.rank == 0:
+                print("Updating {} out of {} base tiles".format(len(dirty), len(checksums)))
+        else:
+            manifest = dict(options=options, tiles={})
+        manifest["sources"] = {"%d_%d" % yx: checksum for yx, checksum in checksums.items()}
+
+    if comm.rank == 0 and os.path.exists(output_dir) and dirty is None:
+        os.system("rm -rf %s" % output_dir)
 
     if not mpi.disabled:
         comm.barrier()
 
-    tile_utils_sigurd.leaftile(
-        input_file,
-        output_dir,
+    kwargs = dict(
         verbose="-v" in enplot_args,
         comm=comm if not mpi.disabled else None,
-        monolithic=True,
+        preprocess=preprocess if mask_file is not None or pre_operation is not None else None,
     )
-
     if use_webplot:
-        args = webplot.parse_args(enplot_args)
-        webplot.plot(args)
-    else:
-        args = enplot.parse_args(enplot_args)
-        for plot in enplot.plot_iterator(*args.ifiles, comm=comm, **args):
-            enplot.write(plot.name, plot)
-
-    if comm.rank == 0:
-        if mask_file is not None or pre_operation is not None:
-            os.remove(input_file)
-
-        if delete_fits:
-            for fits in args.ifiles:
-                os.remove(fits)
+        # PNG files of all the levels are produced in a single pass over the map
+        args = webplot.parse_args(enplot_args, noglob=True)
+        written = {}
+
+        def write(oname, omap):
+            if incremental:
+                # Tiles rebuilt with the same content are left untouched
+                name = os.path.relpath(oname, output_dir)
+                written[name] = hash_items(omap)
+                if manifest["tiles"].get(name) == written[name] and os.path.exists(oname):
+                    return
+            if incremental or not delete_fits:
+                enmap.write_map(oname, omap)
+            webplot.write(oname, omap, args)
+
+        tile_utils_sigurd.leafpyramid(input_file, output_dir, write=write, dirty=dirty, **kwargs)
+
+        if incremental:
+            if not mpi.disabled:
+                written = {k: v for tiles in comm.gather(written) or [] for k, v in tiles.items()}
+            if comm.rank == 0:
+                manifest["tiles"].update(written)
+                utils.mkdir(output_dir)
+                _write_manifest(output_dir, manifest)
+        return
+
+    tile_utils_sigurd.leaftile(input_file, output_dir, monolithic=True, **kwargs)
+    args = enplot.parse_args(enplot_args)
+    for plot in enplot.plot_iterator(*args.ifiles, comm=comm, **args):
+        enplot.write(plot.name, plot)
+
+    if comm.rank == 0 and delete_fits:
+        for fits in args.ifiles:
+            os.remove(fits)
 
 
 def main():
@@ -134,9 +196,15 @@ def main():
     parser.add_argument(
         "--keep-fits-files", help="keep intermediate FITS files", action="store_true", default=False
     )
+    parser.add_argument(
+        "--incremental",
+        help="only rebuild the tiles whose pixels changed since the previous run",
+        action="store_true",
+        default=False,
+    )
     parser.add_argument(
         "--op",
-        help="pre operation on the original CAR file. For instance, 'log(abs(m))' would give you a logarithmic map",
+        help="pre operation on the original CAR file. For instance, 'log(abs(m))' would give you a logarithmic map. Only arithmetic operators and common NumPy functions are allowed",
         type=str,
         default=None,
     )
@@ -150,6 +218,7 @@ def main():
         delete_fits=not args.keep_fits_files,
         use_webplot=not args.use_enplot,
         pre_operation=args.op,
+        incremental=args.incremental,
     )
 
 
@@ -0,0 +1,365 @@
+import os
+import traceback
+from concurrent.futures import ProcessPoolExecutor
+
+import yaml
+from pixell import mpi
+
+from .. import io, utils
+from ..cache import DiskCache, hash_window
+from ..profiling import Profiler
+from ..pstools import ComputationCancelled, compute_ps, create_window
+
+
+def compute_patch(
+    name, patch_dict, maps_info_list, kwargs, cache=None, profile=None, write=None, **options
+):
+    """Compute the power spectra and covariances of a patch
+
+    Parameters
+    ----------
+    name: string
+      the name of the patch
+    patch_dict: dict
+      the pstools patch dictionary
+    maps_info_list: list of dicts describing the data maps
+    kwargs: dict
+      the compute_ps options, as returned by utils.get_compute_kwargs
+    cache: DiskCache
+      an optional on-disk cache of mode coupling matrices
+    profile: string
+      the optional profiling of the computation (see Profiler)
+    write: callable
+      the function writing the messages of the computation (see Profiler)
+    options:
+      additional compute_ps options such as use_memmap, n_workers, executor, state or cancel
+
+    Return
+    ----------
+    The method dictionary of write_results holding the 'results', the 'performance' records and
+    the 'profile_report'. A failed computation holds an 'error' message in place of the results
+    while a cancelled computation raises ComputationCancelled
+    """
+    profiler = Profiler(profile=profile, write=write)
+    profiler.log("Compute patch '{}' for '{}' method".format(name, kwargs["ps_method"]))
+    method = dict(results=None, performance=profiler.records)
+    try:
+        spectra, spec_name_list, lb, ps_dict, cov_dict = compute_ps(
+            patch=patch_dict,
+            maps_info_list=maps_info_list,
+            cache=cache,
+            profiler=profiler,
+            **options,
+            **kwargs
+        )
+    except ComputationCancelled:
+        raise
+    except Exception as e:
+        # A failing patch is recorded and does not prevent the other ones from being written
+        profiler.log(traceback.format_exc())
+        method["error"] = _error_message(name, e, log=profiler.log)
+        return method
+    method["results"] = dict(
+        spectra=spectra, spec_name_list=spec_name_list, lb=lb, ps=ps_dict, cov=cov_dict
+    )
+    method["profile_report"] = profiler.report
+    return method
+
+
+def _compute_group(names, patches, maps_info_list, kwargs, cache, **options):
+    # Patches of a group are computed one after the other so that they share their mode coupling
+    return {
+        name: compute_patch(name, patches[name], maps_info_list, kwargs[name], cache, **options)
+        for name in names
+    }
+
+
+def _window_hash(patch_dict, maps_info_list, kwargs):
+    # Digest of the window of the patch up to a translation in right ascension, None if the
+    # window can not be created
+    try:
+        with Profiler(verbose=False, keep_records=False):
+            _, window, _ = create_window(
+                patch_dict,
+                maps_info_list,
+                galactic_mask=kwargs.get("galactic_mask"),
+                source_mask=kwargs.get("source_mask"),
+                compute_T_only=kwargs.get("compute_T_only", False),
+                use_kspace_filter=kwargs.get("vk_mask") is not None
+                or kwargs.get("hk_mask") is not None,
+            )
+    except Exception:
+        return None
+    return hash_window(window)
+
+
+def _group_patches(hashes):
+    # Group the patches with the same window, each group being computed by a single process
+    groups = {}
+    for name in sorted(hashes):
+        key = hashes[name] if hashes[name] is not None else ("patch", name)
+        groups.setdefault(key, []).append(name)
+    return list(groups.values())
+
+
+def _error_message(name, error, log=print):
+    message = "{}: {}".format(type(error).__name__, error)
+    log("Computation of patch '{}' failed with {}".format(name, message))
+    return message
+
+
+def compute_spectra(
+    config,
+    patches,
+    output_file,
+    ps_method="master",
+    lmax=None,
+    bin_size=None,
+    compute_T_only=None,
+    use_toeplitz=None,
+    use_kspace_filter=None,
+    n_workers=None,
+    cache_dir=None,
+):
+    """Compute power spectra and covariances over a list of patches
+
+    Patches with the same window up to a translation in right ascension are computed one after
+    the other by the same process, so that their mode coupling is only computed once even without
+    an on-disk cache. A patch whose computation fails is written with the error message in place
+    of its results, the other patches being computed and written as usual.
+
+    Parameters
+    ----------
+    config: string or dict
+      the psplay configuration (or the name of the YAML file holding it). Maps and masks are read
+      from the 'data' section while default computation options are read from the 'plot' section
+    patches: string or dict
+      the name of a GeoJSON or YAML file holding the patches or a dictionary of pstools patch
+      dictionaries indexed by their names. If None, patches are read from the 'patches' section
+      of the configuration
+    output_file: string
+      the name of the output HDF5 file
+    ps_method: string
+      the method for the computation of the power spectrum
+    lmax: integer
+      the maximum multipole to consider for the spectra computation
+    bin_size: integer
+      the bin size if no binning file is given in the data section
+    compute_T_only: boolean
+      True to compute only T spectra
+    use_toeplitz: boolean
+      use the Toeplitz approximation of the mode coupling matrices
+    use_kspace_filter: boolean
+      apply the kspace filter defined in the data section
+    n_workers: integer
+      the number of worker processes. With MPI, each process computes its share of the patches
+      with n_workers processes, otherwise patches are computed by a pool of n_workers processes
+    cache_dir: string
+      the directory of the on-disk cache of mode coupling matrices
+    """
+    if not isinstance(config, dict):
+        with open(config, "r") as stream:
+            config = yaml.load(stream, Loader=yaml.FullLoader)
+    data_config = utils.get_section(config, "data")
+    plot_config = config.get("plot", {})
+
+    if patches is None:
+        patches = utils.parse_patches(utils.get_section(config, "patches"))
+    elif isinstance(patches, str):
+        patches = utils.load_patches(patches)
+
+    def _get(value, key, default):
+        return value if value is not None else plot_config.get(key, default)
+
+    maps_info_list = utils.get_maps_info(data_config)
+    masks_info = utils.get_masks_info(data_config)
+    # Toeplitz settings depend on the patch size
+    kwargs = {
+        name: utils.get_compute_kwargs(
+            data_config,
+            masks_info,
+            ps_method=ps_method,
+            lmax=_get(lmax, "lmax", 1000),
+            bin_size=_get(bin_size, "bin_size", 40),
+            compute_T_only=_get(compute_T_only, "compute_only_temperature", False),
+            use_toeplitz=_get(use_toeplitz, "use_toeplitz_approx", False),
+            use_kspace_filter=_get(use_kspace_filter, "use_kspace_filter", False),
+            toeplitz=plot_config.get("toeplitz"),
+            patch=patch,
+        )
+        for name, patch in patches.items()
+    }
+    n_workers = _get(n_workers, "n_workers", None)
+
+    cache = None
+    cache_config = plot_config.get("cache") or {}
+    cache_dir = cache_dir or cache_config.get("directory")
+    if cache_dir is not None:
+        cache = DiskCache(cache_dir, max_size=cache_config.get("max_size"))
+
+    use_memmap = data_config.get("use_memmap", False)
+    comm = mpi.COMM_WORLD
+    names = sorted(patches)
+
+    # Patches with the same window up to a translation in right ascension are computed by the
+    # same process, one after the other, so that their mode coupling is only computed once
+    def _window_hashes(map_func, names):
+        if ps_method == "2dflat":
+            return {name: None for name in names}
+        args = [(patches[name], maps_info_list, kwargs[name]) for name in names]
+        return dict(zip(names, map_func(_window_hash, *zip(*args))))
+
+    results = {}
+    if mpi.disabled and n_workers is not None and n_workers > 1:
+        with ProcessPoolExecutor(max_workers=n_workers) as executor:
+            futures = {
+                tuple(group): executor.submit(
+                    _compute_group,
+                    group,
+                    {name: patches[name] for name in group},
+                    maps_info_list,
+                    kwargs,
+                    cache,
+                    use_memmap=use_memmap,
+                )
+                for group in _group_patches(_window_hashes(executor.map, names))
+            }
+            for group, future in futures.items():
+                try:
+                    results.update(future.result())
+                except Exception as e:
+                    # The worker itself failed, e.g. it was killed
+                    for name in group:
+                        results[name] = dict(results=None, error=_error_message(name, e))
+    else:
+        groups = [[name] for name in names]
+        if comm.size > 1:
+            # Each process creates its share of the windows and the groups are shared
+            hashes = {}
+            rank_hashes = _window_hashes(map, names[comm.rank::comm.size])
+            for rank_hashes in comm.allgather(rank_hashes):
+                hashes.update(rank_hashes)
+            groups = _group_patches(hashes)
+
+        # One pool of workers is shared by the patches of this process
+        executor = None
+        if n_workers is not None and n_workers > 1:
+            executor = ProcessPoolExecutor(max_workers=n_workers)
+        try:
+            for group in groups[comm.rank::comm.size]:
+                results.update(
+                    _compute_group(
+                        group,
+                        patches,
+                        maps_info_list,
+                        kwargs,
+                        cache,
+                        n_workers=n_workers,
+                        executor=executor,
+                        use_memmap=use_memmap,
+                    )
+                )
+        finally:
+            if executor is not None:
+                executor.shutdown()
+
+    if not mpi.disabled:
+        results = comm.gather(results, root=0)
+        if comm.rank != 0:
+            return None
+        results = {name: r for rank_results in results for name, r in rank_results.items()}
+
+    output = {}
+    for name in sorted(results):
+        output[name] = {"patch": patches[name], ps_method: dict(config=kwargs[name], **results[name])}
+    failed = [name for name in sorted(results) if results[name].get("error") is not None]
+    if failed:
+        print("Computation failed for patches {}".format(", ".join(failed)))
+    output_dir = os.path.dirname(output_file)
+    if output_dir:
+        os.makedirs(output_dir, exist_ok=True)
+    print("Writing '{}' file".format(output_file))
+    io.write_results(output_file, output)
+    return output
+
+
+def main():
+    import argparse
+
+    parser = argparse.ArgumentParser(
+        description="A python program to compute power spectra and covariances over many patches",
+        epilog="Run it with mpirun to distribute the patches over several MPI processes",
+    )
+    parser.add_argument(
+        "-c",
+        "--config",
+        help="YAML configuration file holding the 'data' section",
+        type=str,
+        required=True,
+        default=None,
+    )
+    parser.add_argument(
+        "-p",
+        "--patches",
+        help="GeoJSON or YAML file holding the patches (default use the 'patches' section)",
+        type=str,
+        default=None,
+    )
+    parser.add_argument(
+        "-o",
+        "--output-file",
+        help="output HDF5 file holding the spectra and covariances",
+        type=str,
+        required=True,
+        default=None,
+    )
+    parser.add_argument(
+        "--ps-method",
+        help="method for the computation of the power spectrum",
+        choices=["master", "pseudo", "2dflat"],
+        default="master",
+    )
+    parser.add_argument("--lmax", help="maximum multipole", type=int, default=None)
+    parser.add_argument("--bin-size", help="bin size", type=int, default=None)
+    parser.add_argument(
+        "--compute-T-only",
+        help="compute only temperature spectra",
+        action="store_true",
+        default=None,
+    )
+    parser.add_argument(
+        "--use-toeplitz",
+        help="use Toeplitz approximation for the mode coupling matrices",
+        action="store_true",
+        default=None,
+    )
+    parser.add_argument(
+        "--use-kspace-filter",
+        help="apply the kspace filter defined in the configuration",
+        action="store_true",
+        default=None,
+    )
+    parser.add_argument("--n-workers", help="number of worker processes", type=int, default=None)
+    parser.add_argument(
+        "--cache-dir", help="directory of the mode coupling matrices cache", type=str, default=None
+    )
+    args = parser.parse_args()
+
+    compute_spectra(
+        args.config,
+        args.patches,
+        args.output_file,
+        ps_method=args.ps_method,
+        lmax=args.lmax,
+        bin_size=args.bin_size,
+        compute_T_only=args.compute_T_only,
+        use_toeplitz=args.use_toeplitz,
+        use_kspace_filter=args.use_kspace_filter,
+        n_workers=args.n_workers,
+        cache_dir=args.cache_dir,
+    )
+
+
+# script:
+if __name__ == "__main__":
+    main()
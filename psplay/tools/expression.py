@@ -0,0 +1,221 @@
+import ast
+import os
+from concurrent.futures import ThreadPoolExecutor
+
+import numpy as np
+
+# Functions allowed in expressions, all of them being NumPy ufuncs
+functions = {
+    name: getattr(np, name)
+    for name in [
+        "abs",
+        "fabs",
+        "sign",
+        "sqrt",
+        "square",
+        "exp",
+        "expm1",
+        "log",
+        "log2",
+        "log10",
+        "log1p",
+        "sin",
+        "cos",
+        "tan",
+        "arcsin",
+        "arccos",
+        "arctan",
+        "arctan2",
+        "sinh",
+        "cosh",
+        "tanh",
+        "arcsinh",
+        "arccosh",
+        "arctanh",
+        "floor",
+        "ceil",
+        "minimum",
+        "maximum",
+    ]
+}
+constants = {"pi": np.pi, "e": np.e, "inf": np.inf, "nan": np.nan}
+
+# Functions also known by numexpr
+_numexpr_functions = {
+    "abs",
+    "sqrt",
+    "exp",
+    "expm1",
+    "log",
+    "log10",
+    "log1p",
+    "sin",
+    "cos",
+    "tan",
+    "arcsin",
+    "arccos",
+    "arctan",
+    "arctan2",
+    "sinh",
+    "cosh",
+    "tanh",
+    "arcsinh",
+    "arccosh",
+    "arctanh",
+    "floor",
+    "ceil",
+}
+
+_binary_operators = {
+    ast.Add: np.add,
+    ast.Sub: np.subtract,
+    ast.Mult: np.multiply,
+    ast.Div: np.true_divide,
+    ast.Pow: np.power,
+    ast.Mod: np.remainder,
+    ast.FloorDiv: np.floor_divide,
+}
+_unary_operators = {ast.USub: np.negative, ast.UAdd: np.positive}
+
+
+def _import_numexpr():
+    try:
+        import numexpr
+    except ImportError:
+        return None
+    return numexpr
+
+
+class Expression:
+    """A NumPy expression of the map 'm' such as 'log(abs(m))'
+
+    The expression is parsed once and only numbers, the 'pi', 'e', 'inf' and 'nan' constants,
+    arithmetic operators and the functions listed in expression.functions are allowed. It is
+    evaluated with numexpr when available, otherwise by blocks of the map with in-place ufuncs
+    so that temporaries never exceed a few blocks per thread.
+
+    Parameters
+    ----------
+    source: string
+      the expression
+    block_size: integer
+      the number of pixels evaluated at once
+    n_threads: integer
+      the number of threads evaluating the blocks (default the number of CPUs)
+    use_numexpr: boolean
+      use numexpr if it is installed and knows all the functions of the expression
+    """
+
+    def __init__(self, source, block_size=2**16, n_threads=None, use_numexpr=True):
+        self.source = source
+        self.block_size = block_size
+        self.n_threads = n_threads or os.cpu_count() or 1
+        try:
+            tree = ast.parse(source.strip(), mode="eval")
+        except SyntaxError as e:
+            raise ValueError("Invalid expression '{}': {}".format(source, e.msg))
+        self._names = set()
+        self._evaluate = self._compile(tree.body)
+        self._numexpr = None
+        if use_numexpr and self._names <= _numexpr_functions:
+            self._numexpr = _import_numexpr()
+
+    def _compile(self, node):
+        """Return a function evaluating the node over a block of the map
+
+        The function is called with the block and a buffer factory and returns either a scalar,
+        the block itself or a buffer owned by the caller that can be overwritten. Without buffer
+        factory, NumPy allocates the results.
+        """
+        if isinstance(node, ast.Constant) and isinstance(node.value, (int, float)):
+            if isinstance(node.value, bool):
+                raise ValueError("Unsupported constant in expression '{}'".format(self.source))
+            value = node.value
+            return lambda m, new: value
+        if isinstance(node, ast.Name):
+            if node.id == "m":
+                return lambda m, new: m
+            if node.id in constants:
+                value = constants[node.id]
+                return lambda m, new: value
+            raise ValueError("Unknown name '{}' in expression '{}'".format(node.id, self.source))
+        if isinstance(node, ast.BinOp) and type(node.op) in _binary_operators:
+            return self._ufunc(_binary_operators[type(node.op)], [node.left, node.right])
+        if isinstance(node, ast.UnaryOp) and type(node.op) in _unary_operators:
+            return self._ufunc(_unary_operators[type(node.op)], [node.operand])
+        if isinstance(node, ast.Call) and isinstance(node.func, ast.Name) and not node.keywords:
+            ufunc = functions.get(node.func.id)
+            if ufunc is None:
+                raise ValueError(
+                    "Unknown function '{}' in expression '{}'".format(node.func.id, self.source)
+                )
+            if len(node.args) != ufunc.nin:
+                raise ValueError(
+                    "Function '{}' takes {} argument(s) in expression '{}'".format(
+                        node.func.id, ufunc.nin, self.source
+                    )
+                )
+            self._names.add(node.func.id)
+            return self._ufunc(ufunc, node.args)
+        raise ValueError(
+            "Unsupported '{}' in expression '{}'".format(type(node).__name__, self.source)
+        )
+
+    def _ufunc(self, ufunc, args):
+        if ufunc is np.floor_divide:
+            # Not supported by numexpr
+            self._names.add("floor_divide")
+        evaluate_args = [self._compile(arg) for arg in args]
+
+        def evaluate(m, new):
+            values = [evaluate_arg(m, new) for evaluate_arg in evaluate_args]
+            if new is None or all(np.isscalar(v) for v in values):
+                return ufunc(*values)
+            # Overwrite a buffer of the arguments rather than allocating a new one
+            owned = [v for v in values if isinstance(v, np.ndarray) and v is not m]
+            return ufunc(*values, out=owned[0] if owned else new())
+
+        return evaluate
+
+    def result_type(self, dtype):
+        """Return the type of the expression evaluated over a map of the given type"""
+        with np.errstate(all="ignore"):
+            return np.asarray(self._evaluate(np.ones(1, dtype), None)).dtype
+
+    def _evaluate_block(self, m, out, dtype):
+        # Error states are thread local
+        with np.errstate(all="ignore"):
+            out[...] = self._evaluate(m, lambda: np.empty(m.shape, dtype))
+
+    def evaluate(self, m, inplace=False):
+        """Evaluate the expression over the map
+
+        Parameters
+        ----------
+        m: array
+          the map
+        inplace: boolean
+          store the result in m if it has the type of the result
+        """
+        m = np.asanyarray(m)
+        dtype = self.result_type(m.dtype)
+        if inplace and dtype == m.dtype and m.flags.c_contiguous:
+            out = m
+        else:
+            out = np.empty_like(m, dtype=dtype)
+        if self._numexpr is not None:
+            self._numexpr.set_num_threads(self.n_threads)
+            self._numexpr.evaluate(self.source, local_dict=dict(constants, m=m), out=out)
+            return out
+        flat_m, flat_out = m.reshape(-1), out.reshape(-1)
+        blocks = [slice(i, i + self.block_size) for i in range(0, flat_m.size, self.block_size)]
+        blocks = [(flat_m[block], flat_out[block]) for block in blocks]
+        if self.n_threads > 1 and len(blocks) > 1:
+            with ThreadPoolExecutor(max_workers=self.n_threads) as executor:
+                futures = [executor.submit(self._evaluate_block, bm, bo, dtype) for bm, bo in blocks]
+                for future in futures:
+                    future.result()
+        else:
+            for bm, bo in blocks:
+                self._evaluate_block(bm, bo, dtype)
+        return out
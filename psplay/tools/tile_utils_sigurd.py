@@ -1,4 +1,5 @@
 import glob
+import hashlib
 import os
 import re
 
@@ -6,15 +7,65 @@ import numpy as np
 
 from pixell import bunch, enmap, utils
 
+from ..cache import MemoryCache
+
 default_pathformat = "tile%(y)03d_%(x)03d.fits"
+default_cache_size = "1 GB"
+
+
+class TileCache(MemoryCache):
+    """A cache of the blocks of input tiles read by read_area, to be shared
+    by all the calls of a pass over a tiling so that each input tile is only
+    read once. The least recently used blocks are evicted once their total
+    size exceeds max_size, but the last block is always kept. hits and
+    misses count the lookups of blocks."""
+
+    def __init__(self, max_size=default_cache_size):
+        super().__init__(max_size)
+        self.hits = 0
+        self.misses = 0
+        self.geometries = {}
+
+    def get(self, key):
+        value = super().get(key)
+        if value is None:
+            self.misses += 1
+        else:
+            self.hits += 1
+        return value
+
+    def evict(self):
+        if self.max_size is None:
+            return
+        with self._lock:
+            total_size = sum(size for _, size in self._entries.values())
+            while total_size > self.max_size and len(self._entries) > 1:
+                _, (_, size) = self._entries.popitem(last=False)
+                total_size -= size
+
+    def __repr__(self):
+        return "TileCache: {} hits, {} misses, {:.1f} MB".format(
+            self.hits, self.misses, self.size / 1024 ** 2
+        )
 
 
 def leaftile(
-    idir, odir, tsize=675, comm=None, verbose=False, lrange=[0, -6], monolithic=False, slice=None
+    idir,
+    odir,
+    tsize=675,
+    comm=None,
+    verbose=False,
+    lrange=[0, -6],
+    monolithic=False,
+    slice=None,
+    preprocess=None,
+    cache=None,
 ):
     """Given a input directory containing a tiled dmap in standard
     ordering, outputs a leaflet-compatible hierarchy of tiles in
-    odir with tile size tsize."""
+    odir with tile size tsize. preprocess is applied to the input
+    data when building the base tiles, see read_area, and cache is
+    the TileCache used to read the input tiles."""
     # First create our base tiles. These have opposite y ordering than
     # dmap tiles, and may be different-sized.
     otilename = "tile_%(y)d_%(x)d.fits"
@@ -34,6 +85,8 @@ def leaftile(
         itile1=itile1,
         itile2=itile2,
         slice=slice,
+        preprocess=preprocess,
+        cache=cache,
     )
     # Then loop over the smaller levels
     for level in range(lrange[0] - 1, lrange[1], -1):
@@ -49,6 +102,246 @@ def leaftile(
         )
 
 
+def _write_tile(oname, omap):
+    enmap.write_map(oname, omap)
+
+
+def _leaf_geometry(ifile, tsize=675, slice=None, wrap=True):
+    """Return the geometry of the base tiles of leaftile for a monolithic
+    input map."""
+    otilesize = np.array([-tsize, tsize])
+    itile1, itile2, pixoff, otile1, otile2, ntile_wrap = _retile_geometry(
+        ifile, (0, 0), (1, 1), (np.pi / 2, -np.pi), otilesize, slice=slice
+    )
+    ishape, iwcs = enmap.read_map_geometry(ifile)
+    if slice:
+        ishape, iwcs = enmap.slice_geometry(ishape, iwcs, utils.parse_slice(slice))
+    isize = np.array(ishape[-2:])
+    ntile_phi = utils.nint(np.abs(360.0 / iwcs.wcs.cdelt[0]) / isize[1])
+
+    # Same overlap rule as read_area: the geometric range of tiles may hold
+    # tiles without any input pixel, e.g. beyond the poles
+    def overlaps(opix1, opix2):
+        ity = range(opix1[0] // isize[0], (opix2[0] - 1) // isize[0] + 1)
+        itx = range(opix1[1] // isize[1], (opix2[1] - 1) // isize[1] + 1)
+        return 0 in ity and any((x % ntile_phi if wrap else x) == 0 for x in itx)
+
+    # Base tiles holding input pixels and their x index once wrapped
+    tiles = {}
+    for oy in range(otile1[0], otile2[0]):
+        for ox in range(otile1[1], otile2[1]):
+            opix1 = np.array([oy, ox]) * otilesize + pixoff
+            opix2 = np.array([oy + 1, ox + 1]) * otilesize + pixoff
+            if overlaps(np.minimum(opix1, opix2), np.maximum(opix1, opix2)):
+                tiles[oy, ox] = ox % ntile_wrap if wrap else ox
+    if not tiles:
+        raise IOError("No tiles for map %s" % ifile)
+    keys = np.array([(oy, x) for (oy, ox), x in tiles.items()])
+    return bunch.Bunch(
+        itile1=itile1,
+        itile2=itile2,
+        pixoff=pixoff,
+        otilesize=otilesize,
+        tiles=tiles,
+        tile1=keys.min(axis=0),
+        tile2=keys.max(axis=0) + 1,
+    )
+
+
+def _read_leaf(ifile, geo, oy, ox, cache=None, slice=None, preprocess=None):
+    """Read the base tile (oy, ox) of a monolithic input map"""
+    # Our tile stretches from opix1:opix2 relative to the global input pixels
+    opix1 = np.array([oy, ox]) * geo.otilesize + geo.pixoff
+    opix2 = np.array([oy + 1, ox + 1]) * geo.otilesize + geo.pixoff
+    opix1, opix2 = np.minimum(opix1, opix2), np.maximum(opix1, opix2)
+    return read_area(
+        ifile,
+        [opix1, opix2],
+        itile1=geo.itile1,
+        itile2=geo.itile2,
+        cache=cache,
+        slice=slice,
+        preprocess=preprocess,
+    )
+
+
+def leafchecksums(ifiles, tsize=675, comm=None, slice=None, wrap=True, cache=None):
+    """Return the checksums of the pixels of the base tiles of leaftile
+    for a list of monolithic input maps sharing the same geometry, e.g. a
+    map and its mask, as a dictionary indexed by the (y, x) tile indices.
+    With mpi, each process returns the checksums of its share of the rows
+    of tiles."""
+    rank, size = (comm.rank, comm.size) if comm is not None else (0, 1)
+    geo = _leaf_geometry(ifiles[0], tsize=tsize, slice=slice, wrap=wrap)
+    if cache is None:
+        cache = TileCache()
+    checksums = {}
+    for (oy, ox), x in geo.tiles.items():
+        if oy % size != rank:
+            continue
+        sha = hashlib.sha1()
+        try:
+            for ifile in ifiles:
+                omap = _read_leaf(ifile, geo, oy, ox, cache=cache, slice=slice)
+                sha.update("{}{}".format(omap.dtype.str, omap.shape).encode())
+                sha.update(np.ascontiguousarray(omap).tobytes())
+        except (IOError, OSError):
+            continue
+        checksums[oy, x] = sha.hexdigest()
+    return checksums
+
+
+def leafpyramid(
+    ifile,
+    odir,
+    write=None,
+    tsize=675,
+    comm=None,
+    verbose=False,
+    lrange=[0, -6],
+    slice=None,
+    preprocess=None,
+    wrap=True,
+    dirty=None,
+    cache=None,
+):
+    """Same as leaftile for a monolithic input map, but all the levels are
+    built in memory during a single pass over the map. The base tiles are
+    produced row by row and, as soon as the two rows of base tiles below a
+    row of tiles of the next level are done, they are combined into it, and
+    so on, so that only a couple of rows of tiles per level are kept in memory.
+
+    write(oname, omap) is called for each tile, oname being the name of the
+    FITS file leaftile would write for the tile. By default, the FITS files
+    are written. With mpi, the tiles are split in blocks of columns, as small
+    as possible while keeping all the tasks busy, that are combined
+    independently. The few tiles of the coarser levels are then gathered and
+    combined by the first task.
+
+    If dirty is given, only the base tiles with (y, x) indices in dirty and
+    the tiles of the next levels covering them are built. The other tiles
+    needed to build them are read from the FITS files written by a previous
+    call, all the tiles being built if one of these files is missing. cache
+    is the TileCache used to read the input map."""
+    write = write or _write_tile
+    rank, size = (comm.rank, comm.size) if comm is not None else (0, 1)
+    otilename = "tile_%(y)d_%(x)d.fits"
+    combine, downsample, pad_to = 2, np.array([2, 2]), np.array([tsize, tsize])
+    geo = _leaf_geometry(ifile, tsize=tsize, slice=slice, wrap=wrap)
+    levels = list(range(lrange[0], lrange[1], -1))
+    # Blocks of columns are combined independently up to the level ksplit
+    ncol = geo.tile2[1] - geo.tile1[1]
+    ksplit = len(levels) - 1
+    while ksplit > 0 and -(-ncol // combine ** ksplit) < size:
+        ksplit -= 1
+
+    # Tile x of level k <= ksplit belongs to the block of columns x // (nblock >> k)
+    nblock = combine ** ksplit
+
+    def owned(k, x):
+        if k > ksplit:
+            return rank == 0
+        return (x // (nblock >> k)) % size == rank
+
+    def tile_name(k, y, x):
+        return "%s/%d/%s" % (odir, levels[k], otilename % {"y": y, "x": x})
+
+    # Range of tiles of each level, as combine_tiles would find them on disk
+    ranges = [(geo.tile1, geo.tile2)]
+    for k in range(1, len(levels)):
+        t1, t2 = ranges[-1]
+        ranges.append((t1 // combine, (t2 - 1) // combine + 1))
+    pending = [{} for level in levels]
+
+    # The tiles of a previous call combined with the rebuilt ones must all be on disk, otherwise
+    # they would be replaced by zeros
+    if dirty is not None:
+        existing = set((oy, x) for (oy, ox), x in geo.tiles.items())
+        rebuilt = existing & set(dirty)
+        for k in range(len(levels) - 1):
+            parents = set((y // combine, x // combine) for y, x in rebuilt)
+            missing = [
+                (y, x)
+                for py, px in sorted(parents)
+                for y in range(py * combine, (py + 1) * combine)
+                for x in range(px * combine, (px + 1) * combine)
+                if (y, x) in existing - rebuilt and not os.path.exists(tile_name(k, y, x))
+            ]
+            if missing:
+                if rank == 0:
+                    print("Missing tile %s, rebuilding all tiles" % tile_name(k, *missing[0]))
+                dirty = None
+                break
+            existing = set((y // combine, x // combine) for y, x in existing)
+            rebuilt = parents
+
+    def emit(k, y, row):
+        for x, omap in row.items():
+            oname = tile_name(k, y, x)
+            utils.mkdir(os.path.dirname(oname))
+            write(oname, omap)
+            if verbose:
+                print(oname)
+        if k + 1 == len(levels):
+            return
+        # Wait for the last row of tiles below the next row of the next level
+        t2, (pt1, pt2) = ranges[k][1], ranges[k + 1]
+        pending[k][y] = row
+        py = y // combine
+        if y != min((py + 1) * combine, t2[0]) - 1:
+            return
+        rows = {iy: pending[k].pop(iy, {}) for iy in range(py * combine, (py + 1) * combine)}
+        if k == ksplit and size > 1:
+            # All the tasks reach this point for the same rows
+            gathered = comm.gather(rows, root=0)
+            if rank != 0:
+                return
+            rows = {iy: {x: m for r in gathered for x, m in r[iy].items()} for iy in rows}
+        prow = {}
+        for px in range(pt1[1], pt2[1]):
+            if not owned(k + 1, px):
+                continue
+            # Same selection of tiles as combine_tiles
+            tiles = [
+                [(iy, ix) for ix in range(px * combine, (px + 1) * combine) if ix < t2[1]]
+                for iy in sorted(rows)
+                if iy < t2[0]
+            ]
+            ref = next((rows[iy][ix] for cols in tiles for iy, ix in cols if ix in rows[iy]), None)
+            # Tiles without any new tile below them are left untouched
+            if ref is None:
+                continue
+            # Missing tiles are read from a previous call or are not part of the tiling
+            for cols in tiles:
+                for i, (iy, ix) in enumerate(cols):
+                    if ix in rows[iy]:
+                        cols[i] = rows[iy][ix]
+                    elif dirty is not None and os.path.exists(tile_name(k, iy, ix)):
+                        cols[i] = enmap.read_map(tile_name(k, iy, ix))
+                    else:
+                        cols[i] = enmap.zeros(ref.shape, ref.wcs, ref.dtype)
+            prow[px] = _combine_maps(tiles, downsample, pad_to=pad_to, tyflip=True)
+        emit(k + 1, py, prow)
+
+    if cache is None:
+        cache = TileCache()
+    for oy in range(geo.tile1[0], geo.tile2[0]):
+        row = {}
+        for ox in [ox for (ty, ox) in geo.tiles if ty == oy]:
+            x = geo.tiles[oy, ox]
+            if not owned(0, x) or (dirty is not None and (oy, x) not in dirty):
+                continue
+            try:
+                row[x] = _read_leaf(
+                    ifile, geo, oy, ox, cache=cache, slice=slice, preprocess=preprocess
+                )
+            except (IOError, OSError):
+                continue
+        emit(0, oy, row)
+    if verbose:
+        print(cache)
+
+
 def combine_tiles(
     ipathfmt,
     opathfmt,
@@ -113,22 +406,7 @@ def combine_tiles(
             if txflip:
                 cols = cols[::-1]
             rows.append(cols)
-        # Stack them next to each other into a big tile
-        if tyflip:
-            rows = rows[::-1]
-        omap = enmap.tile_maps(rows)
-        # Downgrade if necessary
-        if np.any(downsample > 1):
-            omap = enmap.downgrade(omap, downsample)
-        if pad_to is not None:
-            # Padding happens towards the end of the tiling,
-            # which depends on the flip status
-            padding = np.array([[0, 0], [pad_to[0] - omap.shape[-2], pad_to[1] - omap.shape[-1]]])
-            if tyflip:
-                padding[:, 0] = padding[::-1, 0]
-            if txflip:
-                padding[:, 1] = padding[::-1, 1]
-            omap = enmap.pad(omap, padding)
+        omap = _combine_maps(rows, downsample, pad_to=pad_to, tyflip=tyflip, txflip=txflip)
         # And output
         otname = opathfmt % {"y": oy, "x": ox}
         utils.mkdir(os.path.dirname(otname))
@@ -137,6 +415,58 @@ def combine_tiles(
             print(otname)
 
 
+def _combine_maps(rows, downsample, pad_to=None, tyflip=False, txflip=False):
+    """Stack a list of lists of tiles (already flipped in x) into a big
+    tile, downsample and pad it."""
+    # Stack them next to each other into a big tile
+    if tyflip:
+        rows = rows[::-1]
+    omap = enmap.tile_maps(rows)
+    # Downgrade if necessary
+    if np.any(downsample > 1):
+        omap = enmap.downgrade(omap, downsample)
+    if pad_to is not None:
+        # Padding happens towards the end of the tiling,
+        # which depends on the flip status
+        padding = np.array([[0, 0], [pad_to[0] - omap.shape[-2], pad_to[1] - omap.shape[-1]]])
+        if tyflip:
+            padding[:, 0] = padding[::-1, 0]
+        if txflip:
+            padding[:, 1] = padding[::-1, 1]
+        omap = enmap.pad(omap, padding)
+    return omap
+
+
+def _retile_geometry(ipathfmt, itile1, itile2, ocorner, otilesize, slice=None):
+    """Return the range of input tiles, the pixel position of the output corner,
+    the range of output tiles and the number of output tiles around the sky."""
+    # Find the range of input tiles
+    itile1, itile2 = find_tile_range(ipathfmt, itile1, itile2)
+    # To fill in the rest of the information we need to know more
+    # about the input tiling, so read the geometry of the first tile
+    ishape, iwcs = enmap.read_map_geometry(ipathfmt % {"y": itile1[0], "x": itile1[1]})
+    if slice:
+        ishape, iwcs = enmap.slice_geometry(ishape, iwcs, utils.parse_slice(slice))
+    itilesize = ishape[-2:]
+    ixres = iwcs.wcs.cdelt[0]
+    nphi = utils.nint(360 / np.abs(ixres))
+    ntile_wrap = nphi // otilesize[1]
+    # Find the pixel position of our output corners according to the wcs.
+    # This is the last place we need to do a coordinate transformation.
+    # All the rest can be done in pure pixel logic.
+    pixoff = np.round(enmap.sky2pix(ishape, iwcs, ocorner)).astype(int)
+
+    # Find the range of output tiles
+    def pix2otile(pix, ioff, osize):
+        return (pix - ioff) // osize
+
+    otile1 = pix2otile(itile1 * itilesize, pixoff, otilesize)
+    otile2 = pix2otile(itile2 * itilesize - 1, pixoff, otilesize)
+    otile1, otile2 = np.minimum(otile1, otile2), np.maximum(otile1, otile2)
+    otile2 += 1
+    return itile1, itile2, pixoff, otile1, otile2, ntile_wrap
+
+
 def retile(
     ipathfmt,
     opathfmt,
@@ -150,6 +480,8 @@ def retile(
     verbose=False,
     slice=None,
     wrap=True,
+    preprocess=None,
+    cache=None,
 ):
     """Given a set of tiles on disk with locations ipathfmt % {"y":...,"x":...},
     retile them into a new tiling and write the result to opathfmt % {"y":...,"x":...}.
@@ -161,7 +493,11 @@ def retile(
     The output tiling will logically cover the whole sky, but only output tiles
     that overlap with input tiles will actually be written. This can be modified
     by using otileoff[2] and otilenum[2]. otileoff gives the tile indices of the
-    corner tile, while otilenum indicates the number of tiles to write."""
+    corner tile, while otilenum indicates the number of tiles to write.
+
+    Input tiles are read through cache, a TileCache shared by the output
+    tiles, so that they are read once as long as the cache budget holds the
+    input tiles overlapping a row of output tiles."""
     # Set up mpi
     rank, size = (comm.rank, comm.size) if comm is not None else (0, 1)
     # Expand any scalars
@@ -169,32 +505,12 @@ def retile(
         otilesize = (675, 675)
     otilesize = np.zeros(2, int) + otilesize
     otileoff = np.zeros(2, int) + otileoff
-    # Find the range of input tiles
-    itile1, itile2 = find_tile_range(ipathfmt, itile1, itile2)
-    # To fill in the rest of the information we need to know more
-    # about the input tiling, so read the first tile
-    ibase = enmap.read_map(ipathfmt % {"y": itile1[0], "x": itile1[1]})
-    if slice:
-        ibase = eval("ibase" + slice)
-    itilesize = ibase.shape[-2:]
-    ixres = ibase.wcs.wcs.cdelt[0]
-    nphi = utils.nint(360 / np.abs(ixres))
-    ntile_wrap = nphi // otilesize[1]
-    # Find the pixel position of our output corners according to the wcs.
-    # This is the last place we need to do a coordinate transformation.
-    # All the rest can be done in pure pixel logic.
-    pixoff = np.round(ibase.sky2pix(ocorner)).astype(int)
-
-    # Find the range of output tiles
-    def pix2otile(pix, ioff, osize):
-        return (pix - ioff) // osize
-
-    otile1 = pix2otile(itile1 * itilesize, pixoff, otilesize)
-    otile2 = pix2otile(itile2 * itilesize - 1, pixoff, otilesize)
-    otile1, otile2 = np.minimum(otile1, otile2), np.maximum(otile1, otile2)
-    otile2 += 1
+    itile1, itile2, pixoff, otile1, otile2, ntile_wrap = _retile_geometry(
+        ipathfmt, itile1, itile2, ocorner, otilesize, slice=slice
+    )
     # We can now loop over output tiles
-    cache = [None, None, None]
+    if cache is None:
+        cache = TileCache()
     oyx = [(oy, ox) for oy in range(otile1[0], otile2[0]) for ox in range(otile1[1], otile2[1])]
     for i in range(rank, len(oyx), size):
         otile = np.array(oyx[i])
@@ -206,7 +522,13 @@ def retile(
         opix1, opix2 = np.minimum(opix1, opix2), np.maximum(opix1, opix2)
         try:
             omap = read_area(
-                ipathfmt, [opix1, opix2], itile1=itile1, itile2=itile2, cache=cache, slice=slice
+                ipathfmt,
+                [opix1, opix2],
+                itile1=itile1,
+                itile2=itile2,
+                cache=cache,
+                slice=slice,
+                preprocess=preprocess,
             )
         except (IOError, OSError):
             continue
@@ -218,6 +540,8 @@ def retile(
         enmap.write_map(oname, omap)
         if verbose:
             print(oname)
+    if verbose:
+        print(cache)
 
 
 def read_monolithic(idir, verbose=True, slice=None, dtype=None):
@@ -315,8 +639,9 @@ def read_tileset_geometry(ipathfmt, itile1=(None, None), itile2=(None, None)):
     itile1, itile2 = find_tile_range(ipathfmt, itile1, itile2)
     mfile1 = ipathfmt % {"y": itile1[0], "x": itile1[1]}
     mfile2 = ipathfmt % {"y": itile2[0] - 1, "x": itile2[1] - 1}
-    m1 = enmap.read_map(mfile1)
-    m2 = m1 if mfile1 == mfile2 else enmap.read_map(mfile2)
+    # Only the headers are read
+    m1 = enmap.read_map(mfile1, delayed=True)
+    m2 = m1 if mfile1 == mfile2 else enmap.read_map(mfile2, delayed=True)
     wy, wx = m1.shape[-2:]
     oshape = tuple(np.array(m1.shape[-2:]) * (itile2 - itile1 - 1) + np.array(m2.shape[-2:]))
     return bunch.Bunch(
@@ -333,28 +658,38 @@ def read_area(
     cache=None,
     slice=None,
     wrap=True,
+    preprocess=None,
 ):
     """Given a set of tiles on disk with locations ipathfmt % {"y":...,"x":...},
     read the data corresponding to the pixel range opix[{from,to},{y,x}] in
-    the full map."""
+    the full map.
+
+    Only the rows of the input tiles overlapping the pixel range are read.
+    If given, preprocess(imap, rows) is applied to each block of rows read
+    from a tile, rows being the slice of the rows within the tile, and
+    returns the processed block. The processed blocks are kept in cache, a
+    TileCache shared by the calls reading the same tiling, so that they are
+    only read and processed once."""
     opix = np.asarray(opix)
+    if cache is None:
+        cache = TileCache(max_size=0)
     # Find the range of input tiles
     itile1, itile2 = find_tile_range(ipathfmt, itile1, itile2)
     # To fill in the rest of the information we need to know more
-    # about the input tiling, so read the first tile
-    if cache is None or cache[2] is None:
-        geo = read_tileset_geometry(ipathfmt, itile1=itile1, itile2=itile2)
-    else:
-        geo = cache[2]
-    if cache is not None:
-        cache[2] = geo
+    # about the input tiling, so read the geometry of the tiling
+    geo_key = (ipathfmt, tuple(itile1), tuple(itile2))
+    if geo_key not in cache.geometries:
+        cache.geometries[geo_key] = read_tileset_geometry(ipathfmt, itile1=itile1, itile2=itile2)
+    geo = cache.geometries[geo_key]
     # Determine tile wrapping
     npix_phi = np.abs(360.0 / geo.wcs.wcs.cdelt[0])
     ntile_phi = utils.nint(npix_phi / geo.tshape[-1])
 
     isize = geo.tshape
     osize = opix[1] - opix[0]
-    omap = enmap.zeros(geo.shape[:-2] + tuple(osize), geo.wcs, geo.dtype)
+    # The output map is allocated from the first processed block since
+    # slice and preprocess may change its components and type
+    omap = None
     # Find out which input tiles overlap with this output tile.
     # Our tile stretches from opix1:opix2 relative to the global input pixels
     it1 = opix[0] // isize
@@ -377,28 +712,34 @@ def read_area(
             overlap = range_overlap(opix[:, 1], [ipx1, ipx2])
             ox1, ox2 = overlap - opix[0, 1]
             ix1, ix2 = overlap - ipx1
-            # Read the input tile and copy over
+            # Read the overlapping rows of the input tile and copy over
             iname = ipathfmt % {"y": ity, "x": itx_wrap}
-            if cache is None or cache[0] != iname:
-                imap = enmap.read_map(iname)
+            key = (iname, iy1, iy2, slice, preprocess)
+            block = cache.get(key)
+            if block is None:
+                if verbose:
+                    print(iname)
+                itile = enmap.read_map(iname, delayed=True)
+                imap = itile[..., iy1:iy2, :]
                 if slice:
                     imap = eval("imap" + slice)
-            else:
-                imap = cache[1]
-            if cache is not None:
-                cache[0], cache[1] = iname, imap
-            if verbose:
-                print(iname)
+                if preprocess is not None:
+                    imap = preprocess(imap, np.s_[iy1:iy2])
+                block = dict(map=imap, tshape=np.array(itile.shape[-2:]))
+                cache.set(key, block)
+            imap, tshape = block["map"], block["tshape"]
+            if omap is None:
+                omap = enmap.zeros(imap.shape[:-2] + tuple(osize), geo.wcs, imap.dtype)
             # Edge input tiles may be smaller than the standard
             # size.
-            ysub = isize[0] - imap.shape[-2]
-            xsub = isize[1] - imap.shape[-1]
+            ysub = isize[0] - tshape[-2]
+            xsub = isize[1] - tshape[-1]
             # If the input map is too small, there may actually be
             # zero overlap.
             if oy2 - ysub <= oy1 or ox2 - xsub <= ox1:
                 continue
             # fmt: off
-            omap[..., oy1 : oy2 - ysub, ox1 : ox2 - xsub] = imap[..., iy1 : iy2 - ysub, ix1 : ix2 - xsub] # noqa
+            omap[..., oy1 : oy2 - ysub, ox1 : ox2 - xsub] = imap[..., : iy2 - ysub - iy1, ix1 : ix2 - xsub] # noqa
             # fmt: on
             noverlap += 1
     if noverlap == 0:
@@ -420,6 +761,7 @@ def read_retile(
     itile1=(None, None),
     itile2=(None, None),
     verbose=False,
+    cache=None,
 ):
     """Read a single tile from the tiling at ipathfmt % {"y":tpos[0],"x":tpos[1]},
     returning it as an enmap. If otilesize or pixoff are specified, then
@@ -427,7 +769,8 @@ def read_retile(
     which means that behind the scenes multiple tiles will be read and stitched
     together. If margin[{left,right},{y,x}] is not zero, then it specifies the
     number of pixels to extend the tile by. The tile will be extended with
-    data from the tiling, i.e. from the neighboring tiles."""
+    data from the tiling, i.e. from the neighboring tiles. cache is the
+    TileCache used by read_area."""
     if otilesize is None:
         geo = read_tileset_geometry(ipathfmt, itile1, itile2)
         otilesize = geo.tshape
@@ -437,7 +780,9 @@ def read_retile(
     pixbox = np.array([tpos * otilesize, (tpos + 1) * otilesize]) + pixoff
     pixbox[0] -= margin[0]
     pixbox[1] += margin[1]
-    return read_area(ipathfmt, pixbox, itile1=itile1, itile2=itile2, verbose=verbose)
+    return read_area(
+        ipathfmt, pixbox, itile1=itile1, itile2=itile2, verbose=verbose, cache=cache
+    )
 
 
 def retile_iterator(
@@ -449,12 +794,16 @@ def retile_iterator(
     itile2=(None, None),
     comm=None,
     verbose=False,
+    cache=None,
 ):
     """Iterator that yields a series of tiles from the tileset given by
     ipathfmt. See read_retile for how margin, otilesize and pixoff
-    allow you to iterate over a modified tiling. This currently just
-    calls read_area repeatedly, so it is not as efficient as it could have
-    been."""
+    allow you to iterate over a modified tiling. This calls read_area
+    repeatedly with a TileCache shared over the iteration, so that input
+    tiles are read once as long as the cache budget holds the input tiles
+    overlapping a row of output tiles."""
+    if cache is None:
+        cache = TileCache()
     # Handle mpi
     rank, nproc = (0, 1) if comm is None else (comm.rank, comm.size)
     # Find the number of tiles to iterate over
@@ -474,4 +823,5 @@ def retile_iterator(
             margin=margin,
             itile1=itile1,
             itile2=itile2,
+            cache=cache,
         )
@@ -0,0 +1,225 @@
+import os
+import tempfile
+
+import yaml
+from pspy import pspy_utils
+
+from .. import pstools, utils
+from ..cache import hash_window
+
+
+def _print_records(records):
+    print(
+        "{:>8} {:>8} {:>8} {:>10} {:>9} {:>10}".format(
+            "l_exact", "l_band", "l_toep", "time [s]", "speed-up", "max error"
+        )
+    )
+    for r in records:
+        print(
+            "{:>8} {:>8} {:>8} {:>10.2f} {:>9.2f} {:>10.2e}".format(
+                str(r["l_exact"]),
+                str(r["l_band"]),
+                str(r["l_toep"]),
+                r["wall_time"],
+                r["speedup"],
+                r["max_error"],
+            )
+        )
+
+
+def tune_toeplitz(
+    config,
+    patches=None,
+    output_config=None,
+    lmax=None,
+    bin_size=None,
+    compute_T_only=None,
+    tolerance=1e-3,
+    grid=None,
+):
+    """Tune the Toeplitz approximation of the mode coupling matrices over a list of patches
+
+    Each choice of (l_exact, l_band, l_toep) is evaluated against the exact mode coupling of every
+    patch. For each patch size (see utils.patch_size), the fastest choice meeting the tolerance for
+    all the patches of this size is stored, together with lmax and the patch size, in the
+    'toeplitz' list of the plot section of the configuration. Settings previously tuned for other
+    lmax or patch sizes are kept. Patches with the same window up to a translation in right
+    ascension are evaluated once.
+
+    Parameters
+    ----------
+    config: string or dict
+      the psplay configuration (or the name of the YAML file holding it)
+    patches: string or dict
+      the name of a GeoJSON or YAML file holding the patches or a dictionary of pstools patch
+      dictionaries indexed by their names. If None, patches are read from the 'patches' section
+      of the configuration
+    output_config: string
+      the name of the YAML file where to write the tuned configuration, it must differ from the
+      input configuration file
+    lmax: integer
+      the maximum multipole to consider for the spectra computation
+    bin_size: integer
+      the bin size if no binning file is given in the data section
+    compute_T_only: boolean
+      True to compute only T spectra
+    tolerance: float
+      the maximal relative error allowed on the inverse mode coupling matrices
+    grid: list of tuples
+      the (l_exact, l_band, l_toep) choices to evaluate, see pstools.tune_toeplitz
+
+    Return
+    ----------
+    The list of the selected Toeplitz settings
+    """
+    if isinstance(config, str) and output_config is not None:
+        if os.path.abspath(output_config) == os.path.abspath(config):
+            raise ValueError("The output configuration must not overwrite '{}'".format(config))
+    if not isinstance(config, dict):
+        with open(config, "r") as stream:
+            config = yaml.load(stream, Loader=yaml.FullLoader)
+    data_config = utils.get_section(config, "data")
+    plot_config = config.setdefault("plot", {})
+
+    if patches is None:
+        patches = utils.parse_patches(utils.get_section(config, "patches"))
+    elif isinstance(patches, str):
+        patches = utils.load_patches(patches)
+
+    lmax = lmax if lmax is not None else plot_config.get("lmax", 1000)
+    if compute_T_only is None:
+        compute_T_only = plot_config.get("compute_only_temperature", False)
+    maps_info_list = utils.get_maps_info(data_config)
+    masks_info = utils.get_masks_info(data_config)
+
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        binning_file = data_config.get("binning_file")
+        if binning_file is None:
+            bin_size = bin_size if bin_size is not None else plot_config.get("bin_size", 40)
+            binning_file = os.path.join(tmp_dir, "binning.dat")
+            pspy_utils.create_binning_file(bin_size=bin_size, n_bins=1000, file_name=binning_file)
+
+        windows = {}
+        for name in sorted(patches):
+            print("Create window of patch '{}'".format(name))
+            _, window, _ = pstools.create_window(
+                patches[name],
+                maps_info_list,
+                galactic_mask=masks_info.get("galactic"),
+                source_mask=masks_info.get("source"),
+                compute_T_only=compute_T_only,
+            )
+            size = round(utils.patch_size(patches[name]), 2)
+            windows.setdefault(hash_window(window), (name, window, size))
+
+        worst = {}
+        for name, window, size in windows.values():
+            print("Tune Toeplitz approximation for patch '{}'".format(name))
+            records = pstools.tune_toeplitz(
+                window,
+                "Dl",
+                lmax,
+                binning_file,
+                grid=grid,
+                beam_file=data_config.get("beam_file"),
+                compute_T_only=compute_T_only,
+            )
+            _print_records(records)
+            # Keep the worst speed-up and error of each choice over the patches of the same size
+            for r in records:
+                choice = (r["l_exact"], r["l_band"], r["l_toep"])
+                w = worst.setdefault(size, {}).setdefault(choice, dict(r))
+                w["wall_time"] = max(w["wall_time"], r["wall_time"])
+                w["speedup"] = min(w["speedup"], r["speedup"])
+                w["max_error"] = max(w["max_error"], r["max_error"])
+
+    selected = []
+    for size in sorted(worst):
+        toeplitz = pstools.select_toeplitz(list(worst[size].values()), tolerance=tolerance)
+        if toeplitz["l_exact"] is None:
+            print(
+                "No Toeplitz approximation meets the {:.1e} tolerance".format(tolerance),
+                "for patches of size {} deg".format(size),
+            )
+            continue
+        best = worst[size][tuple(toeplitz.values())]
+        print(
+            "Select (l_exact, l_band, l_toep) = ({l_exact}, {l_band}, {l_toep})".format(**toeplitz),
+            "for patches of size {} deg".format(size),
+            "with speed-up {:.2f} and max error {:.2e}".format(best["speedup"], best["max_error"]),
+        )
+        entry = dict(lmax=int(lmax), patch_size=float(size))
+        selected += [dict(entry, **{k: int(v) for k, v in toeplitz.items()})]
+
+    # Settings tuned for other lmax or patch sizes are kept
+    keys = [(entry["lmax"], entry["patch_size"]) for entry in selected]
+    previous = plot_config.get("toeplitz") or []
+    previous = [entry for entry in previous if (entry["lmax"], entry["patch_size"]) not in keys]
+    plot_config["toeplitz"] = previous + selected
+
+    if output_config is not None:
+        print("Writing '{}' file".format(output_config))
+        with open(output_config, "w") as f:
+            yaml.dump(config, f, sort_keys=False)
+    return selected
+
+
+def main():
+    import argparse
+
+    parser = argparse.ArgumentParser(
+        description="A python program to tune the Toeplitz approximation of the mode coupling matrices"
+    )
+    parser.add_argument(
+        "-c",
+        "--config",
+        help="YAML configuration file holding the 'data' section",
+        type=str,
+        required=True,
+        default=None,
+    )
+    parser.add_argument(
+        "-p",
+        "--patches",
+        help="GeoJSON or YAML file holding the patches (default use the 'patches' section)",
+        type=str,
+        default=None,
+    )
+    parser.add_argument(
+        "-o",
+        "--output-config",
+        help="output YAML configuration file, it must differ from the input one",
+        type=str,
+        required=True,
+        default=None,
+    )
+    parser.add_argument("--lmax", help="maximum multipole", type=int, default=None)
+    parser.add_argument("--bin-size", help="bin size", type=int, default=None)
+    parser.add_argument(
+        "--compute-T-only",
+        help="compute only temperature spectra",
+        action="store_true",
+        default=None,
+    )
+    parser.add_argument(
+        "--tolerance",
+        help="maximal relative error on the inverse mode coupling matrices",
+        type=float,
+        default=1e-3,
+    )
+    args = parser.parse_args()
+
+    tune_toeplitz(
+        args.config,
+        args.patches,
+        output_config=args.output_config,
+        lmax=args.lmax,
+        bin_size=args.bin_size,
+        compute_T_only=args.compute_T_only,
+        tolerance=args.tolerance,
+    )
+
+
+# script:
+if __name__ == "__main__":
+    main()
@@ -112,10 +112,41 @@ def unpack(imap):
     return omap, mask
 
 
-def plot(args):
+def write(ifile, imap, args):
+    """Write the quantized PNG files of a map
+
+    Parameters
+    ----------
+    ifile: string
+      the name of the FITS file of the map, PNG files are named after it
+    imap: enmap
+      the map
+    args: bunch
+      the webplot options (see parse_args)
+    """
+
     def get_num_digits(n):
         return int(np.log10(n)) + 1
 
+    N = imap.shape[:-2]
+    ndigits = [get_num_digits(n) for n in N]
+    for i, map in enumerate(imap.preflat):
+        I = np.unravel_index(i, N) if len(N) > 0 else []  # noqa
+        comp = (
+            "_" + "_".join(["%0*d" % (ndig, ind) for ndig, ind in zip(ndigits, I)])
+            if len(N) > 0
+            else ""
+        )
+        ofile = ifile[:-5] + args.suffix + comp + args.ext
+
+        # Quantize it
+        mask = map == args.mask
+        qmap = pack(map, mask, nbyte=args.nbyte, quantum=args.quantum)
+        img = Image.fromarray(qmap, mode="L")
+        img.save(ofile)
+
+
+def plot(args):
     comm = mpi.COMM_WORLD
     ifiles = sum([sorted(glob.glob(ifile)) for ifile in args.ifiles], [])
 
@@ -123,21 +154,4 @@ def plot(args):
         ifile = ifiles[ind]
         if args.verbose > 0:
             print(ifile)
-        imap = enmap.read_map(ifile)
-
-        N = imap.shape[:-2]
-        ndigits = [get_num_digits(n) for n in N]
-        for i, map in enumerate(imap.preflat):
-            I = np.unravel_index(i, N) if len(N) > 0 else []  # noqa
-            comp = (
-                "_" + "_".join(["%0*d" % (ndig, ind) for ndig, ind in zip(ndigits, I)])
-                if len(N) > 0
-                else ""
-            )
-            ofile = ifile[:-5] + args.suffix + comp + args.ext
-
-            # Quantize it
-            mask = map == args.mask
-            qmap = pack(map, mask, nbyte=args.nbyte, quantum=args.quantum)
-            img = Image.fromarray(qmap, mode="L")
-            img.save(ofile)
+        write(ifile, enmap.read_map(ifile), args)
@@ -1,8 +1,10 @@
+import json
 from copy import deepcopy
 from itertools import product
 
 import matplotlib.pyplot as plt
 import numpy as np
+import yaml
 
 from pixell import colorize
 
@@ -131,6 +133,175 @@ def get_tiles(layers):
     return tiles, keybindings
 
 
+def get_section(section, name):
+    """Return the mandatory entry name of a configuration section"""
+    # Python 3.8 if not value := section.get(name):
+    value = section.get(name)
+    if not value:
+        raise ValueError("Missing '{}' section".format(name))
+    return value
+
+
+def get_maps_info(data_config):
+    """ Fonction that converts the maps of the data section into a list of maps info """
+    maps_info_list = []
+    for imap in data_config.get("maps", []):
+        maps_info_list.append(
+            dict(
+                id=get_section(imap, "id"),
+                name=get_section(imap, "file"),
+                data_type=imap.get("data_type", "IQU"),
+                cal=imap.get("cal"),
+            )
+        )
+    return maps_info_list
+
+
+def get_masks_info(data_config):
+    """ Fonction that converts the masks of the data section into a dictionary of masks info """
+    masks_info = {}
+    for imask in data_config.get("masks", []):
+        mask_info = dict(name=get_section(imask, "file"))
+        apodization = imask.get("apodization")
+        if apodization:
+            mask_info.update(
+                dict(
+                    apo_type=apodization.get("type", "C1"),
+                    apo_radius=apodization.get("radius", 0.3),
+                )
+            )
+        masks_info[get_section(imask, "type")] = mask_info
+    return masks_info
+
+
+# Default settings of the Toeplitz approximation of the mode coupling matrices
+default_toeplitz = dict(l_exact=800, l_band=2000, l_toep=2500)
+
+
+def patch_size(patch):
+    """Return the largest extent in degrees of a pstools patch dictionary"""
+    if patch["patch_type"] == "Disk":
+        return 2.0 * patch["radius"]
+    coordinates = np.array(patch["patch_coordinate"], dtype=float)
+    return float(np.max(np.abs(coordinates[1] - coordinates[0])))
+
+
+def get_toeplitz(toeplitz, lmax, patch=None):
+    """Return the Toeplitz approximation settings for a maximum multipole and a patch
+
+    Parameters
+    ----------
+    toeplitz: list of dicts
+      the settings tuned by psplay-tune-toeplitz (i.e. the 'toeplitz' entry of the plot section)
+      for given 'lmax' and 'patch_size' values
+    lmax: integer
+      the maximum multipole to consider for the spectra computation
+    patch: dict
+      the pstools patch dictionary, the settings tuned for the closest patch size are used
+
+    Return
+    ----------
+    The settings tuned for lmax or the ``default_toeplitz`` ones if there are none
+    """
+    entries = [entry for entry in toeplitz or [] if entry["lmax"] == lmax]
+    if not entries:
+        return dict(default_toeplitz)
+    if patch is not None:
+        size = patch_size(patch)
+        entries = sorted(entries, key=lambda entry: abs(entry["patch_size"] - size))
+    return {key: entries[0][key] for key in default_toeplitz}
+
+
+def get_compute_kwargs(
+    data_config,
+    masks_info,
+    ps_method="master",
+    lmax=1000,
+    bin_size=40,
+    compute_T_only=False,
+    use_toeplitz=False,
+    use_kspace_filter=False,
+    toeplitz=None,
+    patch=None,
+):
+    """Fonction that builds the arguments of pstools.compute_ps from the data section
+
+    The Toeplitz approximation settings are read from the toeplitz list (i.e. the 'toeplitz'
+    entry of the plot section as tuned by psplay-tune-toeplitz) for lmax and the size of the
+    patch, see get_toeplitz
+    """
+    kwargs = dict(ps_method=ps_method, lmax=lmax)
+    if data_config.get("use_pyramid", False):
+        kwargs.update(use_pyramid=True)
+    if ps_method == "2dflat":
+        return kwargs
+
+    kwargs.update(
+        dict(
+            error_method="master",
+            binning_file=data_config.get("binning_file"),
+            bin_size=bin_size,
+            beam_file=data_config.get("beam_file"),
+            source_mask=masks_info.get("source"),
+            galactic_mask=masks_info.get("galactic"),
+            compute_T_only=compute_T_only,
+        )
+    )
+    toeplitz = get_toeplitz(toeplitz, lmax, patch)
+    for key in default_toeplitz:
+        kwargs[key] = toeplitz[key] if use_toeplitz else None
+    if use_kspace_filter:
+        filter_config = get_section(data_config, "filter")
+        kwargs.update(
+            dict(
+                vk_mask=filter_config.get("vk_mask"),
+                hk_mask=filter_config.get("hk_mask"),
+                transfer_function=filter_config.get("transfer_function"),
+            )
+        )
+    return kwargs
+
+
+def load_patches(file_name):
+    """ Fonction that reads a list of patches from a GeoJSON or a YAML file
+
+    GeoJSON files hold a feature collection as exported from the map drawing tools. YAML files hold
+    a list of patches either as GeoJSON features or as pstools patch dictionaries (with
+    patch_type key). Each patch can be named with a 'name' entry (or a 'name' property for
+    features).
+
+    Return
+    ----------
+    A dictionary of pstools patch dictionaries indexed by their names
+    """
+    with open(file_name, "r") as stream:
+        if file_name.endswith((".json", ".geojson")):
+            content = json.load(stream)
+        else:
+            content = yaml.load(stream, Loader=yaml.FullLoader)
+    return parse_patches(content)
+
+
+def parse_patches(content):
+    """ Fonction that converts a GeoJSON feature collection or a list of patches into a dictionary
+    of pstools patch dictionaries indexed by their names (see load_patches) """
+    if isinstance(content, dict):
+        content = content.get("features", content.get("patches", [content]))
+
+    patches = {}
+    for ipatch, patch in enumerate(content):
+        if "geometry" in patch:
+            name = (patch.get("properties") or {}).get("name")
+            patch_dict = build_patch_geometry(patch)
+        else:
+            patch_dict = dict(patch)
+            name = patch_dict.pop("name", None)
+            if patch_dict.get("patch_type") not in ["Rectangle", "Disk"]:
+                raise ValueError("Unknown patch type for patch '{}'".format(patch))
+        patches[name or "patch{}".format(ipatch)] = patch_dict
+    return patches
+
+
 def build_patch_geometry(patch):
     def parse_rectangle(coordinates):
         return [coordinates[0][0][::-1], coordinates[0][2][::-1]]
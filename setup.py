@@ -150,6 +150,7 @@ setup_args = {
     "include_package_data": True,
     "data_files": get_data_files(),
     "install_requires": [
+        "h5py",
         "ipyleaflet>=0.13.0",
         "pspy>=1.3.2",
         "plotly>=4.6.0",
@@ -184,7 +185,11 @@ setup_args = {
     "entry_points": {
         "console_scripts": [
             "car2tiles=psplay.tools.car2tiles:main",
+            "car2pyramid=psplay.tools.car2pyramid:main",
             "healpix2car=psplay.tools.healpix2car:main",
+            "psplay-compute=psplay.tools.compute_spectra:main",
+            "psplay-benchmark=psplay.tools.benchmark:main",
+            "psplay-tune-toeplitz=psplay.tools.tune_toeplitz:main",
         ],
     },
 }
@@ -0,0 +1,20 @@
+import os
+
+import numpy as np
+
+from psplay import cache
+
+
+def test_disk_cache_entry_evicted_while_read(tmp_path, monkeypatch):
+    disk_cache = cache.DiskCache(str(tmp_path))
+    disk_cache.set("key", dict(a=np.arange(3)))
+
+    # Another process removes the entry once it has been read
+    def _utime(path):
+        os.remove(path)
+        raise FileNotFoundError(path)
+
+    monkeypatch.setattr(cache.os, "utime", _utime)
+    np.testing.assert_array_equal(disk_cache.get("key")["a"], np.arange(3))
+    assert disk_cache.get("key") is None
+    disk_cache.remove("key")
@@ -0,0 +1,103 @@
+import numpy as np
+import pytest
+
+from psplay.tools.expression import Expression, constants, functions
+
+sources = [
+    "m",
+    "log(abs(m))",
+    "m**2 + 3 * m - 1",
+    "-m % 3 + m // 2",
+    "arctan2(m, 2) / pi",
+    "maximum(m, 0) * sqrt(abs(m))",
+    "exp(-m) + floor(m) - ceil(m)",
+    "2**m",
+]
+
+
+def _numpy_evaluate(source, m):
+    with np.errstate(all="ignore"):
+        return eval(source, {"__builtins__": {}}, dict(functions, **constants, m=m))
+
+
+def _map(dtype=np.float64):
+    m = np.random.default_rng(0).normal(scale=3, size=(3, 100, 301)).astype(dtype)
+    m[0, 0, :3] = [0, np.nan, np.inf]
+    return m
+
+
+@pytest.mark.parametrize(
+    "source",
+    [
+        "x",
+        "m + y",
+        "__builtins__",
+        "m.T",
+        "m.real",
+        "np.log(m)",
+        "m[0]",
+        "m[::2]",
+        "eval('m')",
+        "__import__('os')",
+        "sum(m)",
+        "m.sum()",
+        "log(m, out=m)",
+        "log(m, m)",
+        "(lambda: m)()",
+        "m if m else 1",
+        "m > 0",
+        "True",
+        "'m'",
+        "m; m",
+    ],
+)
+def test_rejected_expressions(source):
+    with pytest.raises(ValueError):
+        Expression(source)
+
+
+@pytest.mark.parametrize("source", sources)
+@pytest.mark.parametrize("block_size, n_threads", [(2**16, 1), (1000, 4), (7, 3)])
+def test_same_as_numpy(source, block_size, n_threads):
+    m = _map()
+    expected = _numpy_evaluate(source, m)
+    expression = Expression(source, block_size=block_size, n_threads=n_threads, use_numexpr=False)
+    result = expression.evaluate(m)
+    assert result.dtype == expected.dtype
+    np.testing.assert_array_equal(result, expected)
+    # The map is left untouched and strided maps are evaluated as well
+    np.testing.assert_array_equal(m, _map())
+    np.testing.assert_array_equal(expression.evaluate(m[:, ::2, 1:]), expected[:, ::2, 1:])
+
+
+@pytest.mark.parametrize("source", sources)
+@pytest.mark.parametrize("dtype", [np.float32, np.float64, np.int32])
+def test_inplace_same_as_numpy(source, dtype):
+    if np.issubdtype(dtype, np.integer):
+        m = np.random.default_rng(0).integers(0, 10, size=(3, 100, 301)).astype(dtype)
+    else:
+        m = _map(dtype)
+    expected = _numpy_evaluate(source, m.copy())
+    result = Expression(source, block_size=1000, n_threads=4, use_numexpr=False).evaluate(
+        m, inplace=True
+    )
+    assert result.dtype == expected.dtype
+    np.testing.assert_array_equal(result, expected)
+    # The map is only overwritten if it can hold the result
+    assert (result is m) == (expected.dtype == dtype)
+
+
+@pytest.mark.parametrize("source", sources)
+def test_numexpr_same_as_numpy(source):
+    pytest.importorskip("numexpr")
+    m = _map()
+    expected = _numpy_evaluate(source, m)
+    expression = Expression(source)
+    if "//" in source:
+        # floor_divide is not known by numexpr
+        assert expression._numexpr is None
+    else:
+        assert expression._numexpr is not None
+    assert Expression(source, use_numexpr=False)._numexpr is None
+    np.testing.assert_allclose(expression.evaluate(m), expected, rtol=1e-12, atol=0)
+    np.testing.assert_allclose(expression.evaluate(m.copy(), inplace=True), expected, rtol=1e-12)
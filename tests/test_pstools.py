@@ -0,0 +1,166 @@
+import threading
+
+import numpy as np
+import pytest
+from pixell import enmap
+from pspy import flat_tools, sph_tools
+
+from psplay import pstools
+
+
+@pytest.mark.parametrize("dec_c", [0, 45, 60, 75])
+def test_disk_window_area(tmp_path, dec_c):
+    shape, wcs = enmap.fullsky_geometry(res=np.deg2rad(4 / 60))
+    name = str(tmp_path / "map.fits")
+    enmap.write_map(name, enmap.ones(shape, wcs))
+
+    center, radius = (dec_c, 30.0), 5.0
+    cutout = pstools.read_cutout(name, pstools.disk_box(center, radius))
+    mask = pstools.disk_mask(cutout.data.shape, cutout.data.wcs, center, radius)
+
+    # The disk must be fully contained in its box and have the area of a spherical cap
+    area = np.sum(mask * cutout.data.pixsizemap())
+    cap_area = 2 * np.pi * (1 - np.cos(np.deg2rad(radius)))
+    assert area == pytest.approx(cap_area, rel=5e-3)
+    assert not mask[:, 0].any() and not mask[:, -1].any()
+
+
+@pytest.mark.parametrize("factor", [2, 4])
+@pytest.mark.parametrize("periods", [(11, 23), (10.4, 23.3)])
+def test_unapply_downgrade_window(factor, periods):
+    # A wave averaged over blocks of pixels is damped by the ratio of the pixel windows, the
+    # cutout being periodic or not
+    shape, wcs = enmap.geometry(pos=np.deg2rad([[-8, -8], [8, 8]]), res=np.deg2rad(4 / 60))
+    y, x = np.indices(shape)
+    ky, kx = periods[0] / shape[0], periods[1] / shape[1]
+
+    def wave(y, x):
+        return np.cos(2 * np.pi * (ky * y + kx * x) + 0.3)
+
+    imap = enmap.downgrade(enmap.enmap(wave(y, x), wcs), factor)
+
+    # Once deconvolved, the downgraded map samples the wave at the centers of the blocks, without
+    # ringing from the edges
+    y, x = np.indices(imap.shape) * factor + (factor - 1) / 2
+    omap = pstools.unapply_downgrade_window(imap, factor)
+    assert omap.shape == imap.shape
+    assert np.abs(imap - wave(y, x))[10:-10, 10:-10].max() > 1e-2
+    np.testing.assert_allclose(omap[10:-10, 10:-10], wave(y, x)[10:-10, 10:-10], atol=1e-3)
+    assert np.all(np.abs(omap - wave(y, x)) <= np.abs(imap - wave(y, x)).max())
+
+
+def _previous_filtered_map(data, binary, vk_mask, hk_mask):
+    # Filter of psplay 1.x: unnormalized FFTs and real part of the filtered map
+    data = data * binary
+    ly, lx = data.lmap()[0][:, 0], data.lmap()[1][0, :]
+    ft = enmap.fft(data, normalize=False)
+    ft[..., np.where((lx > vk_mask[0]) & (lx < vk_mask[1]))[0]] = 0.0
+    ft[..., np.where((ly > hk_mask[0]) & (ly < hk_mask[1]))[0], :] = 0.0
+    return np.real(enmap.ifft(ft, normalize=False))
+
+
+@pytest.mark.parametrize("ps_method", ["master", "2dflat"])
+def test_kspace_filter_previous_values(tmp_path, ps_method):
+    shape, wcs = enmap.geometry(pos=np.deg2rad([[-5, -5], [5, 5]]), res=np.deg2rad(6 / 60))
+    rng = np.random.default_rng(0)
+    name = str(tmp_path / "split.fits")
+    enmap.write_map(name, enmap.enmap(rng.normal(size=shape), wcs))
+
+    car_box = [[-4, -4], [4, 4]]
+    split = pstools.read_cutout(name, car_box)
+    window, binary = split.copy(), split.copy()
+    window.data[:] = 1.0
+    binary.data[:] = rng.uniform(size=binary.data.shape) > 0.1
+    vk_mask, hk_mask = [-90, 90], [-50, 50]
+
+    maps_info_list = [dict(name=name, data_type="I", id="split", cal=2.0)]
+    _, (ht,) = pstools.get_transforms(
+        window,
+        maps_info_list,
+        car_box,
+        lmax=1000,
+        ps_method=ps_method,
+        compute_T_only=True,
+        vk_mask=vk_mask,
+        hk_mask=hk_mask,
+        binary=binary,
+    )
+
+    split.data = _previous_filtered_map(2.0 * split.data, binary.data, vk_mask, hk_mask)
+    if ps_method == "master":
+        expected = sph_tools.get_alms(split, window, niter=0, lmax=1050) / split.data.size
+        np.testing.assert_allclose(ht, expected, rtol=1e-8, atol=1e-8 * np.abs(expected).max())
+    else:
+        expected = flat_tools.get_ffts(split, window, 1000).kmap
+        np.testing.assert_allclose(ht.kmap, expected, rtol=1e-8, atol=1e-8 * np.abs(expected).max())
+
+
+def test_bin_size_change_reuses_mode_coupling(tmp_path, monkeypatch):
+    shape, wcs = enmap.geometry(pos=np.deg2rad([[-8, -8], [8, 8]]), res=np.deg2rad(10 / 60))
+    rng = np.random.default_rng(0)
+    maps_info_list = []
+    for i in range(2):
+        name = str(tmp_path / "split{}.fits".format(i))
+        enmap.write_map(name, enmap.enmap(rng.normal(size=shape), wcs))
+        maps_info_list += [dict(name=name, data_type="I", id="split{}".format(i), cal=None)]
+    patch = dict(patch_type="Rectangle", patch_coordinate=[[-5, -5], [5, 5]])
+
+    calls = []
+    compute_coupling = pstools._compute_coupling
+
+    def _counted_coupling(*args, **kwargs):
+        calls.append(args)
+        return compute_coupling(*args, **kwargs)
+
+    monkeypatch.setattr(pstools, "memory_cache", pstools.MemoryCache())
+    monkeypatch.setattr(pstools, "_compute_coupling", _counted_coupling)
+    monkeypatch.chdir(tmp_path)
+
+    kwargs = dict(compute_T_only=True, lmax=300, error_method=None)
+    pstools.compute_ps(patch, maps_info_list, bin_size=20, **kwargs)
+    spectra = pstools.compute_ps(patch, maps_info_list, bin_size=40, **kwargs)
+    assert len(calls) == 1
+
+    # Same spectra as a computation from scratch
+    monkeypatch.setattr(pstools, "memory_cache", pstools.MemoryCache())
+    expected = pstools.compute_ps(patch, maps_info_list, bin_size=40, **kwargs)
+    assert len(calls) == 2
+    np.testing.assert_allclose(spectra[2], expected[2])
+    for name in expected[3]:
+        np.testing.assert_allclose(spectra[3][name]["TT"], expected[3][name]["TT"])
+
+
+def test_cancel_between_stages(tmp_path, monkeypatch):
+    shape, wcs = enmap.geometry(pos=np.deg2rad([[-8, -8], [8, 8]]), res=np.deg2rad(10 / 60))
+    name = str(tmp_path / "split.fits")
+    enmap.write_map(name, enmap.enmap(np.random.default_rng(0).normal(size=shape), wcs))
+    maps_info_list = [dict(name=name, data_type="I", id="split", cal=None)]
+    patch = dict(patch_type="Rectangle", patch_coordinate=[[-5, -5], [5, 5]])
+
+    # Cancel while the window is created
+    cancel = threading.Event()
+    create_window = pstools.create_window
+
+    def _cancelled_window(*args, **kwargs):
+        cancel.set()
+        return create_window(*args, **kwargs)
+
+    def _coupling(*args, **kwargs):
+        raise AssertionError("Mode coupling computed after cancel")
+
+    monkeypatch.setattr(pstools, "memory_cache", pstools.MemoryCache())
+    monkeypatch.setattr(pstools, "create_window", _cancelled_window)
+    monkeypatch.setattr(pstools, "_compute_coupling", _coupling)
+    state = {}
+    with pytest.raises(pstools.ComputationCancelled):
+        pstools.compute_ps(
+            patch,
+            maps_info_list,
+            compute_T_only=True,
+            lmax=300,
+            bin_size=20,
+            state=state,
+            cancel=cancel,
+        )
+    # The window is kept for the next computation
+    assert "window" in state and "mcm" not in state
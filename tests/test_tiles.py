@@ -0,0 +1,174 @@
+import functools
+import glob
+import os
+import threading
+
+import numpy as np
+import pytest
+from pixell import enmap
+
+from psplay.tools import tile_utils_sigurd
+from psplay.tools.car2tiles import car2tiles
+
+
+def _read_tiles(directory):
+    return {
+        os.path.relpath(f, directory): enmap.read_map(f)
+        for f in glob.glob(os.path.join(directory, "*", "*.fits"))
+    }
+
+
+@pytest.mark.parametrize("res", [8, 30])
+def test_leafpyramid_matches_leaftile_fullsky(tmp_path, res):
+    # The geometric range of base tiles of a full-sky map goes beyond the south pole
+    shape, wcs = enmap.fullsky_geometry(res=np.deg2rad(res / 60))
+    imap = enmap.enmap(np.random.default_rng(0).normal(size=(2,) + shape), wcs)
+    ifile = str(tmp_path / "map.fits")
+    enmap.write_map(ifile, imap)
+
+    tile_utils_sigurd.leaftile(ifile, str(tmp_path / "leaftile"), monolithic=True)
+    tile_utils_sigurd.leafpyramid(ifile, str(tmp_path / "leafpyramid"))
+
+    expected = _read_tiles(str(tmp_path / "leaftile"))
+    tiles = _read_tiles(str(tmp_path / "leafpyramid"))
+    assert sorted(tiles) == sorted(expected)
+    for name, tile in tiles.items():
+        assert tile.shape == expected[name].shape, name
+        np.testing.assert_array_equal(tile, expected[name], err_msg=name)
+        np.testing.assert_array_equal(tile.wcs.wcs.crpix, expected[name].wcs.wcs.crpix, name)
+
+
+class _ThreadComm:
+    # A communicator between threads with the gather of mpi4py
+    def __init__(self, size):
+        self.size = size
+        self._local = threading.local()
+        self._barrier = threading.Barrier(size)
+        self._values = [None] * size
+
+    @property
+    def rank(self):
+        return self._local.rank
+
+    def gather(self, value, root=0):
+        self._barrier.wait()
+        self._values[self.rank] = value
+        self._barrier.wait()
+        values = list(self._values)
+        self._barrier.wait()
+        return values if self.rank == root else None
+
+    def run(self, func):
+        errors = []
+
+        def _run(rank):
+            self._local.rank = rank
+            try:
+                func(rank)
+            except Exception as e:
+                errors.append(e)
+                self._barrier.abort()
+
+        threads = [threading.Thread(target=_run, args=(rank,)) for rank in range(self.size)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        if errors:
+            raise errors[0]
+
+
+@pytest.mark.parametrize("size", [2, 5])
+def test_leafpyramid_mpi_matches_leaftile(tmp_path, size):
+    shape, wcs = enmap.fullsky_geometry(res=np.deg2rad(8 / 60))
+    imap = enmap.enmap(np.random.default_rng(0).normal(size=shape), wcs)
+    ifile = str(tmp_path / "map.fits")
+    enmap.write_map(ifile, imap)
+    tile_utils_sigurd.leaftile(ifile, str(tmp_path / "leaftile"), tsize=100, monolithic=True)
+
+    comm = _ThreadComm(size)
+    odir = str(tmp_path / "leafpyramid")
+    written = {rank: [] for rank in range(size)}
+
+    def write(rank, oname, omap):
+        written[rank].append(os.path.relpath(oname, odir))
+        enmap.write_map(oname, omap)
+
+    comm.run(
+        lambda rank: tile_utils_sigurd.leafpyramid(
+            ifile, odir, write=lambda oname, omap: write(rank, oname, omap), tsize=100, comm=comm
+        )
+    )
+
+    # Each tile is written once and the base tiles are spread over all the tasks
+    names = [name for rank in written for name in written[rank]]
+    assert len(names) == len(set(names))
+    for rank in written:
+        assert any(name.startswith("0" + os.sep) for name in written[rank]), rank
+
+    expected = _read_tiles(str(tmp_path / "leaftile"))
+    tiles = _read_tiles(odir)
+    assert sorted(tiles) == sorted(expected)
+    for name, tile in tiles.items():
+        np.testing.assert_array_equal(tile, expected[name], err_msg=name)
+        np.testing.assert_array_equal(tile.wcs.wcs.crpix, expected[name].wcs.wcs.crpix, name)
+
+
+def _read_pngs(directory):
+    pngs = {}
+    for f in glob.glob(os.path.join(directory, "*", "*.png")):
+        with open(f, "rb") as png:
+            pngs[os.path.relpath(f, directory)] = png.read()
+    return pngs
+
+
+def test_car2tiles_incremental_matches_full_rebuild(tmp_path, monkeypatch):
+    shape, wcs = enmap.fullsky_geometry(res=np.deg2rad(27 / 60))
+    imap = enmap.enmap(np.random.default_rng(0).normal(size=shape), wcs)
+    ifile = str(tmp_path / "map.fits")
+    enmap.write_map(ifile, imap)
+
+    # Small tiles so that the map is made of 4 x 8 base tiles
+    dirty = []
+    leafpyramid = tile_utils_sigurd.leafpyramid
+
+    def _leafpyramid(*args, **kwargs):
+        dirty.append(kwargs["dirty"])
+        leafpyramid(*args, tsize=100, **kwargs)
+
+    monkeypatch.setattr(tile_utils_sigurd, "leafpyramid", _leafpyramid)
+    monkeypatch.setattr(
+        tile_utils_sigurd,
+        "leafchecksums",
+        functools.partial(tile_utils_sigurd.leafchecksums, tsize=100),
+    )
+
+    odir = str(tmp_path / "incremental")
+    car2tiles(ifile, output_dir=odir, incremental=True)
+    assert dirty[-1] is None
+    assert len(_read_tiles(odir)) == 32 + 8 + 2 + 1 + 1 + 1
+
+    # A local change across the border of two base tiles
+    imap[250:260, 395:405] += 10
+    enmap.write_map(ifile, imap)
+    car2tiles(ifile, output_dir=odir, incremental=True)
+    rebuilt = dirty[-1]
+    assert len(rebuilt) == 2
+
+    full_dir = str(tmp_path / "full")
+    car2tiles(ifile, output_dir=full_dir)
+    expected = _read_pngs(full_dir)
+    assert _read_pngs(odir) == expected
+
+    # Tiles of a previous run missing on disk trigger a full rebuild
+    y, x = sorted(rebuilt)[0]
+    assert (y ^ 1, x) not in rebuilt
+    neighbour = os.path.join(odir, "0", "tile_%d_%d.fits" % (y ^ 1, x))
+    os.remove(neighbour)
+    imap[250:260, 395:405] -= 10
+    enmap.write_map(ifile, imap)
+    car2tiles(ifile, output_dir=odir, incremental=True)
+    assert len(dirty[-1]) == 2
+    assert os.path.exists(neighbour)
+    car2tiles(ifile, output_dir=full_dir)
+    assert _read_pngs(odir) == _read_pngs(full_dir)